@@ -1,5 +1,6 @@
 import json
 from os import environ
+from hashlib import sha1
 from pathlib import Path
 
 from types import UnionType
@@ -20,6 +21,12 @@ class Log:
 @dataclass
 class DB:
     url: str
+    tag_cache_size: int = 65536
+    tag_cache_preload: int = 8192
+    thumb_cache_size: int = 262144
+    vector_batch_size: int = 1000
+    thumb_claim_lease: int = 3600
+    import_batch_size: int = 50000
 
 
 @dataclass
@@ -59,6 +66,39 @@ EHExtraArgs._INT_PARAM_DICT = {
 }
 
 
+@dataclass
+class EHRateLimit:
+    burst: int = 1
+    api_min_interval: float | None = None
+    api_burst: int = 1
+    listing_min_interval: float | None = None
+    listing_burst: int = 1
+    max_interval: float = 300
+    additive_increase: float = 0.01
+    multiplicative_decrease: float = 0.5
+    overload_retries: int = 3
+    overload_pause: int = 60
+    max_ban_wait: int = 6 * 3600
+
+
+@dataclass
+class EHRefresh:
+    enabled: bool = False
+    min_interval: int = 6 * 3600
+    max_interval: int = 90 * 86400
+    age_factor: float = 0.1
+    batch_size: int = 1000
+    max_galleries: int | None = None
+
+
+@dataclass
+class EHIdentity:
+    name: str | None = None
+    proxy: str | None = None
+    cookies: dict[str, str] | None = None
+    min_request_interval: int | None = None
+
+
 @dataclass
 class EH:
     base_url: str = 'https://e-hentai.org'
@@ -69,6 +109,14 @@ class EH:
     include_expunged: bool = True
     extra_args: EHExtraArgs = field(default_factory=EHExtraArgs)
     min_request_interval: int = 5
+    pipeline_depth: int = 4
+    backfill_shards: int = 64
+    backfill_workers: int | None = None
+    rate_limit: EHRateLimit = field(default_factory=EHRateLimit)
+    identities: list[EHIdentity] = field(default_factory=list)
+    refresh: EHRefresh = field(default_factory=EHRefresh)
+    response_store: Path | None = None
+    offline: bool = False
     torrent_key: str | None = None
 
     def get_f_cats(self):
@@ -85,6 +133,14 @@ class EH:
         args.update(self.extra_args.to_dict())
         return args
 
+    def get_search_hash(self):
+        '''
+        Identify the search for crawl_state, f_sh is left out as the expunged pass is tracked separately
+        '''
+
+        args = {k: v for k, v in self.get_search_args().items() if k != 'f_sh'}
+        return sha1(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()
+
 
 EH._CATEGORY_ENCODINGS = {
     Category.MISC:       1,
@@ -111,6 +167,17 @@ class FilterDedupe:
     expunged_tags: list[str] = field(default_factory=list)
     expunged_bias: int = -100
     tag_biases: dict[str, int] = field(default_factory=dict)
+    ann_k: int = 20
+    ef_search: int = 40
+    ann_build_memory: str = '1GB'
+    embedding_dir: Path = APPDATA / 'embeddings'
+    embedding_dtype: str = 'float16'
+    embedding_block: int = 4096
+    embedding_workers: int | None = None
+    dhash_match_distance: int = 4
+    dhash_candidate_distance: int = 7
+    dhash_chunks: int = 4
+    dhash_max_bucket: int = 1000
 
 @dataclass
 class Filter:
@@ -128,6 +195,9 @@ class Aria2:
     local_dir: Path | None
     task_limit: int = 128
     poll_interval: int = 10
+    notifications: bool = True
+    ws_url: str | None = None
+    safety_poll_interval: int = 60
 
 
 @dataclass
@@ -156,6 +226,17 @@ class Archiver:
     blacklist: ArchiverBlacklist = field(default_factory=ArchiverBlacklist)
 
 
+@dataclass
+class Vectorizer:
+    batch_size: int = 64
+    decode_workers: int = 4
+    torch_threads: int | None = None
+    backend: str = 'torch'
+    onnx_model: Path = APPDATA / 'models' / 'mobilenet_v3_small.onnx'
+    onnx_quantized: bool = False
+    onnx_threads: int | None = None
+
+
 @dataclass
 class Config:
     db: DB
@@ -165,6 +246,7 @@ class Config:
     eh: EH = field(default_factory=EH)
     log: Log = field(default_factory=Log)
     archiver: Archiver = field(default_factory=Archiver)
+    vectorizer: Vectorizer = field(default_factory=Vectorizer)
 
 
 def load_dict(cls, data):
@@ -192,6 +274,8 @@ def load_dict(cls, data):
                     _origin = get_origin(_f_type)
                 if _origin is None:
                     value = _f_type(value)
+                elif _origin is list and is_dataclass(get_args(_f_type)[0]):
+                    value = [load_dict(get_args(_f_type)[0], v) for v in value]
                 else:
                     value = _origin(value)
             kwargs[f.name] = value
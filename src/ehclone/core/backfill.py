@@ -0,0 +1,180 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select, func
+from tabulate import tabulate
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.core.eh_session import ehs
+from ehclone.core.sync_index import IndexPipeline, fetch_page, _DONE
+from ehclone.db.entities import Gallery
+from ehclone.db.session import session_generator
+from ehclone.db.crud.crawl_state import get_cursors, set_cursor
+
+
+def range_prefix(expunged=False):
+    return 'backfill-expunged' if expunged else 'backfill'
+
+
+def range_name(prefix, lo, hi):
+    return f'{prefix}:{lo}:{hi}'
+
+
+def parse_range_name(name):
+    _, lo, hi = name.split(':')
+    return int(lo), int(hi)
+
+
+class RangePipeline(IndexPipeline):
+    '''
+    Walk the gid range [lo, hi) downwards with the next cursor. The cursor saved
+    to crawl_state is the smallest gid written so far, lo once the range is done.
+    '''
+
+    def __init__(self, lo, cursor, expunged=False, checkpoint=None):
+        super().__init__(cursor, expunged=expunged, checkpoint=checkpoint)
+        self.lo = lo
+        # Set once the walk went below lo or ran out of pages
+        self.exhausted = False
+
+    def _crawl_stage(self):
+        cursor = self.prev
+        try:
+            while not self.stop.is_set():
+                page = fetch_page(None, expunged=self.expunged, next=cursor)
+                if page is None:
+                    break
+                # Galleries below lo belong to the neighbouring range
+                gidlist = [g for g in page.galleries if self.lo <= g[0] < cursor]
+                if gidlist and not self._put(self.gdata_queue, (gidlist[-1][0], gidlist), self.gdata_thread):
+                    break
+                if not gidlist or len(gidlist) < len(page.galleries):
+                    self.exhausted = True
+                    break
+                cursor = gidlist[-1][0]
+        finally:
+            self._put(self.gdata_queue, _DONE, self.gdata_thread)
+
+
+def plan_ranges(search_hash, shards, expunged=False):
+    '''
+    The saved ranges of this search, or shards new ranges of equal gid width
+    up to the newest gallery if there are none
+
+    :return: dict of (lo, hi) to cursor
+    '''
+
+    prefix = range_prefix(expunged)
+    ranges = {parse_range_name(name): cursor for name, cursor in get_cursors(search_hash, prefix).items()}
+    if ranges:
+        return ranges
+
+    page = fetch_page(None, expunged=expunged)
+    if not page or not page.galleries:
+        logger.error('Could not find the newest gallery to plan the backfill')
+        return {}
+    newest = page.galleries[0][0]
+
+    width = -(-newest // shards)
+    for lo in range(1, newest + 1, width):
+        hi = min(lo + width, newest + 1)
+        ranges[(lo, hi)] = hi
+        set_cursor(search_hash, range_name(prefix, lo, hi), hi)
+    logger.info(f'Planned {len(ranges)} backfill ranges up to gid {newest}')
+    return ranges
+
+
+def _crawl_range(search_hash, prefix, lo, hi, cursor, expunged):
+    name = range_name(prefix, lo, hi)
+    logger.info(f'Backfilling {name} from {cursor}')
+    pipeline = RangePipeline(lo, cursor, expunged=expunged, checkpoint=(search_hash, name))
+    try:
+        cursor = pipeline.run()
+    except Exception as e:
+        logger.error(f'Backfill of {name} stopped at {pipeline.last_gid}: {e}')
+        return False
+
+    if pipeline.exhausted and not pipeline.stop.is_set():
+        set_cursor(search_hash, name, lo)
+        logger.info(f'Backfill of {name} complete')
+        return True
+    logger.warning(f'Backfill of {name} stopped at {cursor}, it resumes from there on the next run')
+    return False
+
+
+def backfill(expunged=False, shards=None, workers=None):
+    '''
+    Crawl the gid space as disjoint ranges concurrently, one range per worker.
+    Every range resumes from its own saved cursor, inserts are upserts so
+    overlapping or repeated pages merge without side effects.
+    :param shards: Number of ranges of a new plan, defaults to eh.backfill_shards
+    :param workers: Ranges crawled at once, defaults to eh.backfill_workers or one per identity
+
+    :return: number of ranges completed by this run
+    '''
+
+    shards = shards or config.eh.backfill_shards
+    workers = workers or config.eh.backfill_workers or len(ehs.identities)
+    search_hash = config.eh.get_search_hash()
+    prefix = range_prefix(expunged)
+
+    ranges = plan_ranges(search_hash, shards, expunged=expunged)
+    # Ranges closest to the newest galleries first
+    pending = sorted(((lo, hi, cursor) for (lo, hi), cursor in ranges.items() if cursor > lo), reverse=True)
+    logger.info(f'{len(pending)} of {len(ranges)} backfill ranges pending, crawling {workers} at once')
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill') as executor:
+        done = sum(executor.map(
+            lambda r: _crawl_range(search_hash, prefix, *r, expunged),
+            pending,
+        ))
+
+    logger.info(f'Backfill run complete, {done} ranges finished, request stats: {ehs.stats()}')
+    return done
+
+
+def coverage_report(expunged=False):
+    '''
+    Print the progress of every backfill range with the galleries stored in it,
+    and the gid intervals not yet crawled
+
+    :return: list of (lo, hi) gaps
+    '''
+
+    search_hash = config.eh.get_search_hash()
+    ranges = sorted(
+        (*parse_range_name(name), cursor)
+        for name, cursor in get_cursors(search_hash, range_prefix(expunged)).items()
+    )
+    if not ranges:
+        print('No backfill has been planned for the current search.')
+        return []
+
+    rows = []
+    gaps = []
+    with session_generator() as session:
+        for lo, hi, cursor in ranges:
+            stored = session.execute(
+                select(func.count())
+                .where(Gallery.gid >= lo)
+                .where(Gallery.gid < hi)
+                .where(Gallery.title.isnot(None))
+            ).scalar()
+            progress = (hi - cursor) / (hi - lo)
+            rows.append([lo, hi, cursor, f'{progress:.1%}', stored])
+            if cursor > lo:
+                gaps.append((lo, cursor))
+
+    # Ranges are planned back to back, anything between them was never assigned
+    for (_, hi, _), (lo, _, _) in zip(ranges, ranges[1:]):
+        if lo > hi:
+            gaps.append((hi, lo))
+    gaps.sort()
+
+    print(tabulate(rows, headers=['lo', 'hi', 'cursor', 'done', 'galleries']))
+    print()
+    if gaps:
+        print(tabulate(gaps, headers=['gap lo', 'gap hi']))
+    else:
+        print('No gaps, every range is complete.')
+    return gaps
@@ -1,113 +1,347 @@
 #!/usr/bin/env python3
 
-from time import sleep
-from datetime import datetime
+import re
+from time import sleep, monotonic
+from threading import Lock
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from ehclone.config import config
 from ehclone.logger import logger
+from ehclone.core.rate_limiter import AdaptiveBucket, RateLimiter
+from ehclone.core.response_store import ResponseStore
 
 
-class EHSession:
-    GDATA_LIMIT = 25
+class EHOverloaded(requests.RequestException):
+    pass
 
-    def __init__(self):
+
+_BAN_RE = re.compile(r'ban expires in(.*)', re.IGNORECASE | re.DOTALL)
+_DURATION_RE = re.compile(r'(\d+)\s+(day|hour|minute|second)s?')
+_DURATION_UNITS = {
+    'day':    86400,
+    'hour':   3600,
+    'minute': 60,
+    'second': 1,
+}
+
+
+def classify_response(res):
+    '''
+    Tell apart normal responses from the ways EH signals overload
+    :param res: A requests Response
+
+    :return: (RateLimiter kind, seconds to pause or None)
+    '''
+
+    overload_pause = config.eh.rate_limit.overload_pause
+
+    if res.status_code in (429, 503, 509):
+        retry_after = res.headers.get('Retry-After', '')
+        pause = int(retry_after) if retry_after.isdigit() else overload_pause
+        return RateLimiter.OVERLOAD, pause
+
+    if not res.ok:
+        return RateLimiter.ERROR, None
+
+    # Ban and warning pages are short plain text, don't decode real pages
+    if len(res.content) < 2048:
+        text = res.text
+        m = _BAN_RE.search(text)
+        if m:
+            pause = sum(int(n) * _DURATION_UNITS[unit] for n, unit in _DURATION_RE.findall(m.group(1)))
+            return RateLimiter.BANNED, pause or overload_pause
+        if 'opening pages too fast' in text:
+            return RateLimiter.OVERLOAD, overload_pause
+
+    return RateLimiter.OK, None
+
+
+def build_limiter(min_interval, rate_limit):
+    def _bucket(interval, burst):
+        interval = max(interval, 0.001)
+        return AdaptiveBucket(
+            max_rate=1 / interval,
+            burst=burst,
+            min_rate=1 / max(rate_limit.max_interval, interval),
+            increase=rate_limit.additive_increase,
+            decrease=rate_limit.multiplicative_decrease,
+        )
+
+    endpoint_buckets = {}
+    if rate_limit.api_min_interval:
+        endpoint_buckets['api'] = _bucket(rate_limit.api_min_interval, rate_limit.api_burst)
+    if rate_limit.listing_min_interval:
+        endpoint_buckets['listing'] = _bucket(rate_limit.listing_min_interval, rate_limit.listing_burst)
+
+    return RateLimiter(_bucket(min_interval, rate_limit.burst), endpoint_buckets)
+
+
+class Identity:
+    '''
+    One set of cookies and proxy with its own rate limiter and health state
+    '''
+
+    # Consecutive transport errors before an identity is parked
+    MAX_FAILURES = 3
+
+    def __init__(self, name, cookies=None, proxy=None, min_request_interval=None):
+        self.name = name
         self.session = requests.Session()
-        self.session.mount('https://', HTTPAdapter(max_retries=5))
+        # Only transport errors are retried here, overload responses go through the limiter.
+        # urllib3 would otherwise retry 413/429/503 with Retry-After itself and raise RetryError.
+        retry = Retry(total=5, backoff_factor=1, status=0, respect_retry_after_header=False, raise_on_status=False)
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36',
         })
 
-        if config.eh.cookies:
+        if cookies:
             requests.utils.add_dict_to_cookiejar(
                 self.session.cookies,
-                config.eh.cookies
+                cookies
             )
         else:
-            logger.warning('No cookies configured.')
+            logger.warning(f'No cookies configured for identity {name}.')
 
-        if config.eh.proxy:
-            url = config.eh.proxy
-            logger.info(f'Using proxy: {url}')
+        if proxy:
+            logger.info(f'Identity {name} using proxy: {proxy}')
             self.session.proxies.update({
-                'http': url,
-                'https': url,
+                'http': proxy,
+                'https': proxy,
             })
         else:
-            logger.info('No proxies configured.')
+            logger.info(f'No proxies configured for identity {name}.')
+
+        if min_request_interval is None:
+            min_request_interval = config.eh.min_request_interval
+        self.limiter = build_limiter(min_request_interval, config.eh.rate_limit)
+
+        self.parked_until = 0
+        self.failures = 0
+
+    def park(self, seconds):
+        self.parked_until = max(self.parked_until, monotonic() + seconds)
+
+    def is_parked(self, now=None):
+        if now is None:
+            now = monotonic()
+        return self.parked_until > now
+
+
+class EHSession:
+    '''
+    A pool of identities, every request goes out through the healthy identity
+    that can send it the soonest. Banned identities are parked until the ban
+    expires while the others keep working.
+    '''
+
+    GDATA_LIMIT = 25
+
+    def __init__(self):
+        if config.eh.identities:
+            self.identities = [
+                Identity(
+                    name=i.name or str(n),
+                    cookies=i.cookies if i.cookies is not None else config.eh.cookies,
+                    proxy=i.proxy if i.proxy is not None else config.eh.proxy,
+                    min_request_interval=i.min_request_interval,
+                )
+                for n, i in enumerate(config.eh.identities)
+            ]
+        else:
+            self.identities = [Identity('default', config.eh.cookies, config.eh.proxy)]
+        logger.info(f'Using {len(self.identities)} EH identities')
 
-        self.last_req_time = 0
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.identities), thread_name_prefix='ehs')
         self.base_url = config.eh.base_url.strip('/')
 
-    def _wait(self):
-        _wait_sec = config.eh.min_request_interval - (datetime.now().timestamp() - self.last_req_time)
-        if _wait_sec > 0:
-            sleep(_wait_sec)
-        self.last_req_time = datetime.now().timestamp()
+        # Raw responses are recorded here, and served from here when offline
+        self.store = ResponseStore(config.eh.response_store) if config.eh.response_store else None
+        if config.eh.offline and self.store is None:
+            raise ValueError('eh.offline needs eh.response_store')
+
+    def stats(self):
+        return {i.name: i.limiter.stats.as_dict() for i in self.identities}
+
+    def _pick(self, endpoint):
+        '''
+        Reserve a request slot on the identity that can send the soonest
+
+        :return: (identity, seconds to wait), identity is None if all of them are parked
+        '''
+
+        with self._lock:
+            now = monotonic()
+            active = [i for i in self.identities if not i.is_parked(now)]
+            if not active:
+                return None, min(i.parked_until for i in self.identities) - now
+            identity = min(active, key=lambda i: i.limiter.peek(endpoint))
+            return identity, identity.limiter.reserve(endpoint)
+
+    def _request(self, method, url, *args, **kwargs):
+        endpoint = 'api' if urlparse(url).path.endswith('/api.php') else 'listing'
+        rate_limit = config.eh.rate_limit
+
+        res = None
+        for _ in range(rate_limit.overload_retries + len(self.identities)):
+            identity, wait = self._pick(endpoint)
+            if identity is None:
+                if wait > rate_limit.max_ban_wait:
+                    raise EHOverloaded(f'All identities are parked for at least {wait:.0f}s', response=res)
+                logger.warning(f'All identities are parked, waiting {wait:.0f}s')
+                sleep(wait)
+                continue
+            if wait > 0:
+                sleep(wait)
+
+            try:
+                res = identity.session.request(method, url, *args, **kwargs)
+            except requests.RequestException:
+                identity.limiter.feedback(endpoint, RateLimiter.ERROR)
+                identity.failures += 1
+                if identity.failures >= Identity.MAX_FAILURES:
+                    logger.warning(f'Identity {identity.name} failed {identity.failures} times, parking it')
+                    identity.park(rate_limit.overload_pause)
+                raise
+            identity.failures = 0
+
+            kind, pause = classify_response(res)
+            identity.limiter.feedback(endpoint, kind, pause)
+
+            if kind == RateLimiter.OK:
+                return res
+            if kind == RateLimiter.ERROR:
+                res.raise_for_status()
+                return res
+            if kind == RateLimiter.BANNED:
+                logger.warning(f'Identity {identity.name} is banned for {pause}s, parking it')
+                identity.park(pause)
+                continue
+
+            logger.warning(f'{kind} response from {url} on identity {identity.name}, pausing {pause}s and pacing at {1 / identity.limiter.rate:.1f}s/request')
+
+        raise EHOverloaded(f'Still overloaded after {rate_limit.overload_retries} retries: {url}', response=res)
 
     def _get(self, url, *args, **kwargs):
-        self._wait()
-        res = self.session.get(url, *args, **kwargs)
-        res.raise_for_status()
-        return res
+        return self._request('GET', url, *args, **kwargs)
 
     def get(self, path, *args, **kwargs):
         res = self._get(self.base_url + path, *args, **kwargs)
         return res
 
     def _post(self, url, *args, **kwargs):
-        self._wait()
-        res = self.session.post(url, *args, **kwargs)
-        res.raise_for_status()
-        return res
+        return self._request('POST', url, *args, **kwargs)
 
     def post(self, path, *args, **kwargs):
         res = self._post(self.base_url + path, *args, **kwargs)
         return res
 
-    def gdata(self, gidlist):
+    def listing(self, query):
+        '''
+        :param query: The urlencoded search of a listing page
+
+        :return: the raw page body, None if offline and the page was never fetched
+        '''
+
+        if config.eh.offline:
+            return self.store.get_listing(query)
+        body = self.get('/?' + query).content
+        if self.store is not None:
+            self.store.put_listing(query, body)
+        return body
+
+    def _gdata_chunk(self, gidlist):
+        _json = {
+            'method': 'gdata',
+            'gidlist': gidlist,
+            'namespace': 1,
+        }
+
+        res = self.post('/api.php', json=_json)
+        gmetadata = res.json().get('gmetadata', [])
+        if not isinstance(gmetadata, list):
+            gmetadata = []
+        return gmetadata
+
+    def gdata_partial(self, gidlist):
+        '''
+        Fetch what EH returns, telling apart galleries EH answered without from
+        galleries whose request failed
+        :param gidlist: list of [gid, token]
+
+        :return: (list of gmetadata entries, set of gids whose request failed)
+        '''
+
+        if config.eh.offline:
+            results = self.store.get_gdata(gidlist)
+            found = {int(d['gid']) for d in results}
+            unfetched = {gid for gid, _ in gidlist if gid not in found}
+            if unfetched:
+                logger.error(f'{len(unfetched)} galleries are not in the response store')
+            return results, unfetched
+
         giddict = { g[0]: g[1] for g in gidlist }
         prev_len = len(giddict)
 
         results = []
+        unfetched = set()
         while giddict:
-            _gidlist = [list(g) for g in list(giddict.items())[:self.GDATA_LIMIT]]
-
-            _json = {
-                'method': 'gdata',
-                'gidlist': _gidlist,
-                'namespace': 1,
-            }
-
-            try:
-                res = self.post('/api.php', json=_json)
-            except requests.RequestException as e:
-                logger.error(f'GDATA post failed: {e}')
-                break
+            _items = [list(g) for g in giddict.items()]
+            _chunks = [_items[i:i + self.GDATA_LIMIT] for i in range(0, len(_items), self.GDATA_LIMIT)]
 
-            gmetadata = res.json().get('gmetadata', [])
-            if not isinstance(gmetadata, list):
-                gmetadata = []
+            # Chunks are spread over the identities, a failed chunk does not drop the others
+            futures = [self._executor.submit(self._gdata_chunk, chunk) for chunk in _chunks]
+            for chunk, future in zip(_chunks, futures):
+                try:
+                    gmetadata = future.result()
+                except requests.RequestException as e:
+                    logger.error(f'GDATA post failed: {e}')
+                    for gid, _ in chunk:
+                        unfetched.add(gid)
+                        del giddict[gid]
+                    continue
 
-            for d in gmetadata:
-                gid = d.get('gid')
-                token = d.get('token')
-                if gid and token and token == giddict.get(gid):
-                    results.append(d)
-                    del giddict[gid]
-                else:
-                    logger.error(f'GDATA response missing or invalid for gid: {gid}')
+                for d in gmetadata:
+                    gid = d.get('gid')
+                    token = d.get('token')
+                    if gid and token and token == giddict.get(gid):
+                        results.append(d)
+                        del giddict[gid]
+                    else:
+                        logger.error(f'GDATA response missing or invalid for gid: {gid}')
 
             if len(giddict) == prev_len:
                 break
             prev_len = len(giddict)
 
+        if self.store is not None and results:
+            self.store.put_gdata(results)
+
         if giddict:
             logger.error(f'Failed to retrieve metadata for gids: {list(giddict)}')
-            return {}
+        if unfetched:
+            logger.error(f'Requests failed for gids: {sorted(unfetched)}')
 
+        return results, unfetched
+
+    def gdata(self, gidlist, strict=True):
+        '''
+        :param gidlist: list of [gid, token]
+        :param strict: Fail as a whole if any gallery is missing, otherwise
+                       return what was found
+
+        :return: list of gmetadata entries, {} on failure
+        '''
+
+        results, unfetched = self.gdata_partial(gidlist)
+        if strict and (unfetched or len(results) < len(gidlist)):
+            return {}
         return results
 
 
@@ -0,0 +1,280 @@
+import io
+import sys
+import bz2
+import csv
+import gzip
+import json
+import lzma
+
+from sqlalchemy import literal_column
+from sqlalchemy.dialects import postgresql
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.db.cache import tag_cache, thumb_cache
+from ehclone.db.session import session_generator
+from ehclone.db.crud.gallery import GALLERY_UPSERT_COLUMNS, parse_gdata, rebuild_chains, next_refresh_at
+
+
+STAGE_GALLERY_COLUMNS = GALLERY_UPSERT_COLUMNS + ('gid', 'first_key', 'fingerprint')
+STAGE_TAG_COLUMNS = ('gid', 'namespace', 'name')
+STAGE_TORRENT_COLUMNS = ('gid', 'infohash', 'added_at', 'name', 'tsize', 'fsize')
+
+_STAGE_TYPES = {
+    'gid': 'bigint',
+    'token': 'text',
+    'title': 'text',
+    'title_jpn': 'text',
+    'category': 'text',
+    'thumb_url': 'text',
+    'uploader': 'text',
+    'posted_at': 'timestamptz',
+    'filecount': 'integer',
+    'filesize': 'bigint',
+    'expunged': 'boolean',
+    'rating': 'integer',
+    'first_gid': 'bigint',
+    'first_key': 'text',
+    'fingerprint': 'bigint',
+    'namespace': 'text',
+    'name': 'text',
+    'infohash': 'text',
+    'added_at': 'timestamptz',
+    'tsize': 'bigint',
+    'fsize': 'bigint',
+}
+
+
+def _stage_ddl(table, columns):
+    return f'CREATE TEMP TABLE {table} ({", ".join(f"{c} {_STAGE_TYPES[c]}" for c in columns)}) ON COMMIT DROP'
+
+
+_GALLERY_COLUMNS = ('gid',) + GALLERY_UPSERT_COLUMNS + ('fingerprint',)
+_GALLERY_SELECT = ', '.join('category::category' if c == 'category' else c for c in _GALLERY_COLUMNS)
+_GALLERY_SET = ', '.join(f'{c} = excluded.{c}' for c in GALLERY_UPSERT_COLUMNS + ('fingerprint', 'next_refresh_at'))
+_NEXT_REFRESH_AT = next_refresh_at(literal_column('posted_at')).compile(
+    dialect=postgresql.dialect(),
+    compile_kwargs={'literal_binds': True},
+)
+
+# In FK order, every statement only touches rows that differ from the stored ones
+MERGE_STATEMENTS = [
+    '''
+    INSERT INTO thumb (url, first_gid)
+    SELECT thumb_url, min(gid) FROM stage_gallery WHERE thumb_url IS NOT NULL GROUP BY thumb_url
+    ON CONFLICT (url) DO UPDATE SET first_gid = least(thumb.first_gid, excluded.first_gid)
+    WHERE thumb.first_gid IS NULL OR excluded.first_gid < thumb.first_gid
+    ''',
+    '''
+    INSERT INTO tag (namespace, name)
+    SELECT DISTINCT s.namespace, s.name FROM stage_tag s
+    WHERE NOT EXISTS (SELECT 1 FROM tag t WHERE t.namespace = s.namespace AND t.name = s.name)
+    ON CONFLICT DO NOTHING
+    ''',
+    '''
+    INSERT INTO gallery (gid, token, first_gid, next_refresh_at)
+    SELECT DISTINCT ON (first_gid) first_gid, first_key, first_gid, localtimestamp FROM stage_gallery
+    WHERE first_gid IS NOT NULL
+    ORDER BY first_gid
+    ON CONFLICT DO NOTHING
+    ''',
+    f'''
+    WITH changed AS (
+        INSERT INTO gallery ({", ".join(_GALLERY_COLUMNS)}, next_refresh_at)
+        SELECT {_GALLERY_SELECT}, {_NEXT_REFRESH_AT} FROM stage_gallery
+        ON CONFLICT (gid) DO UPDATE SET {_GALLERY_SET}, updated_at = now(), refreshed_at = now()
+        WHERE gallery.fingerprint IS DISTINCT FROM excluded.fingerprint
+        RETURNING gid
+    )
+    INSERT INTO stage_changed SELECT gid FROM changed
+    ''',
+    '''
+    DELETE FROM gallery_tag gt USING stage_changed c
+    WHERE gt.gallery_gid = c.gid AND NOT EXISTS (
+        SELECT 1 FROM stage_tag s JOIN tag t ON t.namespace = s.namespace AND t.name = s.name
+        WHERE s.gid = gt.gallery_gid AND t.id = gt.tag_id
+    )
+    ''',
+    '''
+    INSERT INTO gallery_tag (gallery_gid, tag_id)
+    SELECT DISTINCT s.gid, t.id FROM stage_tag s
+    JOIN stage_changed c ON c.gid = s.gid
+    JOIN tag t ON t.namespace = s.namespace AND t.name = s.name
+    ON CONFLICT DO NOTHING
+    ''',
+    '''
+    DELETE FROM torrent tr USING stage_changed c
+    WHERE tr.gid = c.gid AND NOT EXISTS (
+        SELECT 1 FROM stage_torrent s WHERE s.gid = tr.gid AND s.infohash = tr.infohash
+    )
+    ''',
+    '''
+    INSERT INTO torrent (gid, infohash, added_at, name, tsize, fsize)
+    SELECT DISTINCT ON (s.gid, s.infohash) s.gid, s.infohash, s.added_at, s.name, s.tsize, s.fsize
+    FROM stage_torrent s JOIN stage_changed c ON c.gid = s.gid
+    ORDER BY s.gid, s.infohash
+    ON CONFLICT (gid, infohash) DO UPDATE SET
+        added_at = excluded.added_at, name = excluded.name, tsize = excluded.tsize, fsize = excluded.fsize
+    WHERE (torrent.added_at, torrent.name, torrent.tsize, torrent.fsize)
+        IS DISTINCT FROM (excluded.added_at, excluded.name, excluded.tsize, excluded.fsize)
+    ''',
+]
+
+
+def open_dump(path):
+    '''
+    Open a dump as text by its suffix, '-' for stdin
+    '''
+
+    if str(path) == '-':
+        return sys.stdin
+    suffix = path.suffix.lower()
+    if suffix == '.gz':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if suffix == '.bz2':
+        return bz2.open(path, 'rt', encoding='utf-8')
+    if suffix in ('.xz', '.lzma'):
+        return lzma.open(path, 'rt', encoding='utf-8')
+    if suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(f'zstandard is required to read {path}, install ehclone[zstd]') from e
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def iter_dump(path):
+    '''
+    Stream the gdata entries of a JSONL dump, one entry or one gdata API response per line
+    '''
+
+    with open_dump(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                logger.warning(f'{path}:{line_no} is not JSON, skipped')
+                continue
+            entries = obj.get('gmetadata', [obj]) if isinstance(obj, dict) else obj
+            for entry in entries:
+                if isinstance(entry, dict) and 'error' not in entry:
+                    yield entry
+
+
+def _csv_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'name') and hasattr(value, 'value'):
+        # Enum columns store the member name
+        return value.name
+    return value
+
+
+def _stage_buffers(entries):
+    '''
+    Normalize entries with parse_gdata into CSV buffers for the staging tables
+
+    :return: (gallery, tag, torrent buffers, number of galleries, number of entries rejected)
+    '''
+
+    parsed = {}
+    rejected = 0
+    for entry in entries:
+        try:
+            gallery, first, tags, torrents = parse_gdata(entry)
+        except Exception:
+            rejected += 1
+            continue
+        # The last copy of a gallery wins, like consecutive upserts would
+        parsed[gallery['gid']] = (gallery, first, tags, torrents)
+
+    buffers = [io.StringIO(), io.StringIO(), io.StringIO()]
+    gallery_csv, tag_csv, torrent_csv = (csv.writer(b, quoting=csv.QUOTE_NOTNULL) for b in buffers)
+    for gid, (gallery, first, tags, torrents) in parsed.items():
+        row = dict(gallery, first_key=first[1] if first else None)
+        gallery_csv.writerow([_csv_value(row[c]) for c in STAGE_GALLERY_COLUMNS])
+        for namespace, name in tags:
+            tag_csv.writerow([gid, namespace, name])
+        for t in torrents:
+            torrent_csv.writerow([_csv_value(t[c]) for c in STAGE_TORRENT_COLUMNS])
+
+    for b in buffers:
+        b.seek(0)
+    return (*buffers, len(parsed), rejected)
+
+
+def _merge(gallery_buffer, tag_buffer, torrent_buffer):
+    '''
+    COPY one chunk into staging tables and merge it in a single transaction
+
+    :return: number of galleries inserted or changed
+    '''
+
+    with session_generator() as session:
+        cursor = session.connection().connection.cursor()
+        cursor.execute(_stage_ddl('stage_gallery', STAGE_GALLERY_COLUMNS))
+        cursor.execute(_stage_ddl('stage_tag', STAGE_TAG_COLUMNS))
+        cursor.execute(_stage_ddl('stage_torrent', STAGE_TORRENT_COLUMNS))
+        cursor.execute('CREATE TEMP TABLE stage_changed (gid bigint) ON COMMIT DROP')
+
+        for table, columns, buffer in [
+            ('stage_gallery', STAGE_GALLERY_COLUMNS, gallery_buffer),
+            ('stage_tag', STAGE_TAG_COLUMNS, tag_buffer),
+            ('stage_torrent', STAGE_TORRENT_COLUMNS, torrent_buffer),
+        ]:
+            cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT CSV)', buffer)
+            cursor.execute(f'ANALYZE {table}')
+
+        for statement in MERGE_STATEMENTS:
+            cursor.execute(statement)
+        cursor.execute('SELECT count(*) FROM stage_changed')
+        return cursor.fetchone()[0]
+
+
+def _chunks(entries, size):
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_dumps(paths, batch_size=None):
+    '''
+    Load gdata dumps through COPY and staging tables, batch_size entries per
+    transaction so memory stays constant. Chains are resolved once at the end.
+    :param paths: JSONL files, optionally .gz, .bz2, .xz or .zst compressed
+    :param batch_size: Entries per transaction, defaults to db.import_batch_size
+
+    :return: (galleries read, galleries inserted or changed)
+    '''
+
+    batch_size = batch_size or config.db.import_batch_size
+    read = 0
+    changed = 0
+    rejected = 0
+
+    for path in paths:
+        logger.info(f'Importing {path}')
+        for chunk in _chunks(iter_dump(path), batch_size):
+            gallery_buffer, tag_buffer, torrent_buffer, galleries, _rejected = _stage_buffers(chunk)
+            if galleries:
+                changed += _merge(gallery_buffer, tag_buffer, torrent_buffer)
+            read += galleries
+            rejected += _rejected
+            logger.info(f'{read} galleries read, {changed} written, {rejected} rejected')
+
+    # Rows were written behind the caches' back
+    tag_cache.clear()
+    thumb_cache.clear()
+
+    rebuild_chains()
+    logger.info(f'Import complete, {read} galleries read, {changed} written, {rejected} rejected')
+    return read, changed
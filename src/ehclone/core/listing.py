@@ -0,0 +1,78 @@
+import re
+from dataclasses import dataclass, field
+from urllib.parse import urlparse, parse_qs
+
+from lxml import etree
+
+
+GALLERY_HREF = re.compile(r'/g/(\d+)/([0-9a-f]+)')
+RESULT_COUNT = re.compile(r'([\d,]+)\s+result')
+
+# Gallery links of every display mode live under the .itg table or div
+_GALLERY_LINKS = etree.XPath(
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' itg ')]//a[contains(@href, '/g/')]/@href"
+)
+_CURSOR_LINKS = etree.XPath("//a[@id='uprev' or @id='unext' or @id='dprev' or @id='dnext']")
+_SEARCH_TEXT = etree.XPath("string(//div[contains(@class, 'searchtext')])")
+
+_PARSER = etree.HTMLParser(recover=True, no_network=True)
+
+
+@dataclass
+class ListingPage:
+    # [gid, token] in page order, newest first
+    galleries: list[list] = field(default_factory=list)
+    # Cursors of the neighbouring pages, None where there is no such page
+    prev: int | None = None
+    next: int | None = None
+    # Total number of results, approximate for large searches
+    count: int | None = None
+
+
+def _cursor(href, name):
+    values = parse_qs(urlparse(href).query).get(name)
+    if not values:
+        return None
+    try:
+        return int(values[0].split('-')[0])
+    except ValueError:
+        return None
+
+
+def parse_listing(content):
+    '''
+    Parse a listing page without building a soup, in any display mode
+    :param content: The raw response body, bytes so that lxml handles the encoding
+
+    :return: ListingPage
+    '''
+
+    root = etree.fromstring(content, _PARSER)
+    page = ListingPage()
+    if root is None:
+        return page
+
+    seen = set()
+    for href in _GALLERY_LINKS(root):
+        match = GALLERY_HREF.search(href)
+        if match is None:
+            continue
+        gid = int(match.group(1))
+        # Extended and thumbnail modes link every gallery more than once
+        if gid not in seen:
+            seen.add(gid)
+            page.galleries.append([gid, match.group(2)])
+
+    for a in _CURSOR_LINKS(root):
+        href = a.get('href')
+        if not href:
+            continue
+        name = 'prev' if a.get('id').endswith('prev') else 'next'
+        if getattr(page, name) is None:
+            setattr(page, name, _cursor(href, name))
+
+    match = RESULT_COUNT.search(_SEARCH_TEXT(root))
+    if match is not None:
+        page.count = int(match.group(1).replace(',', ''))
+
+    return page
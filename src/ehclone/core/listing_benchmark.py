@@ -0,0 +1,53 @@
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+from tabulate import tabulate
+
+from ehclone.logger import logger
+from ehclone.core.listing import parse_listing
+
+
+def parse_listing_soup(content):
+    '''
+    The BeautifulSoup path parse_listing replaced, compact display mode only
+    '''
+
+    soup = BeautifulSoup(content, 'lxml')
+    gidlist = []
+    for a in soup.select('table.itg > tr > td.gl3c > a'):
+        gid, token = a['href'].strip('/').split('/')[-2:]
+        gidlist.append([int(gid), token])
+    return gidlist
+
+
+def bench_listing_parsers(html_dir, repeat=20):
+    '''
+    Time both parsers on saved listing pages, one file per page in any display mode,
+    and check that they find the same galleries where the soup path supports the mode
+    '''
+
+    paths = sorted(html_dir.glob('*.htm*'))
+    if not paths:
+        logger.error(f'No HTML files found in {html_dir}')
+        return
+    pages = [p.read_bytes() for p in paths]
+
+    rows = []
+    for path, content in zip(paths, pages):
+        page = parse_listing(content)
+        soup_gidlist = parse_listing_soup(content)
+        if soup_gidlist and soup_gidlist != page.galleries:
+            logger.warning(f'{path.name}: parsers disagree, {len(soup_gidlist)} vs {len(page.galleries)} galleries')
+        rows.append([path.name, len(page.galleries), len(soup_gidlist), page.prev, page.next, page.count])
+    print(tabulate(rows, headers=['page', 'galleries', 'soup galleries', 'prev', 'next', 'count']))
+    print()
+
+    timings = []
+    for name, parse in [('lxml xpath', parse_listing), ('beautifulsoup', parse_listing_soup)]:
+        start = perf_counter()
+        for _ in range(repeat):
+            for content in pages:
+                parse(content)
+        elapsed = (perf_counter() - start) / (repeat * len(pages))
+        timings.append([name, f'{elapsed * 1000:.3f}', f'{1 / elapsed:.0f}'])
+    print(tabulate(timings, headers=['parser', 'ms/page', 'pages/s']))
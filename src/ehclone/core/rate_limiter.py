@@ -0,0 +1,188 @@
+from time import sleep, monotonic
+from threading import Lock
+from collections import Counter, deque
+
+
+class TokenBucket:
+    '''
+    A thread-safe token bucket, tokens are reserved ahead so waiting happens outside the lock
+    :param rate: Tokens added per second
+    :param burst: Maximum number of tokens held
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self._lock = Lock()
+
+    def _refill(self, now):
+        # updated is in the future while paused
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def _wait(self, now, tokens):
+        wait = max(0, self.updated - now)
+        if tokens < 0:
+            wait += -tokens / self.rate
+        return wait
+
+    def peek(self):
+        '''
+        :return: seconds a reservation made now would have to wait
+        '''
+
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            return self._wait(now, self.tokens - 1)
+
+    def reserve(self):
+        '''
+        Take a token
+
+        :return: seconds to wait before the token may be used
+        '''
+
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            return self._wait(now, self.tokens)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(monotonic())
+            self.rate = rate
+
+    def pause(self, seconds):
+        '''
+        Hand out no tokens for the given seconds
+        '''
+
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self.updated = max(self.updated, now + seconds)
+            self.tokens = min(self.tokens, 1)
+
+
+class AdaptiveBucket(TokenBucket):
+    '''
+    A token bucket paced with AIMD: every success adds increase to the rate,
+    every overload multiplies it by decrease, bounded by [min_rate, max_rate].
+    '''
+
+    def __init__(self, max_rate, burst=1, min_rate=None, increase=0.01, decrease=0.5):
+        super().__init__(max_rate, burst)
+        self.max_rate = max_rate
+        self.min_rate = min_rate if min_rate is not None else max_rate / 64
+        self.increase = increase
+        self.decrease = decrease
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.set_rate(min(self.max_rate, self.rate + self.increase))
+
+    def on_overload(self, pause=None):
+        self.set_rate(max(self.min_rate, self.rate * self.decrease))
+        if pause:
+            self.pause(pause)
+
+
+class LimiterStats:
+    '''
+    Request counters by endpoint and response class, plus the achieved rate over a window
+    '''
+
+    def __init__(self, window=300):
+        self.window = window
+        self.counts = Counter()
+        self._times = deque()
+        self._lock = Lock()
+
+    def record(self, endpoint, kind):
+        now = monotonic()
+        with self._lock:
+            self.counts[(endpoint, kind)] += 1
+            self._times.append(now)
+            while self._times and self._times[0] < now - self.window:
+                self._times.popleft()
+
+    def rate(self):
+        '''
+        :return: requests per second over the last window
+        '''
+
+        now = monotonic()
+        with self._lock:
+            while self._times and self._times[0] < now - self.window:
+                self._times.popleft()
+            if len(self._times) < 2:
+                return 0.0
+            return len(self._times) / max(now - self._times[0], 1e-9)
+
+    def as_dict(self):
+        with self._lock:
+            counts = {f'{endpoint}:{kind}': n for (endpoint, kind), n in sorted(self.counts.items())}
+        return {'rate': round(self.rate(), 4), **counts}
+
+
+class RateLimiter:
+    '''
+    A global bucket shared by every request plus optional per-endpoint buckets
+    :param global_bucket: The bucket every request takes a token from
+    :param endpoint_buckets: dict of endpoint name to an extra bucket for that endpoint
+    '''
+
+    OK = 'ok'
+    OVERLOAD = 'overload'
+    BANNED = 'banned'
+    ERROR = 'error'
+
+    def __init__(self, global_bucket, endpoint_buckets=None):
+        self.global_bucket = global_bucket
+        self.endpoint_buckets = endpoint_buckets or {}
+        self.stats = LimiterStats()
+
+    def _buckets(self, endpoint):
+        buckets = [self.global_bucket]
+        if endpoint in self.endpoint_buckets:
+            buckets.append(self.endpoint_buckets[endpoint])
+        return buckets
+
+    def peek(self, endpoint=None):
+        return max(b.peek() for b in self._buckets(endpoint))
+
+    def reserve(self, endpoint=None):
+        return max(b.reserve() for b in self._buckets(endpoint))
+
+    def acquire(self, endpoint=None):
+        wait = self.reserve(endpoint)
+        if wait > 0:
+            sleep(wait)
+
+    def feedback(self, endpoint, kind, pause=None):
+        '''
+        Adjust pacing from the class of a response
+        :param kind: One of OK, OVERLOAD, BANNED, ERROR
+        :param pause: Seconds the server asked us to stay away
+        '''
+
+        self.stats.record(endpoint, kind)
+        for bucket in self._buckets(endpoint):
+            if kind == self.OK:
+                bucket.on_success()
+            elif kind in (self.OVERLOAD, self.BANNED):
+                bucket.on_overload(pause)
+
+    @property
+    def rate(self):
+        return self.global_bucket.rate
@@ -0,0 +1,89 @@
+from sqlalchemy import select, update, func
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.core.eh_session import ehs, EHSession
+from ehclone.db.entities import Gallery
+from ehclone.db.session import session_generator
+from ehclone.db.crud.gallery import insert_galleries, next_refresh_at, retry_interval
+
+
+def get_stale_galleries(limit):
+    '''
+    :return: list of [gid, token] of the galleries due for a refresh, most overdue first
+    '''
+
+    with session_generator() as session:
+        rows = session.execute(
+            select(Gallery.gid, Gallery.token)
+            .where(Gallery.next_refresh_at <= func.localtimestamp())
+            .order_by(Gallery.next_refresh_at)
+            .limit(limit)
+        )
+        return [[gid, token] for gid, token in rows]
+
+
+def mark_refreshed(gids, missing=()):
+    '''
+    Schedule the next refresh of requested galleries
+    :param gids: Galleries EH returned, due again after their refresh_interval
+    :param missing: Galleries EH did not return, due again after their retry_interval
+    '''
+
+    with session_generator() as session:
+        if gids:
+            session.execute(
+                update(Gallery)
+                .where(Gallery.gid.in_(gids))
+                .values(refreshed_at=func.now(), next_refresh_at=next_refresh_at(Gallery.posted_at))
+                .execution_options(synchronize_session=False)
+            )
+        if missing:
+            session.execute(
+                update(Gallery)
+                .where(Gallery.gid.in_(missing))
+                .values(refreshed_at=func.now(), next_refresh_at=func.localtimestamp() + retry_interval())
+                .execution_options(synchronize_session=False)
+            )
+
+
+def refresh_galleries(max_galleries=None):
+    '''
+    Fetch the metadata of stale galleries again, batch_size at a time in full gdata
+    calls, and write back what changed
+
+    :return: number of galleries refreshed
+    '''
+
+    refresh = config.eh.refresh
+    max_galleries = max_galleries or refresh.max_galleries
+    # Every gdata call carries a full GDATA_LIMIT galleries except for the very last one
+    batch_size = max(refresh.batch_size // EHSession.GDATA_LIMIT, 1) * EHSession.GDATA_LIMIT
+
+    refreshed = 0
+    while max_galleries is None or refreshed < max_galleries:
+        limit = batch_size if max_galleries is None else min(batch_size, max_galleries - refreshed)
+        gidlist = get_stale_galleries(limit)
+        if not gidlist:
+            break
+
+        gdata, unfetched = ehs.gdata_partial(gidlist)
+        if len(unfetched) == len(gidlist):
+            logger.error(f'Stopping refresh, gdata requests failed for all {len(gidlist)} galleries')
+            break
+        if gdata:
+            insert_galleries(gdata)
+        # Galleries EH did not return are gone, have a new token or are placeholders
+        # that never resolve, retry them less and less often. Galleries whose request
+        # failed are left due and picked up again.
+        returned = {int(g['gid']) for g in gdata}
+        mark_refreshed(
+            [gid for gid, _ in gidlist if gid in returned],
+            missing=[gid for gid, _ in gidlist if gid not in returned and gid not in unfetched],
+        )
+
+        refreshed += len(gidlist) - len(unfetched)
+        logger.info(f'Refreshed {len(gdata)} of {len(gidlist)} stale galleries, {refreshed} in this run')
+
+    logger.info(f'Refresh complete, {refreshed} galleries, request stats: {ehs.stats()}')
+    return refreshed
@@ -0,0 +1,28 @@
+from ehclone.logger import logger
+from ehclone.core.eh_session import ehs
+from ehclone.db.crud.gallery import insert_galleries, rebuild_chains
+
+
+def replay(batch_size=1000):
+    '''
+    Ingest every gdata entry of the response store again without touching the
+    network, chains are resolved once at the end instead of per batch
+
+    :return: number of galleries ingested
+    '''
+
+    if ehs.store is None:
+        logger.error('eh.response_store is not set, nothing to replay')
+        return 0
+
+    total = ehs.store.count()
+    logger.info(f'Replaying {total} galleries from {ehs.store.path}')
+
+    ingested = 0
+    for batch in ehs.store.iter_gdata(batch_size):
+        insert_galleries(batch, chains=False)
+        ingested += len(batch)
+        logger.info(f'Replayed {ingested}/{total} galleries')
+
+    rebuild_chains()
+    return ingested
@@ -0,0 +1,135 @@
+import json
+import time
+import zlib
+import sqlite3
+from pathlib import Path
+from threading import Lock
+
+
+class ResponseStore:
+    '''
+    Raw EH responses on disk, the latest gdata entry of every gallery and the
+    latest body of every listing query, zlib-compressed in a SQLite file.
+    Lets the index be rebuilt after a schema change or parsing fix without
+    sending a single request, see replay and eh.offline.
+
+    Recording is opt-in through eh.response_store. gdata holds one row per
+    gallery, but listing holds one row per distinct query and every backfill
+    cursor is a new query, so prune it with the prune-responses command.
+    '''
+
+    SQLITE_CHUNK = 500
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Written by the crawl and gdata threads of IndexPipeline
+        self._lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS gdata '
+                '(gid INTEGER PRIMARY KEY, token TEXT NOT NULL, fetched_at REAL NOT NULL, payload BLOB NOT NULL)'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS listing '
+                '(query TEXT PRIMARY KEY, fetched_at REAL NOT NULL, body BLOB NOT NULL)'
+            )
+
+    def put_gdata(self, gmetadata):
+        now = time.time()
+        rows = [
+            (int(d['gid']), d['token'], now, zlib.compress(json.dumps(d, ensure_ascii=False).encode('utf-8')))
+            for d in gmetadata
+        ]
+        with self._lock, self.db:
+            self.db.executemany(
+                'INSERT INTO gdata (gid, token, fetched_at, payload) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (gid) DO UPDATE SET token = excluded.token, '
+                'fetched_at = excluded.fetched_at, payload = excluded.payload',
+                rows,
+            )
+
+    def get_gdata(self, gidlist):
+        '''
+        :param gidlist: list of [gid, token]
+
+        :return: list of stored gdata entries whose token matches
+        '''
+
+        tokens = {int(gid): token for gid, token in gidlist}
+        gids = list(tokens)
+        results = []
+        with self._lock:
+            for i in range(0, len(gids), self.SQLITE_CHUNK):
+                chunk = gids[i:i + self.SQLITE_CHUNK]
+                rows = self.db.execute(
+                    f'SELECT gid, token, payload FROM gdata WHERE gid IN ({", ".join("?" * len(chunk))})',
+                    chunk,
+                ).fetchall()
+                for gid, token, payload in rows:
+                    if tokens[gid] == token:
+                        results.append(json.loads(zlib.decompress(payload)))
+        return results
+
+    def iter_gdata(self, batch_size=1000):
+        '''
+        Every stored gdata entry in gid order, in lists of up to batch_size
+        '''
+
+        after = -1
+        while True:
+            with self._lock:
+                rows = self.db.execute(
+                    'SELECT gid, payload FROM gdata WHERE gid > ? ORDER BY gid LIMIT ?',
+                    (after, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            after = rows[-1][0]
+            yield [json.loads(zlib.decompress(payload)) for _, payload in rows]
+
+    def put_listing(self, query, body):
+        with self._lock, self.db:
+            self.db.execute(
+                'INSERT INTO listing (query, fetched_at, body) VALUES (?, ?, ?) '
+                'ON CONFLICT (query) DO UPDATE SET fetched_at = excluded.fetched_at, body = excluded.body',
+                (query, time.time(), zlib.compress(body)),
+            )
+
+    def get_listing(self, query):
+        '''
+        :return: the stored body of a listing query, None if it was never fetched
+        '''
+
+        with self._lock:
+            row = self.db.execute('SELECT body FROM listing WHERE query = ?', (query,)).fetchone()
+        return None if row is None else zlib.decompress(row[0])
+
+    def prune(self, listing_age=None, gdata_age=None):
+        '''
+        Delete responses fetched longer ago than the given ages and give the space back
+        :param listing_age: Seconds to keep listing bodies, None keeps them all
+        :param gdata_age: Seconds to keep gdata entries, None keeps them all
+
+        :return: (listing rows deleted, gdata rows deleted)
+        '''
+
+        now = time.time()
+        deleted = []
+        with self._lock:
+            with self.db:
+                for table, age in (('listing', listing_age), ('gdata', gdata_age)):
+                    if age is None:
+                        deleted.append(0)
+                        continue
+                    cursor = self.db.execute(f'DELETE FROM {table} WHERE fetched_at < ?', (now - age,))
+                    deleted.append(cursor.rowcount)
+            self.db.execute('VACUUM')
+        return tuple(deleted)
+
+    def count(self):
+        with self._lock:
+            return self.db.execute('SELECT count(*) FROM gdata').fetchone()[0]
@@ -1,25 +1,36 @@
 #!/usr/bin/env python3
 
+from queue import Queue, Full
+from threading import Thread, Event
 from urllib.parse import urlencode
-from bs4 import BeautifulSoup
 
 from ehclone.config import config
 from ehclone.logger import logger
 from ehclone.core.eh_session import ehs
+from ehclone.core.listing import parse_listing
 from ehclone.db.crud.gallery import insert_galleries, get_last_gid
+from ehclone.db.crud.crawl_state import get_cursor
 
 
-def sync_page(prev, expunged=False):
+_DONE = object()
+
+
+def fetch_page(prev, expunged=False, next=None):
     '''
-    Get a page of galleries from EH
-    :param prev: The last gallery ID from the previous page
+    Get a page of gallery IDs from EH
+    :param prev: The last gallery ID from the previous page, the page holds the galleries
+                 right above it. None for the newest page.
     :param expunged: Whether to search for expunged galleries
+    :param next: Walk downwards instead, the page holds the galleries right below next
 
-    :return: last gallery ID, -1 if no galleries found
+    :return: ListingPage, None on error
     '''
 
     _args = config.eh.get_search_args()
-    _args['prev'] = prev
+    if next is not None:
+        _args['next'] = next
+    elif prev is not None:
+        _args['prev'] = prev
 
     if expunged:
         _args['f_sh'] = 'on'
@@ -29,53 +40,159 @@ def sync_page(prev, expunged=False):
     _query = urlencode(_args)
 
     try:
-        res = ehs.get('/?' + _query)
-        soup = BeautifulSoup(res.text, 'lxml')
-        galleries_a = soup.select('table.itg > tr > td.gl3c > a')
+        body = ehs.listing(_query)
+        if body is None:
+            logger.info(f'Listing page {_query} is not in the response store')
+            return None
+        page = parse_listing(body)
     except Exception as e:
         logger.error(f'Error fetching galleries: {e}')
-        return -1
-
-    gidlist = []
-    for a in galleries_a:
-        href = a['href'].strip('/')
-        gid, token = href.split('/')[-2:]
-        gidlist.append([int(gid), token])
-    logger.debug(f'Found {len(gidlist)} galleries: {list(map(lambda x: f"{x[0]}/{x[1]}", gidlist))}')
+        return None
 
-    if not gidlist:
-        return -1
+    if page.galleries:
+        logger.debug(f'Found {len(page.galleries)} galleries from {page.galleries[-1][0]} to {page.galleries[0][0]}')
+    else:
+        logger.debug('Found no galleries')
 
-    _gdata = ehs.gdata(gidlist)
-    logger.debug(f'Retrieved metadata for {len(_gdata)} galleries: {list(map(lambda x: f"{x["gid"]}/{x["token"]}", _gdata))}')
+    return page
 
-    insert_galleries(_gdata)
 
-    return gidlist[0][0]
+class IndexPipeline:
+    '''
+    Crawl listing pages with the listing fetch, gdata and DB write stages overlapped.
+
+    Listing fetches and gdata calls share the rate limit of ehs, so the next
+    listing page is requested while gdata and the DB write of the previous
+    one are in flight. Queues between the stages are bounded by
+    config.eh.pipeline_depth. Pages are written strictly in order and the
+    pipeline stops at the first failing page, so everything before it is
+    committed and nothing after it is. With a checkpoint, the cursor is
+    saved to crawl_state in the transaction of every page.
+    '''
 
+    def __init__(self, prev, expunged=False, checkpoint=None):
+        '''
+        :param checkpoint: Optional (search_hash, name) of the crawl_state row to keep up to date
+        '''
+
+        self.prev = prev
+        self.expunged = expunged
+        self.checkpoint = checkpoint
+        self.last_gid = prev
+        self.error = None
+
+        self.stop = Event()
+        self.gdata_queue = Queue(maxsize=config.eh.pipeline_depth)
+        self.db_queue = Queue(maxsize=config.eh.pipeline_depth)
+        self.gdata_thread = Thread(target=self._gdata_stage, name='sync-gdata', daemon=True)
+        self.db_thread = Thread(target=self._db_stage, name='sync-db', daemon=True)
+
+    @staticmethod
+    def _put(queue, item, consumer):
+        # Give up once the consumer is gone instead of blocking on a full queue
+        while consumer.is_alive():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _crawl_stage(self):
+        prev = self.prev
+        try:
+            while not self.stop.is_set():
+                logger.info(f'Syncing {"expunged " if self.expunged else ""}page with prev={prev}')
+                page = fetch_page(prev, expunged=self.expunged)
+                if page is None or not page.galleries:
+                    break
+                if not self._put(self.gdata_queue, (page.galleries[0][0], page.galleries), self.gdata_thread):
+                    break
+                prev = page.galleries[0][0]
+        finally:
+            self._put(self.gdata_queue, _DONE, self.gdata_thread)
+
+    def _gdata_stage(self):
+        try:
+            while not self.stop.is_set():
+                item = self.gdata_queue.get()
+                if item is _DONE:
+                    break
+                cursor, gidlist = item
+
+                _gdata = ehs.gdata(gidlist)
+                if not _gdata:
+                    logger.error(f'Stopping sync, no metadata for page ending at {gidlist[0][0]}')
+                    self.stop.set()
+                    break
+                logger.debug(f'Retrieved metadata for {len(_gdata)} galleries: {list(map(lambda x: f"{x["gid"]}/{x["token"]}", _gdata))}')
+
+                if not self._put(self.db_queue, (cursor, _gdata), self.db_thread):
+                    break
+        except Exception as e:
+            logger.exception(e)
+            self.stop.set()
+        finally:
+            self._put(self.db_queue, _DONE, self.db_thread)
+
+    def _db_stage(self):
+        try:
+            while True:
+                item = self.db_queue.get()
+                if item is _DONE:
+                    break
+
+                cursor, _gdata = item
+                checkpoint = None if self.checkpoint is None else (*self.checkpoint, cursor)
+                insert_galleries(_gdata, checkpoint=checkpoint)
+                self.last_gid = cursor
+        except Exception as e:
+            self.error = e
+            self.stop.set()
+
+    def run(self):
+        '''
+        :return: the cursor of the last page written
+        '''
+
+        self.gdata_thread.start()
+        self.db_thread.start()
+        try:
+            self._crawl_stage()
+        finally:
+            self.gdata_thread.join()
+            self.db_thread.join()
+
+        if self.error is not None:
+            raise self.error
+        return self.last_gid
+
+
+def sync_pass(expunged=False):
+    '''
+    Crawl one pass from its saved cursor, or from the newest gallery in the database
+    if the current search has never been crawled
 
-def sync_index():
-    last_gid = get_last_gid(expunged=False, categories=config.eh.categories)
-    logger.info(f'Starting sync from {last_gid}')
+    :return: the last gallery ID written
+    '''
 
-    while True:
-        logger.info(f'Syncing page with prev={last_gid}')
-        new_gid = sync_page(last_gid, expunged=False)
-        if new_gid == -1:
-            logger.info('Sync complete, no more galleries found.')
-            break
+    name = 'expunged' if expunged else 'index'
+    search_hash = config.eh.get_search_hash()
 
-        last_gid = new_gid
+    last_gid = get_cursor(search_hash, name)
+    if last_gid is None:
+        last_gid = get_last_gid(expunged=expunged, categories=config.eh.categories)
+        logger.info(f'Starting {name} sync from {last_gid}')
+    else:
+        logger.info(f'Resuming {name} sync from {last_gid}')
 
-    if config.eh.include_expunged:
-        last_gid = get_last_gid(expunged=True, categories=config.eh.categories)
-        logger.info(f'Starting expunged sync from {last_gid}')
+    last_gid = IndexPipeline(last_gid, expunged=expunged, checkpoint=(search_hash, name)).run()
+    logger.info(f'{name.capitalize()} sync complete at {last_gid}, no more galleries found.')
+    logger.info(f'Request stats: {ehs.stats()}')
+    return last_gid
 
-        while True:
-            logger.info(f'Syncing expunged page with prev={last_gid}')
-            new_gid = sync_page(last_gid, expunged=True)
-            if new_gid == -1:
-                logger.info('Expunged sync complete, no more galleries found.')
-                break
 
-            last_gid = new_gid
+def sync_index():
+    sync_pass(expunged=False)
+    if config.eh.include_expunged:
+        sync_pass(expunged=True)
@@ -1,76 +1,254 @@
-import shutil
-from pathlib import Path
-from urllib.parse import urlparse
+from queue import Queue, Empty
+from threading import Thread, Lock
+
+import numpy as np
 
 from ehclone.config import config
 from ehclone.logger import logger
 from ehclone.downloader.aria2_client import aria2
-from ehclone.db.crud.thumb import get_unvectorized_thumbs, update_thumb_vector
-from ehclone.vectorizer.mobile_net_v3 import vectorizer
+from ehclone.db.crud.thumb import claim_unvectorized_thumbs, get_thumb_vectors, update_thumb_vectors
+from ehclone.core.thumb_store import ThumbStore, out_subpath
+from ehclone.vectorizer.backend import vectorizer
 
 
-def sync_thumbs():
-    while True:
-        thumb_urls = get_unvectorized_thumbs(limit=config.aria2.task_limit * 2)
+_DONE = object()
 
-        if not thumb_urls:
-            logger.info('All thumbs processed.')
-            break
-        logger.info(f'Downloading {len(thumb_urls)} thumbs')
 
-        tasks = {}
-        for url in thumb_urls:
-            parsed = urlparse(url)
-            out_subpath = Path('thumb') / 'incomplete' / parsed.path.lstrip('/')
+def delete_thumb(local_path):
+    try:
+        local_path.unlink()
+        logger.debug(f'Deleted processed thumb: {local_path}')
+    except Exception as e:
+        logger.warning(f'Failed to delete {local_path}: {e}')
 
-            task_id = aria2.add_task(url=url, out=out_subpath, prioritize=True)
-            if task_id:
-                tasks[task_id] = (url, out_subpath)
-            else:
-                logger.error(f'Failed to add aria2 task for {url}')
 
-        logger.info(f'Waiting for {len(tasks)} downloads to complete...')
-        results, remaining = aria2.wait_for_tasks(list(tasks.keys()))
+def process_thumbs(items, store=None):
+    '''
+    Vectorize thumbs in one batch and save the vectors. With a store, downloads are moved
+    into it first, byte-identical thumbs are vectorized once and thumbs whose content
+    already has a vector under another url reuse it. Without one, downloads are deleted.
+    :param items: list of (url, local_path), a finished download or a stored thumb
+    :param store: ThumbStore or None
+
+    :return: list of bools aligned with items, True if the vector was saved
+    '''
 
-        if remaining:
-            logger.warning(f'{len(remaining)} tasks did not complete')
+    success = [False] * len(items)
 
-        success_count = 0
-        for task_id, (url, out_subpath) in tasks.items():
-            result = results.get(task_id, {})
-            status = result.get('result', {}).get('status')
-            if status != 'complete':
-                logger.error(f'Download failed for {url}: {result}')
+    paths = {}
+    for i, (url, local_path) in enumerate(items):
+        if not local_path.exists():
+            logger.error(f'File not found after download: {local_path}')
+            continue
+        if store is not None:
+            try:
+                local_path = store.add(url, local_path)
+            except Exception as e:
+                logger.error(f'Failed to store {local_path}: {e}')
                 continue
+        paths[i] = local_path
+
+    if not paths:
+        return success
+
+    # Stored paths are content addresses, identical thumbs share one
+    unique = list(dict.fromkeys(paths.values()))
+    results = {}
+    if store is not None:
+        urls_by_digest = store.urls_for(store.digest(p) for p in unique)
+        known = get_thumb_vectors(url for urls in urls_by_digest.values() for url in urls)
+        for local_path in unique:
+            for url in urls_by_digest.get(store.digest(local_path), []):
+                if url in known:
+                    results[local_path] = known[url]
+                    break
+
+    pending = [p for p in unique if p not in results]
+    if pending:
+        vectors, dhashes = vectorizer.encode_batch_with_hashes(pending)
+        for local_path, vector, dhash in zip(pending, vectors, dhashes):
+            if not np.isnan(vector).any():
+                results[local_path] = (vector, dhash)
+    logger.debug(f'Vectorized {len(pending)} thumbs for {len(paths)} urls')
+
+    written = []
+    pairs = []
+    hashes = {}
+    for i, local_path in paths.items():
+        if local_path in results:
+            url = items[i][0]
+            vector, dhash = results[local_path]
+            written.append(i)
+            pairs.append((url, vector))
+            hashes[url] = dhash
+
+    failures = update_thumb_vectors(pairs, hashes)
+    for url, reason in failures.items():
+        logger.error(f'Failed to save vector for {url}: {reason}')
+    for i in written:
+        success[i] = items[i][0] not in failures
+
+    if store is None:
+        for local_path in unique:
+            delete_thumb(local_path)
+
+    return success
+
+
+class ThumbPipeline:
+    '''
+    Keep about task_limit thumbs downloading, hand every finished download
+    straight to the vectorizer thread and refill the slot right away, so
+    aria2 and the CNN are both kept busy. Thumbs already in the thumb store
+    skip aria2 and go to the vectorizer thread directly.
+    '''
+
+    def __init__(self):
+        self.task_limit = config.aria2.task_limit
+        thumb_dir = config.filter.dedupe.thumb_dir
+        self.store = ThumbStore(thumb_dir) if thumb_dir is not None else None
+        self.reused = 0
+        self.in_flight = {}
+        # Keyset cursor of the work queue, see claim_unvectorized_thumbs
+        self.cursor = None
+        # Failed thumbs keep their lease and are retried once it expires
+        self.failed = 0
+        self.vectorized = 0
+        # Counters are shared with the vectorizer thread
+        self._lock = Lock()
+
+        self.stream = aria2.completion_stream()
+        self.vectorize_queue = Queue(maxsize=self.task_limit)
+        self.vectorize_thread = Thread(target=self._vectorize_stage, name='thumb-vectorize', daemon=True)
+
+    def _next_batch(self):
+        '''
+        Block for one finished download, then take whatever else is ready up to a model batch
+        '''
+
+        items = [self.vectorize_queue.get()]
+        while items[-1] is not _DONE and len(items) < vectorizer.batch_size:
+            try:
+                items.append(self.vectorize_queue.get_nowait())
+            except Empty:
+                break
+        return items
+
+    def _vectorize_stage(self):
+        done = False
+        while not done:
+            items = self._next_batch()
+            if items[-1] is _DONE:
+                items.pop()
+                done = True
+            if not items:
+                continue
+
+            try:
+                success = process_thumbs(items, self.store)
+            except Exception as e:
+                logger.exception(e)
+                success = [False] * len(items)
+
+            with self._lock:
+                self.vectorized += sum(success)
+                self.failed += len(success) - sum(success)
+            logger.debug(f'{self.vectorized} vectors computed')
+
+    def _fail(self):
+        with self._lock:
+            self.failed += 1
+
+    def _claim(self, limit):
+        claimed = claim_unvectorized_thumbs(limit, after=self.cursor)
+        if len(claimed) < limit and self.cursor is not None:
+            # Wrap around for thumbs whose lease expired behind the cursor
+            self.cursor = None
+            claimed += claim_unvectorized_thumbs(limit - len(claimed))
+        if claimed:
+            self.cursor = claimed[-1]
+        return [url for _, url in claimed]
+
+    def _find_stored(self, urls):
+        '''
+        :return: dict of url to the stored file for thumbs that need no download
+        '''
+
+        if self.store is None:
+            return {}
+        stored = self.store.lookup_many(urls)
+        for url in urls:
+            # Thumbs kept at thumb_dir / out_subpath before the store existed
+            legacy_path = self.store.root / out_subpath(url)
+            if url not in stored and legacy_path.exists():
+                try:
+                    stored[url] = self.store.add(url, legacy_path)
+                except Exception as e:
+                    logger.warning(f'Failed to store {legacy_path}: {e}')
+        self.reused += len(stored)
+        return stored
+
+    def _refill(self):
+        '''
+        :return: False once there are no more thumbs to queue
+        '''
+
+        free = self.task_limit - len(self.in_flight)
+        if free <= 0:
+            return True
+
+        thumb_urls = self._claim(free)
+        if not thumb_urls:
+            return False
 
-            local_path = config.aria2.local_dir / out_subpath
-
-            if local_path.exists():
-                vector = vectorizer.encode(local_path)
-                if vector:
-                    update_thumb_vector(url, vector)
-                    success_count += 1
-
-                thumb_dir = config.filter.dedupe.thumb_dir
-
-                # Cleanup
-                if thumb_dir is None:
-                    try:
-                        local_path.unlink()
-                        logger.debug(f'Deleted processed thumb: {local_path}')
-                    except Exception as e:
-                        logger.warning(f'Failed to delete {local_path}: {e}')
-
-                else:
-                    target_path = thumb_dir / out_subpath
-                    try:
-                        target_path.parent.mkdir(parents=True, exist_ok=True)
-                        shutil.move(str(local_path), str(target_path))
-                        logger.debug(f'Moved thumb to {target_path}')
-                    except Exception as e:
-                        logger.warning(f'Failed to move {local_path} to {target_path}: {e}')
+        stored = self._find_stored(thumb_urls)
+        for url, local_path in stored.items():
+            self.vectorize_queue.put((url, local_path))
 
+        downloads = [(url, out_subpath(url)) for url in thumb_urls if url not in stored]
+        task_ids = aria2.add_tasks(downloads, prioritize=True) if downloads else []
+        for (url, subpath), task_id in zip(downloads, task_ids):
+            if task_id:
+                self.in_flight[task_id] = (url, config.aria2.local_dir / subpath)
             else:
-                logger.error(f'File not found after download: {local_path}')
+                logger.error(f'Failed to add aria2 task for {url}')
+                self._fail()
+        self.stream.add(t for t in task_ids if t)
+
+        return len(thumb_urls) == free
+
+    def run(self):
+        self.vectorize_thread.start()
+        try:
+            has_more = True
+            while True:
+                if has_more:
+                    has_more = self._refill()
+                if not self.in_flight:
+                    if has_more:
+                        # Every claimed thumb was already stored
+                        continue
+                    break
+
+                for task_id, result in self.stream.next_batch().items():
+                    url, local_path = self.in_flight.pop(task_id)
+                    status = result.get('result', {}).get('status')
+                    if status != 'complete':
+                        logger.error(f'Download failed for {url}: {result}')
+                        self._fail()
+                        continue
+                    self.vectorize_queue.put((url, local_path))
+        finally:
+            self.stream.close()
+            self.vectorize_queue.put(_DONE)
+            self.vectorize_thread.join()
+
+        logger.info(
+            f'{self.vectorized} vectors computed, {self.reused} thumbs found in the store, '
+            f'{self.failed} thumbs failed'
+        )
+
 
-        logger.info(f'{success_count}/{len(tasks)} vectors computed')
+def sync_thumbs():
+    ThumbPipeline().run()
+    logger.info('All thumbs processed.')
@@ -0,0 +1,125 @@
+import shutil
+import sqlite3
+import hashlib
+from pathlib import Path
+from threading import Lock
+from urllib.parse import urlparse
+
+from ehclone.logger import logger
+
+
+def out_subpath(url):
+    '''
+    Download target of a thumb relative to the aria2 dir, and where thumbs were kept before the store
+    '''
+
+    return Path('thumb') / 'incomplete' / urlparse(url).path.lstrip('/')
+
+
+class ThumbStore:
+    '''
+    Thumbnails stored once per content as root/ab/cd/<sha256><suffix>. The url to sha256
+    index is a SQLite file in root, so it survives rebuilding the database and
+    recomputing the vectors.
+    '''
+
+    SQLITE_CHUNK = 500
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Used by the crawl and the vectorizer thread of ThumbPipeline
+        self._lock = Lock()
+        self.db = sqlite3.connect(self.root / 'index.sqlite3', check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS thumb (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL, suffix TEXT NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS ix_thumb_sha256 ON thumb (sha256)')
+
+    def path_for(self, sha256, suffix):
+        return self.root / sha256[:2] / sha256[2:4] / f'{sha256}{suffix}'
+
+    @staticmethod
+    def digest(path):
+        '''
+        :return: the sha256 of a stored thumb, which is its file name
+        '''
+
+        return Path(path).stem
+
+    def _query(self, sql, keys):
+        rows = []
+        with self._lock:
+            for i in range(0, len(keys), self.SQLITE_CHUNK):
+                chunk = keys[i:i + self.SQLITE_CHUNK]
+                rows.extend(self.db.execute(sql.format(', '.join('?' * len(chunk))), chunk).fetchall())
+        return rows
+
+    def lookup_many(self, urls):
+        '''
+        :return: dict of url to the stored file, for urls indexed with their file still on disk
+        '''
+
+        rows = self._query('SELECT url, sha256, suffix FROM thumb WHERE url IN ({})', list(urls))
+        found = {}
+        for url, sha256, suffix in rows:
+            path = self.path_for(sha256, suffix)
+            if path.exists():
+                found[url] = path
+        return found
+
+    def urls_for(self, digests):
+        '''
+        :return: dict of sha256 to every url indexed with that content
+        '''
+
+        urls = {}
+        for url, sha256 in self._query('SELECT url, sha256 FROM thumb WHERE sha256 IN ({})', list(digests)):
+            urls.setdefault(sha256, []).append(url)
+        return urls
+
+    def add(self, url, path):
+        '''
+        Move a file into the store and index url to it. Content already stored is
+        kept and the new copy deleted, a file already in the store is only indexed.
+
+        :return: the stored path
+        '''
+
+        path = Path(path)
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha256.update(block)
+        sha256 = sha256.hexdigest()
+
+        target = self.path_for(sha256, path.suffix)
+        if path != target:
+            if target.exists():
+                path.unlink()
+                logger.debug(f'{url} is identical to the stored {target}')
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(path), str(target))
+
+        with self._lock, self.db:
+            self.db.execute(
+                'INSERT INTO thumb (url, sha256, suffix) VALUES (?, ?, ?) '
+                'ON CONFLICT (url) DO UPDATE SET sha256 = excluded.sha256, suffix = excluded.suffix',
+                (url, sha256, path.suffix),
+            )
+        return target
+
+    def find_many(self, urls):
+        '''
+        lookup_many that also finds thumbs still at out_subpath in root, without moving them
+
+        :return: dict of url to the file
+        '''
+
+        found = self.lookup_many(urls)
+        for url in urls:
+            legacy_path = self.root / out_subpath(url)
+            if url not in found and legacy_path.exists():
+                found[url] = legacy_path
+        return found
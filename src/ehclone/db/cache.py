@@ -0,0 +1,52 @@
+from threading import Lock
+from collections import OrderedDict
+
+from ehclone.config import config
+
+
+class LRUCache:
+    '''
+    A bounded, thread-safe mapping that evicts the least recently used keys.
+    Only committed rows should be put in here, see insert_galleries.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.warmed = False
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def get_many(self, keys):
+        hits = {}
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    hits[key] = self._data[key]
+        return hits
+
+    def update(self, mapping):
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = value
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.warmed = False
+
+
+# (namespace, name) -> tag.id
+tag_cache = LRUCache(config.db.tag_cache_size)
+# thumb.url -> thumb.first_gid, for thumbs known to exist
+thumb_cache = LRUCache(config.db.thumb_cache_size)
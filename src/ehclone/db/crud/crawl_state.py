@@ -0,0 +1,49 @@
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ehclone.db.entities import CrawlState
+from ehclone.db.session import session_generator
+
+
+def get_cursor(search_hash, name):
+    '''
+    :return: the saved cursor of a crawl pass, None if it never ran
+    '''
+
+    with session_generator() as session:
+        return session.execute(
+            select(CrawlState.cursor)
+            .where(CrawlState.search_hash == search_hash)
+            .where(CrawlState.name == name)
+        ).scalar()
+
+
+def save_cursor(session, search_hash, name, cursor):
+    '''
+    Save a crawl cursor in the caller's transaction, so that it commits with the page it follows
+    '''
+
+    stmt = pg_insert(CrawlState).values(search_hash=search_hash, name=name, cursor=cursor)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[CrawlState.search_hash, CrawlState.name],
+        set_={'cursor': stmt.excluded.cursor, 'updated_at': func.now()},
+    ))
+
+
+def set_cursor(search_hash, name, cursor):
+    with session_generator() as session:
+        save_cursor(session, search_hash, name, cursor)
+
+
+def get_cursors(search_hash, prefix):
+    '''
+    :return: dict of name to cursor for the passes named prefix:...
+    '''
+
+    with session_generator() as session:
+        rows = session.execute(
+            select(CrawlState.name, CrawlState.cursor)
+            .where(CrawlState.search_hash == search_hash)
+            .where(CrawlState.name.startswith(f'{prefix}:', autoescape=True))
+        )
+        return {name: cursor for name, cursor in rows}
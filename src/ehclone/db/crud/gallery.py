@@ -1,13 +1,103 @@
+import json
+from hashlib import blake2b
 from datetime import datetime, timezone
 
-from sqlalchemy import func
+from sqlalchemy import func, select, update, delete, insert, tuple_, or_, extract
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
+from ehclone.config import config
 from ehclone.logger import logger
-from ehclone.db.entities import Gallery, Tag, Torrent, Category, Thumb
+from ehclone.db.cache import tag_cache, thumb_cache
+from ehclone.db.entities import Gallery, Tag, Torrent, Category, Thumb, gallery_tag
 from ehclone.db.session import session_generator
+from ehclone.db.crud.crawl_state import save_cursor
 
 
-def insert_gallery(session, gdata, thumb_cache, tag_cache):
+BULK_BATCH_SIZE = 500
+
+GALLERY_UPSERT_COLUMNS = (
+    'token',
+    'title',
+    'title_jpn',
+    'category',
+    'thumb_url',
+    'uploader',
+    'posted_at',
+    'filecount',
+    'filesize',
+    'expunged',
+    'rating',
+    'first_gid',
+)
+
+
+def _seconds(seconds):
+    return func.make_interval(0, 0, 0, 0, 0, 0, seconds)
+
+
+def refresh_interval(posted_at):
+    '''
+    Time until a gallery is due for a refresh again. The interval grows with the age of
+    the gallery, age_factor of it, clamped to min_interval and max_interval, so recent
+    uploads are refreshed often and old ones rarely.
+    :param posted_at: Column or value, NULL counts as just posted
+
+    :return: SQL interval expression
+    '''
+
+    refresh = config.eh.refresh
+    now = func.localtimestamp()
+    age = extract('epoch', now - func.coalesce(posted_at, now))
+    return _seconds(func.greatest(refresh.min_interval, func.least(refresh.max_interval, age * refresh.age_factor)))
+
+
+def retry_interval():
+    '''
+    Time until a gallery EH did not return is requested again, twice the previous
+    interval clamped to min_interval and max_interval, so placeholders and removed
+    galleries that never resolve back off instead of taking a slot in every batch
+
+    :return: SQL interval expression
+    '''
+
+    refresh = config.eh.refresh
+    previous = extract('epoch', Gallery.next_refresh_at - Gallery.refreshed_at)
+    return _seconds(func.greatest(
+        refresh.min_interval,
+        func.least(refresh.max_interval, 2 * func.coalesce(previous, 0)),
+    ))
+
+
+def next_refresh_at(posted_at):
+    return func.localtimestamp() + refresh_interval(posted_at)
+
+
+def gallery_fingerprint(gallery, tags, torrents):
+    '''
+    64-bit hash of a normalized gallery with its tags and torrents, stored in
+    gallery.fingerprint so that unchanged galleries are not written again
+    '''
+
+    payload = json.dumps(
+        [
+            [gallery[c] for c in GALLERY_UPSERT_COLUMNS],
+            sorted(tags),
+            sorted([t['infohash'], t['added_at'], t['name'], t['tsize'], t['fsize']] for t in torrents),
+        ],
+        default=str,
+        ensure_ascii=False,
+    )
+    return int.from_bytes(blake2b(payload.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def parse_gdata(gdata):
+    '''
+    Normalize a gdata dict into plain rows
+    :param gdata: A single entry of the gdata API response
+
+    :return: (gallery row, (first_gid, first_token) or None, tag keys, torrent rows)
+    '''
+
     try:
         gid = int(gdata['gid'])
         posted_ts = int(gdata['posted'])
@@ -21,43 +111,48 @@ def insert_gallery(session, gdata, thumb_cache, tag_cache):
         rating = gdata.get('rating', 0)
         rating = round(float(rating) * 20)
 
+        first = None
         first_gid = gdata.get('first_gid')
         if first_gid:
             first_gid = int(first_gid)
-            first_token = gdata['first_key']
-
-        gallery = Gallery(
-            gid = gid,
-            token = gdata['token'],
-            title = gdata['title'],
-            title_jpn = gdata.get('title_jpn'),
-            category = category,
-            thumb_url = gdata.get('thumb'),
-            uploader = uploader,
-            posted_at = posted_dt,
-            filecount = int(gdata['filecount']),
-            filesize = int(gdata['filesize']),
-            expunged = gdata.get('expunged'),
-            rating = rating,
-            first_gid = first_gid,
-        )
+            first = (first_gid, gdata['first_key'])
+        else:
+            first_gid = None
+
+        gallery = {
+            'gid': gid,
+            'token': gdata['token'],
+            'title': gdata['title'],
+            'title_jpn': gdata.get('title_jpn'),
+            'category': category,
+            'thumb_url': gdata.get('thumb'),
+            'uploader': uploader,
+            'posted_at': posted_dt,
+            'filecount': int(gdata['filecount']),
+            'filesize': int(gdata['filesize']),
+            'expunged': gdata.get('expunged'),
+            'rating': rating,
+            'first_gid': first_gid,
+        }
 
         tags = []
         for tag_str in gdata.get('tags', []):
-            tags.append(Tag.from_str(tag_str))
+            tags.append(Tag.split_str(tag_str))
 
         torrents = []
         for t_data in gdata.get('torrents', []):
             added_ts = int(t_data['added'])
             added_dt = datetime.fromtimestamp(added_ts, tz=timezone.utc)
-            torrents.append(Torrent(
-                gid = gid,
-                infohash = t_data['hash'],
-                added_at = added_dt,
-                name = t_data.get('name'),
-                tsize = int(t_data['tsize']),
-                fsize = int(t_data['fsize']),
-            ))
+            torrents.append({
+                'gid': gid,
+                'infohash': t_data['hash'],
+                'added_at': added_dt,
+                'name': t_data.get('name'),
+                'tsize': int(t_data['tsize']),
+                'fsize': int(t_data['fsize']),
+            })
+
+        gallery['fingerprint'] = gallery_fingerprint(gallery, tags, torrents)
 
     except ValueError as e:
         logger.error('Failed to process gallery data')
@@ -65,59 +160,288 @@ def insert_gallery(session, gdata, thumb_cache, tag_cache):
         logger.exception(e)
         raise
 
-    thumb = None
-    if gallery.thumb_url:
-        if gallery.thumb_url in thumb_cache:
-            thumb = thumb_cache[gallery.thumb_url]
-        else:
-            thumb = session.get(Thumb, gallery.thumb_url)
-            if not thumb:
-                thumb = Thumb(url=gallery.thumb_url)
-                session.add(thumb)
-            thumb_cache[gallery.thumb_url] = thumb
-
-    gallery_tags = []
-    for _tag in tags:
-        key = (_tag.namespace, _tag.name)
-        if key in tag_cache:
-            tag = tag_cache[key]
-        else:
-            tag = session.query(Tag).filter_by(namespace=_tag.namespace, name=_tag.name).first()
-            if not tag:
-                tag = _tag
-                session.add(tag)
-            tag_cache[key] = tag
-        gallery_tags.append(tag)
-
-    if first_gid:
-        first_gallery = session.get(Gallery, first_gid)
-        if first_gallery is None:
-            first_gallery = Gallery(gid=first_gid, token=first_token)
-            first_gallery.first_gid = first_gid
-            session.add(first_gallery)
-
-    gallery = session.merge(gallery)
-
-    if first_gid:
-        chain = (session
-                 .query(Gallery)
-                 .filter_by(first_gid=first_gid)
-                 .order_by(Gallery.gid)).all()
-        chain_end = max(chain[-1].gid, gid)
-        for g in chain:
-            if g.gid < chain_end:
-                g.dupe_with = chain_end
-
-    gallery.tags = gallery_tags
-    gallery.torrents = torrents
-
-
-def insert_galleries(gdata_list):
+    return gallery, first, tags, torrents
+
+
+def warm_tag_cache(session):
+    '''
+    Preload the most used tags into the process-wide tag cache, once per process
+    '''
+
+    if tag_cache.warmed:
+        return
+
+    limit = min(config.db.tag_cache_preload, config.db.tag_cache_size)
+    if limit > 0:
+        rows = session.execute(
+            select(Tag.id, Tag.namespace, Tag.name)
+            .join(gallery_tag, gallery_tag.c.tag_id == Tag.id)
+            .group_by(Tag.id)
+            .order_by(func.count().desc())
+            .limit(limit)
+        ).all()
+        # Least used first so that the hottest tags are the last to be evicted
+        tag_cache.update({(ns, name): tag_id for tag_id, ns, name in reversed(rows)})
+        logger.info(f'Preloaded {len(rows)} tags')
+
+    tag_cache.warmed = True
+
+
+def upsert_tags(session, keys, pending=None):
+    '''
+    Make sure every (namespace, name) pair exists in the tag table
+    :param keys: Iterable of (namespace, name) tuples
+    :param pending: Tags resolved in the current transaction, updated in place
+
+    :return: dict mapping (namespace, name) to tag.id
+    '''
+
+    keys = set(keys)
+    if not keys:
+        return {}
+    if pending is None:
+        pending = {}
+
+    tag_ids = tag_cache.get_many(keys)
+    for key in keys - tag_ids.keys():
+        if key in pending:
+            tag_ids[key] = pending[key]
+
+    def _select(_keys):
+        rows = session.execute(
+            select(Tag.id, Tag.namespace, Tag.name)
+            .where(tuple_(Tag.namespace, Tag.name).in_(list(_keys)))
+        )
+        for tag_id, namespace, name in rows:
+            tag_ids[(namespace, name)] = tag_id
+            pending[(namespace, name)] = tag_id
+
+    missing = keys - tag_ids.keys()
+    if missing:
+        _select(missing)
+
+    # Only insert unknown tags, ON CONFLICT would burn sequence values otherwise
+    missing = keys - tag_ids.keys()
+    if missing:
+        rows = session.execute(
+            pg_insert(Tag)
+            .values([{'namespace': ns, 'name': name} for ns, name in sorted(missing)])
+            .on_conflict_do_nothing()
+            .returning(Tag.id, Tag.namespace, Tag.name)
+        )
+        for tag_id, namespace, name in rows:
+            tag_ids[(namespace, name)] = tag_id
+            pending[(namespace, name)] = tag_id
+
+        # Inserted concurrently by someone else
+        missing = keys - tag_ids.keys()
+        if missing:
+            _select(missing)
+
+    return tag_ids
+
+
+def resolve_chains(session, first_gids=None):
+    '''
+    Point dupe_with of every gallery in the given chains to the newest gid of the chain.
+    Galleries that stop being a chain end lose their cluster_best, clusters only hold chain ends.
+    :param first_gids: The first_gid of each chain to resolve, None for all chains
+    '''
+
+    chain = select(Gallery.first_gid, func.max(Gallery.gid).label('chain_end'))
+    if first_gids is None:
+        chain = chain.where(Gallery.first_gid.isnot(None))
+    else:
+        first_gids = list(first_gids)
+        if not first_gids:
+            return
+        chain = chain.where(Gallery.first_gid.in_(first_gids))
+    chain = chain.group_by(Gallery.first_gid).subquery()
+
+    res = session.execute(
+        update(Gallery)
+        .where(Gallery.first_gid == chain.c.first_gid)
+        .where(Gallery.gid < chain.c.chain_end)
+        .where(Gallery.dupe_with.is_distinct_from(chain.c.chain_end))
+        .values(dupe_with=chain.c.chain_end, cluster_best=None)
+        .execution_options(synchronize_session=False)
+    )
+    return res.rowcount
+
+
+def rebuild_chains():
     with session_generator() as session:
-        thumb_cache = {}
-        tag_cache = {}
-        for gdata in gdata_list:
-            insert_gallery(session, gdata, thumb_cache, tag_cache)
+        updated = resolve_chains(session)
+    logger.info(f'Rebuilt first_gid chains, {updated} galleries updated')
+    return updated
+
+
+def upsert_batch(session, gdata_list, pending_tags=None, pending_thumbs=None):
+    '''
+    Upsert a batch of galleries with a fixed number of statements. Galleries whose
+    fingerprint matches the stored one are skipped, and only the tag and torrent
+    rows that differ are written for the others.
+    :param gdata_list: Entries of the gdata API response
+    :param pending_tags: Tags resolved in the current transaction, updated in place
+    :param pending_thumbs: Thumb first_gids written in the current transaction, updated in place
+
+    :return: set of first_gids of the chains touched by this batch
+    '''
+
+    galleries = {}
+    gallery_firsts = {}
+    tags = {}
+    torrents = {}
+    for gdata in gdata_list:
+        gallery, first, _tags, _torrents = parse_gdata(gdata)
+        gid = gallery['gid']
+        galleries[gid] = gallery
+        gallery_firsts[gid] = first
+        tags[gid] = set(_tags)
+        torrents[gid] = {t['infohash']: t for t in _torrents}
+
+    if not galleries:
+        return set()
+
+    stored = dict(session.execute(
+        select(Gallery.gid, Gallery.fingerprint).where(Gallery.gid.in_(list(galleries)))
+    ).all())
+    for gid in [gid for gid, g in galleries.items() if stored.get(gid) == g['fingerprint']]:
+        del galleries[gid]
+        del tags[gid]
+        del torrents[gid]
+    if not galleries:
+        return set()
+
+    firsts = {}
+    for gid in galleries:
+        if gallery_firsts[gid]:
+            firsts.setdefault(*gallery_firsts[gid])
+
+    if pending_thumbs is None:
+        pending_thumbs = {}
+
+    thumbs = {}
+    for gid, g in galleries.items():
+        if g['thumb_url']:
+            thumbs[g['thumb_url']] = min(gid, thumbs.get(g['thumb_url'], gid))
+    # Skip thumbs already known with a first_gid at least as small
+    known = thumb_cache.get_many(thumbs.keys())
+    for url, first_gid in list(thumbs.items()):
+        known_gid = pending_thumbs.get(url, known.get(url))
+        if known_gid is not None and known_gid <= first_gid:
+            del thumbs[url]
+    # Rows are written in key order so that concurrent writers lock them in the same order
+    if thumbs:
+        stmt = pg_insert(Thumb).values([{'url': url, 'first_gid': gid} for url, gid in sorted(thumbs.items())])
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=[Thumb.url],
+            set_={'first_gid': func.least(Thumb.first_gid, stmt.excluded.first_gid)},
+            where=or_(Thumb.first_gid.is_(None), stmt.excluded.first_gid < Thumb.first_gid),
+        ))
+        for url, gid in thumbs.items():
+            pending_thumbs[url] = min(gid, known.get(url, gid))
+
+    tag_ids = upsert_tags(session, set().union(*tags.values()), pending_tags)
+
+    # Placeholders are due right away, the refresh fills them in
+    placeholders = [
+        {'gid': gid, 'token': token, 'first_gid': gid, 'next_refresh_at': func.localtimestamp()}
+        for gid, token in sorted(firsts.items())
+        if gid not in galleries
+    ]
+    if placeholders:
+        session.execute(
+            pg_insert(Gallery)
+            .values(placeholders)
+            .on_conflict_do_nothing()
+        )
+
+    stmt = pg_insert(Gallery).values([
+        dict(galleries[gid], next_refresh_at=next_refresh_at(galleries[gid]['posted_at']))
+        for gid in sorted(galleries)
+    ])
+    set_ = {c: stmt.excluded[c] for c in GALLERY_UPSERT_COLUMNS}
+    set_['fingerprint'] = stmt.excluded.fingerprint
+    set_['updated_at'] = func.now()
+    set_['refreshed_at'] = func.now()
+    set_['next_refresh_at'] = stmt.excluded.next_refresh_at
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[Gallery.gid],
+        set_=set_,
+        where=Gallery.fingerprint.is_distinct_from(stmt.excluded.fingerprint),
+    ))
+
+    gids = sorted(galleries)
+
+    # Most changes add or drop a few tags, diff against the stored rows
+    gallery_tag_rows = {(gid, tag_ids[key]) for gid, keys in tags.items() for key in keys}
+    stored_tag_rows = set(session.execute(
+        select(gallery_tag.c.gallery_gid, gallery_tag.c.tag_id).where(gallery_tag.c.gallery_gid.in_(gids))
+    ).all())
+    removed = sorted(stored_tag_rows - gallery_tag_rows)
+    added = sorted(gallery_tag_rows - stored_tag_rows)
+    if removed:
+        session.execute(
+            delete(gallery_tag)
+            .where(tuple_(gallery_tag.c.gallery_gid, gallery_tag.c.tag_id).in_(removed))
+        )
+    if added:
+        session.execute(insert(gallery_tag).values([{'gallery_gid': g, 'tag_id': t} for g, t in added]))
+
+    torrent_rows = sorted(
+        (t for _torrents in torrents.values() for t in _torrents.values()),
+        key=lambda t: (t['gid'], t['infohash']),
+    )
+    session.execute(
+        delete(Torrent)
+        .where(Torrent.gid.in_(gids))
+        .where(tuple_(Torrent.gid, Torrent.infohash).not_in([(t['gid'], t['infohash']) for t in torrent_rows]))
+        .execution_options(synchronize_session=False)
+    )
+    if torrent_rows:
+        stmt = pg_insert(Torrent).values(torrent_rows)
+        columns = [c for c in torrent_rows[0] if c not in ('gid', 'infohash')]
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=[Torrent.gid, Torrent.infohash],
+            set_={c: stmt.excluded[c] for c in columns},
+            where=tuple_(*(Torrent.__table__.c[c] for c in columns)).is_distinct_from(
+                tuple_(*(stmt.excluded[c] for c in columns))
+            ),
+        ))
+
+    return set(firsts)
+
+
+def insert_galleries(gdata_list, chains=True, checkpoint=None):
+    '''
+    Upsert galleries from gdata in a single transaction
+    :param gdata_list: Entries of the gdata API response
+    :param chains: Whether to resolve touched first_gid chains before committing,
+                   pass False to defer it and resolve the returned set later
+    :param checkpoint: Optional (search_hash, name, cursor) saved to crawl_state
+                       in the same transaction
+
+    :return: set of first_gids of the chains touched
+    '''
+
+    pending_tags = {}
+    pending_thumbs = {}
+    first_gids = set()
+    with session_generator() as session:
+        warm_tag_cache(session)
+        for i in range(0, len(gdata_list), BULK_BATCH_SIZE):
+            first_gids |= upsert_batch(session, gdata_list[i:i + BULK_BATCH_SIZE], pending_tags, pending_thumbs)
+        if chains:
+            resolve_chains(session, first_gids)
+        if checkpoint is not None:
+            save_cursor(session, *checkpoint)
+
+    # Only publish to the process-wide caches once the transaction is committed
+    tag_cache.update(pending_tags)
+    thumb_cache.update(pending_thumbs)
+
+    return first_gids
 
 
 def get_last_gid(categories=None, expunged=None):
@@ -1,32 +1,191 @@
-from sqlalchemy import func
+import struct
+from io import BytesIO
+from datetime import timedelta
 
-from ehclone.db.entities import Thumb, Gallery
+import numpy as np
+from sqlalchemy import func, select, update, values, column, or_, tuple_, BigInteger, String
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.db.entities import Thumb
 from ehclone.db.session import session_generator
 
 
-def get_unvectorized_thumbs(limit):
+VECTOR_DIM = 576
+
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_COPY_TRAILER = struct.pack('>h', -1)
+
+
+def get_thumb_vectors(urls):
+    '''
+    :return: dict of url to (vector, dhash) for the thumbs among urls that have a vector
+    '''
+
+    with session_generator() as session:
+        rows = session.execute(
+            select(Thumb.url, Thumb.mobile_net_v3, Thumb.dhash)
+            .where(Thumb.url.in_(list(urls)))
+            .where(Thumb.mobile_net_v3.isnot(None))
+        )
+        return {url: (np.asarray(vector, dtype=np.float32), dhash) for url, vector, dhash in rows}
+
+
+def claim_unvectorized_thumbs(limit, after=None):
+    '''
+    Lease unvectorized thumbs in first_gid order, walking ix_thumb_unvectorized.
+    Rows locked or leased by other workers are skipped, a lease that is not
+    released by writing the vector expires after db.thumb_claim_lease seconds.
+    :param limit: Maximum number of thumbs to claim
+    :param after: (first_gid, url) keyset cursor, the last thumb claimed before
+
+    :return: list of (first_gid, url) in order
+    '''
+
+    table = Thumb.__table__
+    lease_expired = func.now() - timedelta(seconds=config.db.thumb_claim_lease)
+
+    candidates = (
+        select(table.c.url)
+        .where(table.c.mobile_net_v3.is_(None))
+        .where(table.c.first_gid.isnot(None))
+        .where(or_(table.c.claimed_at.is_(None), table.c.claimed_at < lease_expired))
+    )
+    if after is not None:
+        candidates = candidates.where(tuple_(table.c.first_gid, table.c.url) > tuple_(*after))
+    candidates = (
+        candidates
+        .order_by(table.c.first_gid, table.c.url)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+
+    with session_generator() as session:
+        rows = session.execute(
+            update(table)
+            .where(table.c.url.in_(candidates.scalar_subquery()))
+            .values(claimed_at=func.now())
+            .returning(table.c.first_gid, table.c.url)
+        ).all()
+    return sorted((first_gid, url) for first_gid, url in rows)
+
+
+def _copy_rows(rows):
+    '''
+    Encode (url, vector, dhash) rows as a binary COPY stream, vectors in pgvector's binary format
+    '''
+
+    buf = BytesIO()
+    buf.write(_COPY_HEADER)
+    for url, vector, dhash in rows:
+        url = url.encode('utf-8')
+        buf.write(struct.pack('>hi', 3, len(url)))
+        buf.write(url)
+        buf.write(struct.pack('>ihh', 4 + 4 * len(vector), len(vector), 0))
+        buf.write(vector.astype('>f4').tobytes())
+        if dhash is None:
+            buf.write(struct.pack('>i', -1))
+        else:
+            buf.write(struct.pack('>iq', 8, dhash))
+    buf.write(_COPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+def _update_batch(rows):
     with session_generator() as session:
-        subq = (
-            session.query(
-                Thumb.url,
-                func.min(Gallery.gid).label('min_gid')
-            )
-            .join(Gallery, Gallery.thumb_url == Thumb.url)
-            .filter(Thumb.mobile_net_v3.is_(None))
-            .group_by(Thumb.url)
-            .subquery()
+        cursor = session.connection().connection.cursor()
+        cursor.execute(
+            f'CREATE TEMP TABLE thumb_vector_stage (url text, vec vector({VECTOR_DIM}), dhash bigint) ON COMMIT DROP'
         )
-        results = (
-            session.query(subq.c.url)
-            .order_by(subq.c.min_gid)
-            .limit(limit)
-            .all()
+        cursor.copy_expert('COPY thumb_vector_stage (url, vec, dhash) FROM STDIN WITH (FORMAT BINARY)', _copy_rows(rows))
+        cursor.execute(
+            'UPDATE thumb SET mobile_net_v3 = s.vec, dhash = coalesce(s.dhash, thumb.dhash), vectorized_at = now() '
+            'FROM thumb_vector_stage s WHERE thumb.url = s.url RETURNING thumb.url'
         )
-        return [r[0] for r in results]
+        return {r[0] for r in cursor.fetchall()}
 
 
-def update_thumb_vector(url, vector):
+def update_thumb_vectors(pairs, hashes=None, batch_size=None):
+    '''
+    Write many thumb vectors with one COPY and one joined UPDATE per batch
+    :param pairs: Iterable of (url, vector), vectors as NumPy arrays or lists
+    :param hashes: Optional dict of url to the dhash computed from the same image
+    :param batch_size: Rows per transaction, defaults to config.db.vector_batch_size
+
+    :return: dict of url to the reason it was not written, empty if all succeeded
+    '''
+
+    batch_size = batch_size or config.db.vector_batch_size
+    failures = {}
+
+    rows = {}
+    for url, vector in pairs:
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != (VECTOR_DIM,):
+            failures[url] = f'Invalid vector shape {vector.shape}'
+        elif not np.isfinite(vector).all():
+            failures[url] = 'Vector is not finite'
+        else:
+            rows[url] = vector
+    hashes = hashes or {}
+    rows = [(url, vector, hashes.get(url)) for url, vector in rows.items()]
+
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        try:
+            updated = _update_batch(batch)
+        except Exception as e:
+            logger.error(f'Failed to write {len(batch)} thumb vectors: {e}')
+            for url, _, _ in batch:
+                failures[url] = str(e)
+            continue
+        for url, _, _ in batch:
+            if url not in updated:
+                failures[url] = 'Thumb not found'
+
+    return failures
+
+
+def get_unhashed_thumbs(limit, after=None):
+    '''
+    Vectorized thumbs without a dhash in url order
+    :param after: The last url returned before
+    '''
+
+    query = (
+        select(Thumb.url)
+        .where(Thumb.dhash.is_(None))
+        .where(Thumb.mobile_net_v3.isnot(None))
+    )
+    if after is not None:
+        query = query.where(Thumb.url > after)
     with session_generator() as session:
-        thumb = session.get(Thumb, url)
-        if thumb:
-            thumb.mobile_net_v3 = vector
+        return list(session.scalars(query.order_by(Thumb.url).limit(limit)))
+
+
+def update_thumb_hashes(hashes):
+    '''
+    Set the dhash of thumbs that have none. vectorized_at is bumped as well so that
+    EmbeddingStore.sync picks the hashes up.
+    :param hashes: dict of url to dhash
+
+    :return: number of thumbs updated
+    '''
+
+    if not hashes:
+        return 0
+    v = values(column('url', String), column('dhash', BigInteger), name='v').data(list(hashes.items()))
+    with session_generator() as session:
+        res = session.execute(
+            update(Thumb)
+            .where(Thumb.url == v.c.url)
+            .where(Thumb.dhash.is_(None))
+            .values(dhash=v.c.dhash, vectorized_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        return res.rowcount
+
+
+def update_thumb_vector(url, vector):
+    update_thumb_vectors([(url, vector)])
@@ -50,7 +50,7 @@ class Gallery(Base):
     title = Column(String)
     title_jpn = Column(String)
     category = Column(Enum(Category))
-    thumb_url = Column(String, ForeignKey('thumb.url'))
+    thumb_url = Column(String, ForeignKey('thumb.url'), index=True)
     uploader = Column(String)
     posted_at = Column(DateTime(timezone=False))
     filecount = Column(Integer)
@@ -59,9 +59,19 @@ class Gallery(Base):
     rating = Column(Integer)
 
     first_gid = Column(BigInteger, ForeignKey('gallery.gid'))
+    # Newest gallery of the first_gid chain, owned by resolve_chains
     dupe_with = Column(BigInteger, ForeignKey('gallery.gid'), index=True)
+    # Best gallery of the near-duplicate cluster, owned by the dedupe resolver. Clusters
+    # are built over chain ends, so following dupe_with then cluster_best always stops.
+    cluster_best = Column(BigInteger, ForeignKey('gallery.gid'), index=True)
 
     updated_at = Column(DateTime(timezone=False), server_default=func.now(), onupdate=func.now())
+    # Hash of the normalized gdata, see gallery_fingerprint
+    fingerprint = Column(BigInteger)
+    # Last time the metadata was requested, returned or not, NULL before it was tracked
+    refreshed_at = Column(DateTime(timezone=False), server_default=func.now())
+    # When the refresh picks the gallery up again, see refresh_interval and retry_interval
+    next_refresh_at = Column(DateTime(timezone=False), index=True)
 
     downloaded = Column(Integer)
 
@@ -71,6 +81,14 @@ class Gallery(Base):
 
     __table_args__ = (
         Index('ix_gallery_first_gid_gid', 'first_gid', 'gid'),
+        # Covers get_last_gid with a backward index-only scan
+        Index(
+            'ix_gallery_last_gid',
+            'expunged',
+            'gid',
+            postgresql_include=['category'],
+            postgresql_where=title.isnot(None),
+        ),
     )
 
 
@@ -80,8 +98,27 @@ class Thumb(Base):
     url = Column(String, primary_key=True)
     mobile_net_v3 = Column(Vector(576))
 
+    # Smallest gid using this thumb, the vectorizer work queue is ordered by it
+    first_gid = Column(BigInteger)
+    claimed_at = Column(DateTime(timezone=False))
+    # 64-bit difference hash of the same image, see dedupe.phash
+    dhash = Column(BigInteger)
+    # Watermark for incremental embedding exports
+    vectorized_at = Column(DateTime(timezone=False), index=True)
+
     galleries = relationship('Gallery', back_populates='thumb')
 
+    __table_args__ = (
+        Index('ix_thumb_unvectorized', 'first_gid', 'url', postgresql_where=mobile_net_v3.is_(None)),
+        Index(
+            'ix_thumb_mobile_net_v3_hnsw',
+            mobile_net_v3,
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'mobile_net_v3': 'vector_cosine_ops'},
+        ),
+    )
+
 
 class Tag(Base):
     __tablename__ = 'tag'
@@ -97,13 +134,18 @@ class Tag(Base):
 
     galleries = relationship('Gallery', secondary=gallery_tag, back_populates='tags')
 
-    @classmethod
-    def from_str(cls, tag_str):
+    @staticmethod
+    def split_str(tag_str):
         if ':' in tag_str:
             namespace, name = tag_str.split(':', 1)
         else:
             namespace = 'temp'
             name = tag_str
+        return namespace, name
+
+    @classmethod
+    def from_str(cls, tag_str):
+        namespace, name = cls.split_str(tag_str)
         return cls(namespace=namespace, name=name)
 
 
@@ -120,6 +162,18 @@ class Torrent(Base):
     gallery = relationship('Gallery', back_populates='torrents')
 
 
+class CrawlState(Base):
+    __tablename__ = 'crawl_state'
+
+    # EH.get_search_hash of the search being crawled
+    search_hash = Column(String, primary_key=True)
+    # The pass, e.g. 'index' or 'expunged'
+    name = Column(String, primary_key=True)
+    # prev of the next listing page to fetch
+    cursor = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime(timezone=False), server_default=func.now(), onupdate=func.now())
+
+
 class DownloadStatus(str, enum.Enum):
     QUEUED = 'queued'
     QBIT_DOWNLOADING = 'qbit_downloading'
@@ -0,0 +1,64 @@
+from sqlalchemy import text, inspect, update, func
+
+from ehclone.logger import logger
+from ehclone.db.entities import Gallery
+from ehclone.db.crud.gallery import refresh_interval
+
+
+def _add_column(connection, table, column, ddl):
+    '''
+    :return: True if the column was missing and has been added
+    '''
+
+    columns = {c['name'] for c in inspect(connection).get_columns(table)}
+    if column in columns:
+        return False
+    logger.info(f'Adding column {table}.{column}')
+    connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    return True
+
+
+def upgrade(connection):
+    '''
+    Bring tables created by an older version up to date, create_all only creates missing tables
+    '''
+
+    if _add_column(connection, 'thumb', 'first_gid', 'BIGINT'):
+        connection.execute(text('''
+            UPDATE thumb SET first_gid = g.min_gid
+            FROM (
+                SELECT thumb_url, min(gid) AS min_gid
+                FROM gallery
+                WHERE thumb_url IS NOT NULL
+                GROUP BY thumb_url
+            ) g
+            WHERE thumb.url = g.thumb_url
+        '''))
+    _add_column(connection, 'thumb', 'claimed_at', 'TIMESTAMP WITHOUT TIME ZONE')
+    _add_column(connection, 'thumb', 'dhash', 'BIGINT')
+    _add_column(connection, 'thumb', 'vectorized_at', 'TIMESTAMP WITHOUT TIME ZONE')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_thumb_vectorized_at ON thumb (vectorized_at)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_thumb_unvectorized ON thumb (first_gid, url) WHERE mobile_net_v3 IS NULL'
+    ))
+    _add_column(connection, 'gallery', 'fingerprint', 'BIGINT')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_gallery_thumb_url ON gallery (thumb_url)'))
+    if _add_column(connection, 'gallery', 'cluster_best', 'BIGINT REFERENCES gallery (gid)'):
+        # Cluster links used to share dupe_with with the chains, keep only the chain links
+        connection.execute(text('''
+            UPDATE gallery SET dupe_with = NULL
+            WHERE dupe_with IS NOT NULL AND dupe_with IS DISTINCT FROM (
+                SELECT max(c.gid) FROM gallery c WHERE c.first_gid = gallery.first_gid
+            )
+        '''))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_gallery_cluster_best ON gallery (cluster_best)'))
+    if _add_column(connection, 'gallery', 'refreshed_at', 'TIMESTAMP WITHOUT TIME ZONE'):
+        connection.execute(text('ALTER TABLE gallery ALTER COLUMN refreshed_at SET DEFAULT now()'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_gallery_last_gid ON gallery (expunged, gid) '
+        'INCLUDE (category) WHERE title IS NOT NULL'
+    ))
+    if _add_column(connection, 'gallery', 'next_refresh_at', 'TIMESTAMP WITHOUT TIME ZONE'):
+        last = func.coalesce(Gallery.refreshed_at, Gallery.updated_at, func.localtimestamp())
+        connection.execute(update(Gallery).values(next_refresh_at=last + refresh_interval(Gallery.posted_at)))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_gallery_next_refresh_at ON gallery (next_refresh_at)'))
@@ -0,0 +1,104 @@
+from sqlalchemy import select, func, text, true
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.db.entities import Gallery, Thumb
+from ehclone.db.session import engine, session_generator
+
+
+ANN_INDEX_NAME = 'ix_thumb_mobile_net_v3_hnsw'
+
+
+def build_ann_index():
+    '''
+    Create the HNSW cosine index on thumb.mobile_net_v3 for databases created before it existed,
+    pgvector keeps it up to date on every write afterwards
+    '''
+
+    index = next(i for i in Thumb.__table__.indexes if i.name == ANN_INDEX_NAME)
+    with engine.begin() as connection:
+        connection.execute(
+            text("SELECT set_config('maintenance_work_mem', :mem, true)"),
+            {'mem': config.filter.dedupe.ann_build_memory},
+        )
+        logger.info(f'Building {ANN_INDEX_NAME}, this may take a while')
+        index.create(connection, checkfirst=True)
+    logger.info(f'{ANN_INDEX_NAME} is ready')
+
+
+def _candidates_query(where, k, threshold, page_tolerance):
+    g = Gallery.__table__.alias('g')
+    t = Thumb.__table__.alias('t')
+    g2 = Gallery.__table__.alias('g2')
+    t2 = Thumb.__table__.alias('t2')
+
+    # ORDER BY distance LIMIT k is what lets the planner use the HNSW index
+    distance = t2.c.mobile_net_v3.cosine_distance(t.c.mobile_net_v3)
+    neighbors = (
+        select(t2.c.url, distance.label('distance'))
+        .where(t2.c.mobile_net_v3.isnot(None))
+        .order_by(distance)
+        .limit(k)
+        .lateral('n')
+    )
+
+    return (
+        select(g.c.gid, g2.c.gid.label('candidate_gid'), neighbors.c.distance)
+        .select_from(
+            g
+            .join(t, t.c.url == g.c.thumb_url)
+            .join(neighbors, true())
+            .join(g2, g2.c.thumb_url == neighbors.c.url)
+        )
+        .where(where(g))
+        .where(t.c.mobile_net_v3.isnot(None))
+        .where(g2.c.gid != g.c.gid)
+        .where(neighbors.c.distance <= threshold)
+        .where(func.abs(g2.c.filecount - g.c.filecount) <= page_tolerance)
+        .order_by(g.c.gid, neighbors.c.distance)
+    )
+
+
+def find_candidates(session, where, k=None, ef_search=None, threshold=None, page_tolerance=None):
+    '''
+    Near-duplicate candidates of the galleries matched by where
+    :param where: Callable taking the source gallery table and returning a filter clause
+    :param k: Nearest thumbs fetched per gallery before filtering, defaults to filter.dedupe.ann_k
+    :param ef_search: HNSW search breadth, defaults to filter.dedupe.ef_search
+    :param threshold: Maximum cosine distance, defaults to filter.dedupe.cosine_threshold
+    :param page_tolerance: Maximum filecount difference, defaults to filter.dedupe.page_tolerance
+
+    :return: list of (gid, candidate_gid, cosine distance), ordered by gid then distance
+    '''
+
+    dedupe = config.filter.dedupe
+    k = k or dedupe.ann_k
+    ef_search = ef_search or dedupe.ef_search
+    threshold = dedupe.cosine_threshold if threshold is None else threshold
+    page_tolerance = dedupe.page_tolerance if page_tolerance is None else page_tolerance
+
+    # ef_search bounds how many neighbors the index can return at all
+    session.execute(
+        text("SELECT set_config('hnsw.ef_search', :ef, true)"),
+        {'ef': str(max(ef_search, k))},
+    )
+    rows = session.execute(_candidates_query(where, k, threshold, page_tolerance))
+    return [(gid, candidate_gid, float(distance)) for gid, candidate_gid, distance in rows]
+
+
+def get_candidates(gid, **kwargs):
+    with session_generator() as session:
+        return find_candidates(session, lambda g: g.c.gid == gid, **kwargs)
+
+
+def get_candidates_in_range(min_gid, max_gid, **kwargs):
+    '''
+    Candidates of every gallery with min_gid <= gid < max_gid in a single query
+    '''
+
+    with session_generator() as session:
+        return find_candidates(
+            session,
+            lambda g: (g.c.gid >= min_gid) & (g.c.gid < max_gid),
+            **kwargs,
+        )
@@ -0,0 +1,510 @@
+import os
+import json
+import struct
+import tempfile
+from array import array
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.db.session import session_generator
+from ehclone.db.crud.thumb import VECTOR_DIM
+from ehclone.dedupe.phash import hamming_pairs
+
+
+CHUNK_ROWS = 65536
+# now() is the transaction start, vectors committed after a sync can carry an older timestamp
+WATERMARK_OVERLAP = timedelta(minutes=10)
+
+_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+_EXPORT_QUERY = '''
+    COPY (
+        SELECT t.url, t.dhash, t.mobile_net_v3
+        FROM thumb t
+        WHERE t.mobile_net_v3 IS NOT NULL {where}
+    ) TO STDOUT WITH (FORMAT BINARY)
+'''
+_GALLERY_EXPORT_QUERY = 'COPY ({}) TO STDOUT WITH (FORMAT BINARY)'
+_GALLERY_SELECT = 'SELECT g.gid, g.filecount, g.thumb_url FROM gallery g'
+
+
+def _read_copy_rows(f):
+    '''
+    Decode a binary COPY stream into lists of raw field bytes, None for NULL
+    '''
+
+    header = f.read(19)
+    if header[:11] != _COPY_SIGNATURE:
+        raise ValueError('Not a binary COPY stream')
+    (extension,) = struct.unpack('>i', header[15:19])
+    f.read(extension)
+
+    while True:
+        (fields,) = struct.unpack('>h', f.read(2))
+        if fields == -1:
+            return
+        row = []
+        for _ in range(fields):
+            (length,) = struct.unpack('>i', f.read(4))
+            row.append(None if length == -1 else f.read(length))
+        yield row
+
+
+class EmbeddingStore:
+    '''
+    A memory-mapped copy of the thumb vectors for dedupe runs that do not query pgvector.
+    Row i of vectors.npy is the unit-length vector of urls.txt line i, hashes.npy its
+    dhash where hashed.npy is set. Rows are only appended or overwritten in place,
+    meta.json is written last and is authoritative.
+
+    Every gallery is kept in the gallery_*.npy arrays sorted by gid, with its filecount
+    and the row of its thumb, -1 without a vectorized thumb. Galleries sharing a thumb
+    all take part in the clusters like they do in the pgvector candidates.
+    '''
+
+    ARRAYS = {
+        'vectors': (VECTOR_DIM,),
+        'hashes': (),
+        'hashed': (),
+    }
+    GALLERY_ARRAYS = {
+        'gallery_gids': np.int64,
+        'gallery_rows': np.int64,
+        'gallery_filecounts': np.int32,
+    }
+    # Written by versions that kept only the first gallery of each thumb
+    LEGACY_ARRAYS = ('gids', 'filecounts')
+
+    def __init__(self, path=None, dtype=None):
+        '''
+        :param path: Directory of the store, defaults to filter.dedupe.embedding_dir
+        :param dtype: Vector dtype of a new store, defaults to filter.dedupe.embedding_dtype.
+                      An existing store keeps the dtype it was created with.
+        '''
+
+        dedupe = config.filter.dedupe
+        self.path = Path(path or dedupe.embedding_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            self.meta = json.loads(meta_path.read_text())
+        else:
+            self.meta = {'count': 0, 'dtype': dtype or dedupe.embedding_dtype, 'watermark': None}
+        self.meta.setdefault('gallery_watermark', None)
+        self.dtypes = {
+            'vectors': np.dtype(self.meta['dtype']),
+            'hashes': np.dtype(np.int64),
+            'hashed': np.dtype(bool),
+        }
+
+        urls_path = self.path / 'urls.txt'
+        self.urls = urls_path.read_text().splitlines() if urls_path.exists() else []
+        # Lines past count were appended by a sync that did not finish
+        self._rewrite_urls = len(self.urls) > self.count
+        self.urls = self.urls[:self.count]
+        self._saved_urls = len(self.urls)
+        self.index = {url: i for i, url in enumerate(self.urls)}
+
+        for name in self.ARRAYS:
+            array_path = self.path / f'{name}.npy'
+            setattr(self, name, np.load(array_path, mmap_mode='r+') if array_path.exists() else None)
+
+        missing = [name for name in self.ARRAYS if getattr(self, name) is None]
+        if self.vectors is not None and missing:
+            # A store from an older version, add the arrays and export every row again to fill them
+            for name in missing:
+                array = np.lib.format.open_memmap(
+                    self.path / f'{name}.npy', mode='w+', dtype=self.dtypes[name],
+                    shape=(self.capacity, *self.ARRAYS[name]),
+                )
+                setattr(self, name, array)
+            self.meta['watermark'] = None
+
+        legacy = [self.path / f'{name}.npy' for name in self.LEGACY_ARRAYS]
+        if any(path.exists() for path in legacy):
+            # Thumbs without a first_gid were left out, export every row again
+            self.meta['watermark'] = None
+            for path in legacy:
+                path.unlink(missing_ok=True)
+
+        self._galleries_changed = False
+        for name, dtype in self.GALLERY_ARRAYS.items():
+            array_path = self.path / f'{name}.npy'
+            setattr(self, name, np.load(array_path) if array_path.exists() else np.empty(0, dtype=dtype))
+        if not all(len(getattr(self, name)) == len(self.gallery_gids) for name in self.GALLERY_ARRAYS):
+            # Interrupted between two of the files, export every gallery again
+            for name, dtype in self.GALLERY_ARRAYS.items():
+                setattr(self, name, np.empty(0, dtype=dtype))
+            self.meta['gallery_watermark'] = None
+        # Rows past count were appended by a sync that did not finish
+        self.gallery_rows[self.gallery_rows >= self.count] = -1
+
+    @property
+    def count(self):
+        return self.meta['count']
+
+    @property
+    def capacity(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def _reserve(self, rows):
+        '''
+        Grow the arrays to fit count + rows, doubling to keep appends amortized
+        '''
+
+        needed = self.count + rows
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, 2 * self.capacity, CHUNK_ROWS)
+
+        for name, shape in self.ARRAYS.items():
+            array_path = self.path / f'{name}.npy'
+            tmp_path = self.path / f'{name}.tmp.npy'
+            grown = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtypes[name], shape=(capacity, *shape))
+            old = getattr(self, name)
+            if old is not None:
+                grown[:self.count] = old[:self.count]
+            grown.flush()
+            del grown, old
+            setattr(self, name, None)
+            os.replace(tmp_path, array_path)
+            setattr(self, name, np.load(array_path, mmap_mode='r+'))
+
+    def upsert(self, urls, hashes, vectors):
+        '''
+        Overwrite the rows of known urls and append the rest, vectors are normalized on the way in
+        :param hashes: dhash of each url, None where the thumb has none
+        '''
+
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, VECTOR_DIM)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        self._reserve(sum(url not in self.index for url in urls))
+        rows = np.empty(len(urls), dtype=np.int64)
+        for i, url in enumerate(urls):
+            row = self.index.get(url)
+            if row is None:
+                row = self.index[url] = len(self.urls)
+                self.urls.append(url)
+            rows[i] = row
+
+        self.vectors[rows] = vectors.astype(self.dtypes['vectors'])
+        self.hashes[rows] = [0 if h is None else h for h in hashes]
+        self.hashed[rows] = [h is not None for h in hashes]
+        self.meta['count'] = len(self.urls)
+
+    def upsert_galleries(self, gids, filecounts, rows):
+        '''
+        Overwrite the known galleries and insert the rest in one pass, keeping them sorted
+        by gid. The last row of a gid repeated in gids wins.
+        :param rows: Thumb row of each gallery, -1 without a vectorized thumb
+        '''
+
+        gids = np.asarray(gids, dtype=np.int64)
+        if not len(gids):
+            return
+        rows = np.asarray(rows, dtype=np.int64)
+        filecounts = np.asarray(filecounts, dtype=np.int32)
+
+        # Last occurrence of each gid, in gid order
+        gids, last = np.unique(gids[::-1], return_index=True)
+        last = len(rows) - 1 - last
+        rows, filecounts = rows[last], filecounts[last]
+
+        positions = np.searchsorted(self.gallery_gids, gids)
+        known = positions < len(self.gallery_gids)
+        known[known] = self.gallery_gids[positions[known]] == gids[known]
+        self.gallery_rows[positions[known]] = rows[known]
+        self.gallery_filecounts[positions[known]] = filecounts[known]
+
+        new = ~known
+        if new.any():
+            self.gallery_gids = np.insert(self.gallery_gids, positions[new], gids[new])
+            self.gallery_rows = np.insert(self.gallery_rows, positions[new], rows[new])
+            self.gallery_filecounts = np.insert(self.gallery_filecounts, positions[new], filecounts[new])
+        self._galleries_changed = True
+
+    def save(self):
+        for name in self.ARRAYS:
+            if getattr(self, name) is not None:
+                getattr(self, name).flush()
+
+        # Before meta.json, a watermark must never be ahead of the arrays it covers
+        if self._galleries_changed:
+            for name in self.GALLERY_ARRAYS:
+                tmp_path = self.path / f'{name}.tmp.npy'
+                np.save(tmp_path, getattr(self, name))
+                os.replace(tmp_path, self.path / f'{name}.npy')
+            self._galleries_changed = False
+
+        urls_path = self.path / 'urls.txt'
+        if self._rewrite_urls:
+            tmp_path = self.path / 'urls.tmp.txt'
+            tmp_path.write_text(''.join(f'{url}\n' for url in self.urls))
+            os.replace(tmp_path, urls_path)
+            self._rewrite_urls = False
+        elif len(self.urls) > self._saved_urls:
+            with open(urls_path, 'a') as f:
+                f.writelines(f'{url}\n' for url in self.urls[self._saved_urls:])
+        self._saved_urls = len(self.urls)
+
+        tmp_path = self.path / 'meta.tmp.json'
+        tmp_path.write_text(json.dumps(self.meta))
+        os.replace(tmp_path, self.path / 'meta.json')
+
+    def _load_copy(self, f):
+        exported = 0
+        urls, hashes, vectors = [], [], bytearray()
+
+        def flush():
+            vector_array = np.frombuffer(bytes(vectors), dtype='>f4').reshape(-1, VECTOR_DIM)
+            self.upsert(urls, hashes, vector_array)
+            urls.clear()
+            hashes.clear()
+            vectors.clear()
+
+        for url, dhash, vector in _read_copy_rows(f):
+            urls.append(url.decode('utf-8'))
+            hashes.append(None if dhash is None else struct.unpack('>q', dhash)[0])
+            # pgvector binary: int16 dim, int16 unused, dim big-endian float4
+            vectors += vector[4:]
+            exported += 1
+            if len(urls) == CHUNK_ROWS:
+                flush()
+        if urls:
+            flush()
+        return exported
+
+    def _load_gallery_copy(self, f):
+        '''
+        Read the whole export before merging it, inserting chunk by chunk would copy
+        the sorted arrays once per chunk
+        '''
+
+        gids, filecounts, rows = array('q'), array('i'), array('q')
+        for gid, filecount, thumb_url in _read_copy_rows(f):
+            gids.append(struct.unpack('>q', gid)[0])
+            filecounts.append(0 if filecount is None else struct.unpack('>i', filecount)[0])
+            rows.append(-1 if thumb_url is None else self.index.get(thumb_url.decode('utf-8'), -1))
+        self.upsert_galleries(np.frombuffer(gids, np.int64), np.frombuffer(filecounts, np.int32), np.frombuffer(rows, np.int64))
+        return len(gids)
+
+    @staticmethod
+    def _since(watermark):
+        return datetime.fromisoformat(watermark) - WATERMARK_OVERLAP
+
+    def sync(self):
+        '''
+        Export the vectors written since the last sync, then the galleries changed since or
+        whose thumb was vectorized since, the first sync exports all of them
+
+        :return: number of thumb rows exported
+        '''
+
+        watermark = self.meta['watermark']
+        gallery_watermark = self.meta['gallery_watermark']
+        with tempfile.TemporaryFile(dir=self.path) as f, tempfile.TemporaryFile(dir=self.path) as gallery_f:
+            with session_generator() as session:
+                cursor = session.connection().connection.cursor()
+                cursor.execute('SELECT (SELECT max(vectorized_at) FROM thumb), (SELECT max(updated_at) FROM gallery)')
+                latest, gallery_latest = cursor.fetchone()
+
+                where = ''
+                if watermark is not None:
+                    where = cursor.mogrify('AND t.vectorized_at > %s', (self._since(watermark),)).decode()
+                cursor.copy_expert(_EXPORT_QUERY.format(where=where), f)
+
+                if gallery_watermark is None:
+                    query = _GALLERY_SELECT
+                else:
+                    query = cursor.mogrify(f'{_GALLERY_SELECT} WHERE g.updated_at > %s', (self._since(gallery_watermark),)).decode()
+                    # Galleries that did not change but whose thumb got its vector
+                    query += f' UNION ALL {_GALLERY_SELECT} JOIN thumb t ON t.url = g.thumb_url WHERE t.mobile_net_v3 IS NOT NULL {where}'
+                cursor.copy_expert(_GALLERY_EXPORT_QUERY.format(query), gallery_f)
+
+            f.seek(0)
+            exported = self._load_copy(f)
+            gallery_f.seek(0)
+            galleries = self._load_gallery_copy(gallery_f)
+
+        if latest is not None:
+            self.meta['watermark'] = latest.isoformat()
+        if gallery_latest is not None:
+            self.meta['gallery_watermark'] = gallery_latest.isoformat()
+        self.save()
+        logger.info(
+            f'Exported {exported} thumb vectors and {galleries} galleries to {self.path}, '
+            f'{self.count} thumbs and {len(self.gallery_gids)} galleries in total'
+        )
+        return exported
+
+    def _block_pairs(self, query, first_other, block, min_similarity, queried):
+        n = self.count
+        a = np.asarray(self.vectors[query], dtype=np.float32)
+        found_a, found_b, found_d = [], [], []
+
+        for other in range(first_other, n, block):
+            b = np.asarray(self.vectors[other:min(other + block, n)], dtype=np.float32)
+            similarity = a @ b.T
+            rows, columns = np.nonzero(similarity >= min_similarity)
+            distances = 1 - similarity[rows, columns]
+            rows = query[rows]
+            columns = columns + other
+
+            # Pairs of two queried rows come up twice, keep the ordered one
+            keep = (rows < columns) | ~queried[columns]
+            found_a.append(np.minimum(rows, columns)[keep])
+            found_b.append(np.maximum(rows, columns)[keep])
+            found_d.append(distances[keep])
+
+        return np.concatenate(found_a), np.concatenate(found_b), np.concatenate(found_d)
+
+    def all_pairs(self, threshold=None, block=None, workers=None, rows=None):
+        '''
+        Every pair of thumb rows within a cosine distance, comparing blocks of rows with one
+        matrix product each. Row blocks are spread over a thread pool, NumPy releases
+        the GIL inside the product.
+        :param threshold: Maximum cosine distance, defaults to filter.dedupe.cosine_threshold
+        :param block: Rows per block, defaults to filter.dedupe.embedding_block
+        :param workers: Threads, defaults to filter.dedupe.embedding_workers or the CPU count
+        :param rows: Only the pairs with at least one of these rows, None for every pair
+
+        :return: (rows_a, rows_b, distances) arrays with rows_a < rows_b
+        '''
+
+        dedupe = config.filter.dedupe
+        threshold = dedupe.cosine_threshold if threshold is None else threshold
+        block = block or dedupe.embedding_block
+        workers = workers or dedupe.embedding_workers or os.cpu_count()
+
+        empty = np.empty(0, dtype=np.int64)
+        if self.count < 2 or (rows is not None and not len(rows)):
+            return empty, empty, np.empty(0, dtype=np.float32)
+
+        if rows is None:
+            # Each block against itself and the blocks after it
+            queries = [(np.arange(start, min(start + block, self.count)), start) for start in range(0, self.count, block)]
+            queried = np.ones(self.count, dtype=bool)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            queries = [(rows[start:start + block], 0) for start in range(0, len(rows), block)]
+            queried = np.zeros(self.count, dtype=bool)
+            queried[rows] = True
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda q: self._block_pairs(q[0], q[1], block, 1 - threshold, queried),
+                queries,
+            ))
+        rows_a, rows_b, distances = (np.concatenate(parts) for parts in zip(*results))
+        return rows_a, rows_b, distances
+
+    def hash_pairs(self, threshold=None):
+        '''
+        Thumb candidates from the perceptual hashes. Pairs within filter.dedupe.dhash_match_distance
+        bits are taken as they are, pairs up to dhash_candidate_distance bits are ambiguous
+        and kept only if their cosine distance is within threshold as well.
+        :param threshold: Maximum cosine distance, defaults to filter.dedupe.cosine_threshold
+
+        :return: (rows_a, rows_b, distances) like all_pairs, the distance is NaN for pairs
+                 accepted on their hashes alone
+        '''
+
+        dedupe = config.filter.dedupe
+        threshold = dedupe.cosine_threshold if threshold is None else threshold
+
+        hashed = np.flatnonzero(self.hashed[:self.count]) if self.count else np.empty(0, dtype=np.int64)
+        index_a, index_b, bits = hamming_pairs(
+            self.hashes[hashed],
+            dedupe.dhash_candidate_distance,
+            chunks=dedupe.dhash_chunks,
+            max_bucket=dedupe.dhash_max_bucket,
+        )
+        rows_a, rows_b = hashed[index_a], hashed[index_b]
+
+        distances = np.full(len(rows_a), np.nan, dtype=np.float32)
+        ambiguous = np.flatnonzero(bits > dedupe.dhash_match_distance)
+        for start in range(0, len(ambiguous), CHUNK_ROWS):
+            pairs = ambiguous[start:start + CHUNK_ROWS]
+            a = np.asarray(self.vectors[rows_a[pairs]], dtype=np.float32)
+            b = np.asarray(self.vectors[rows_b[pairs]], dtype=np.float32)
+            distances[pairs] = 1 - np.einsum('ij,ij->i', a, b)
+
+        keep = (bits <= dedupe.dhash_match_distance) | (distances <= threshold)
+        logger.info(
+            f'{len(rows_a)} thumb pairs within {dedupe.dhash_candidate_distance} bits, '
+            f'{len(ambiguous)} checked by cosine distance, {keep.sum()} kept'
+        )
+        return rows_a[keep], rows_b[keep], distances[keep]
+
+    def gallery_pairs(self, rows_a, rows_b, distances, page_tolerance=None):
+        '''
+        Expand thumb pairs to every pair of galleries using them, and pair the galleries
+        that share a thumb at distance 0, like the pgvector candidates do
+        :param page_tolerance: Maximum filecount difference, defaults to filter.dedupe.page_tolerance
+
+        :return: ((m, 2) array of (gid, candidate gid), distances)
+        '''
+
+        dedupe = config.filter.dedupe
+        page_tolerance = dedupe.page_tolerance if page_tolerance is None else page_tolerance
+
+        # Galleries grouped by thumb row
+        with_thumb = np.flatnonzero(self.gallery_rows >= 0)
+        members = with_thumb[np.argsort(self.gallery_rows[with_thumb], kind='stable')]
+        thumb_rows = np.arange(self.count)
+        starts = np.searchsorted(self.gallery_rows[members], thumb_rows, 'left')
+        counts = np.searchsorted(self.gallery_rows[members], thumb_rows, 'right') - starts
+
+        shared = np.flatnonzero(counts > 1)
+        rows_a = np.concatenate((rows_a, shared))
+        rows_b = np.concatenate((rows_b, shared))
+        distances = np.concatenate((distances, np.zeros(len(shared), dtype=distances.dtype)))
+
+        # One entry per (gallery of a, gallery of b) combination
+        width = counts[rows_b]
+        sizes = counts[rows_a] * width
+        pair = np.repeat(np.arange(len(rows_a)), sizes)
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        left = members[starts[rows_a][pair] + offsets // width[pair]]
+        right = members[starts[rows_b][pair] + offsets % width[pair]]
+        distances = distances[pair]
+
+        # Pairs within a shared thumb are found both ways round
+        keep = np.where(rows_a[pair] == rows_b[pair], left < right, left != right)
+        if page_tolerance is not None:
+            keep &= np.abs(self.gallery_filecounts[left] - self.gallery_filecounts[right]) <= page_tolerance
+        gids = np.column_stack((self.gallery_gids[left[keep]], self.gallery_gids[right[keep]]))
+        return gids, distances[keep]
+
+    def candidate_pairs(self, full=False, page_tolerance=None, **kwargs):
+        '''
+        Thumb pairs expanded to galleries, keyword arguments are passed through. Thumbs
+        without a dhash, e.g. vectorized before it was stored, are compared by cosine
+        distance to every row until backfill-dhash has hashed them.
+        :param full: Add the all_pairs search to the hash candidates, to also find
+                     near-duplicates whose hashes differ, e.g. re-cropped covers
+
+        :return: ((m, 2) array of (gid, candidate gid), distances)
+        '''
+
+        rows_a, rows_b, distances = self.hash_pairs(threshold=kwargs.get('threshold'))
+        unhashed = np.flatnonzero(~self.hashed[:self.count]) if self.count else np.empty(0, dtype=np.int64)
+        if not full and len(unhashed):
+            logger.info(f'{len(unhashed)} thumbs have no dhash, searching them by cosine distance')
+            kwargs['rows'] = unhashed
+        if full or len(unhashed):
+            found = self.all_pairs(**kwargs)
+            rows_a = np.concatenate((rows_a, found[0]))
+            rows_b = np.concatenate((rows_b, found[1]))
+            distances = np.concatenate((distances, found[2]))
+
+        gids, distances = self.gallery_pairs(rows_a, rows_b, distances, page_tolerance)
+        logger.info(f'Found {len(gids)} candidate pairs among {len(self.gallery_gids)} galleries')
+        return gids, distances
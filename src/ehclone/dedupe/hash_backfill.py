@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.core.thumb_store import ThumbStore
+from ehclone.db.crud.thumb import get_unhashed_thumbs, update_thumb_hashes
+from ehclone.dedupe.phash import dhash
+
+
+BATCH_SIZE = 5000
+
+
+def _hash_file(path):
+    try:
+        with Image.open(path) as image:
+            # Same conversion as BaseVectorizer._load, so that hashes match the ones stored with vectors
+            return dhash(image.convert('RGB'))
+    except Exception as e:
+        logger.warning(f'Failed to hash {path}: {e}')
+        return None
+
+
+def backfill_hashes(batch_size=BATCH_SIZE, workers=None):
+    '''
+    Compute the dhash of thumbs vectorized before it was stored, from the files in the
+    thumb store or still at their download path in thumb_dir. Thumbs without a local
+    file stay unhashed, dedupe-offline searches those by cosine distance instead.
+    :param workers: Decoding threads, defaults to vectorizer.decode_workers
+
+    :return: (number of thumbs hashed, number without a local file)
+    '''
+
+    thumb_dir = config.filter.dedupe.thumb_dir
+    if thumb_dir is None:
+        logger.error('filter.dedupe.thumb_dir is not set, there are no thumbs to hash')
+        return 0, 0
+
+    store = ThumbStore(thumb_dir)
+    hashed = 0
+    missing = 0
+    after = None
+    with ThreadPoolExecutor(max_workers=workers or config.vectorizer.decode_workers) as executor:
+        while True:
+            urls = get_unhashed_thumbs(batch_size, after)
+            if not urls:
+                break
+            after = urls[-1]
+
+            paths = store.find_many(urls)
+            missing += len(urls) - len(paths)
+            hashes = {
+                url: h for url, h in zip(paths, executor.map(_hash_file, paths.values()))
+                if h is not None
+            }
+            hashed += update_thumb_hashes(hashes)
+            logger.info(f'Hashed {hashed} thumbs, {missing} without a local file')
+
+    logger.info(f'dhash backfill complete, {hashed} thumbs hashed, {missing} without a local file')
+    return hashed, missing
@@ -0,0 +1,95 @@
+from itertools import combinations
+
+import numpy as np
+from PIL import Image
+
+
+HASH_SIZE = 8
+
+# Set bits of every byte value, for popcounts without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image):
+    '''
+    64-bit difference hash of a decoded image: one bit per horizontally adjacent
+    pixel pair of a 9x8 grayscale thumbnail, set where brightness increases
+
+    :return: the hash as a signed 64-bit int, the way thumb.dhash stores it
+    '''
+
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(np.packbits(bits).view('>i8')[0])
+
+
+def hamming_distance(a, b):
+    '''
+    Elementwise Hamming distance of two int64 hash arrays
+    '''
+
+    diff = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.int64)
+    return _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _flip_masks(bits, radius):
+    masks = [0]
+    for weight in range(1, radius + 1):
+        for positions in combinations(range(bits), weight):
+            masks.append(sum(1 << p for p in positions))
+    return masks
+
+
+def hamming_pairs(hashes, max_distance, chunks=4, max_bucket=None):
+    '''
+    All pairs of hashes within a Hamming distance by multi-index hashing. Pairs within
+    max_distance agree on one of the chunks up to max_distance // chunks bits, so each
+    chunk is looked up in a sorted index with every flip of that many bits.
+    :param hashes: int64 array of hashes
+    :param max_distance: Maximum Hamming distance
+    :param chunks: Number of substrings the 64 bits are split into
+    :param max_bucket: Skip lookups matching more hashes than this, blank and
+                       single-color thumbs otherwise pair with each other quadratically
+
+    :return: (index_a, index_b, distances) arrays with index_a < index_b
+    '''
+
+    hashes = np.asarray(hashes, dtype=np.int64)
+    codes = hashes.view(np.uint64)
+    n = len(codes)
+    radius = max_distance // chunks
+    bounds = np.linspace(0, 64, chunks + 1).astype(int)
+
+    found = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        keys = ((codes >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)).astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+
+        for mask in _flip_masks(hi - lo, radius):
+            query = keys ^ mask
+            start = np.searchsorted(sorted_keys, query, 'left')
+            counts = np.searchsorted(sorted_keys, query, 'right') - start
+            if max_bucket:
+                counts[counts > max_bucket] = 0
+            total = counts.sum()
+            if not total:
+                continue
+
+            left = np.repeat(np.arange(n), counts)
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            right = order[np.repeat(start, counts) + offsets]
+            keep = left < right
+            found.append(left[keep] * n + right[keep])
+
+    if not found:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # A pair close in several chunks is found once per chunk
+    keys = np.unique(np.concatenate(found))
+    index_a, index_b = keys // n, keys % n
+    distances = hamming_distance(hashes[index_a], hashes[index_b])
+    close = distances <= max_distance
+    return index_a[close], index_b[close], distances[close]
@@ -0,0 +1,252 @@
+import io
+import csv
+
+import numpy as np
+from sqlalchemy import select, func
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.db.entities import Gallery, Tag, gallery_tag
+from ehclone.db.session import session_generator
+from ehclone.dedupe.candidates import get_candidates_in_range
+
+
+LOAD_CHUNK = 50000
+WRITE_CHUNK = 10000
+
+
+def connected_components(n, a, b):
+    '''
+    Union-find over n nodes with the edges (a[i], b[i]), hooking and
+    compressing all edges at once with array operations
+
+    :return: array of the root (smallest member) of each node's component
+    '''
+
+    parent = np.arange(n)
+    while True:
+        pa = parent[a]
+        pb = parent[b]
+        lo = np.minimum(pa, pb)
+        hi = np.maximum(pa, pb)
+        pending = lo != hi
+        if not pending.any():
+            return parent
+        # Every hi is a root after compression, hook it to the smallest root it touches
+        np.minimum.at(parent, hi[pending], lo[pending])
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+
+
+def _load_attributes(session, gids):
+    '''
+    :return: rating, filecount, expunged arrays aligned with gids, and a
+             (len(gids), len(tags)) 0/1 matrix of the scored tags
+    '''
+
+    dedupe = config.filter.dedupe
+    scored_tags = list(dedupe.tag_biases) + [t for t in dedupe.expunged_tags if t not in dedupe.tag_biases]
+    tag_index = {t: i for i, t in enumerate(scored_tags)}
+
+    rating = np.zeros(len(gids), dtype=np.float64)
+    filecount = np.zeros(len(gids), dtype=np.float64)
+    expunged = np.zeros(len(gids), dtype=bool)
+    tags = np.zeros((len(gids), len(scored_tags)), dtype=np.float64)
+
+    position = {gid: i for i, gid in enumerate(gids.tolist())}
+    tag_str = func.concat(Tag.namespace, ':', Tag.name)
+
+    for start in range(0, len(gids), LOAD_CHUNK):
+        chunk = gids[start:start + LOAD_CHUNK].tolist()
+
+        rows = session.execute(
+            select(Gallery.gid, Gallery.rating, Gallery.filecount, Gallery.expunged)
+            .where(Gallery.gid.in_(chunk))
+        )
+        for gid, _rating, _filecount, _expunged in rows:
+            i = position[gid]
+            rating[i] = _rating or 0
+            filecount[i] = _filecount or 0
+            expunged[i] = bool(_expunged)
+
+        if scored_tags:
+            rows = session.execute(
+                select(gallery_tag.c.gallery_gid, tag_str)
+                .join(Tag, Tag.id == gallery_tag.c.tag_id)
+                .where(gallery_tag.c.gallery_gid.in_(chunk))
+                .where(tag_str.in_(scored_tags))
+            )
+            for gid, tag in rows:
+                tags[position[gid], tag_index[tag]] = 1
+
+    return rating, filecount, expunged, tags, scored_tags
+
+
+def score_galleries(labels, rating, filecount, expunged, tags, scored_tags):
+    '''
+    Score every gallery against the other members of its cluster, higher is better
+    '''
+
+    dedupe = config.filter.dedupe
+
+    # Page counts only matter relative to the most complete copy in the cluster
+    max_filecount = np.zeros(labels.max() + 1)
+    np.maximum.at(max_filecount, labels, filecount)
+
+    biases = np.array([dedupe.tag_biases.get(t, 0) for t in scored_tags], dtype=np.float64)
+    expunged_columns = np.array([t in dedupe.expunged_tags for t in scored_tags], dtype=bool)
+    if scored_tags:
+        tag_score = tags @ biases
+        expunged = expunged | tags[:, expunged_columns].any(axis=1)
+    else:
+        tag_score = np.zeros(len(labels))
+
+    return (
+        dedupe.rating_factor * rating
+        + dedupe.page_count_factor * (filecount - max_filecount[labels])
+        + tag_score
+        + np.where(expunged, dedupe.expunged_bias, 0)
+    )
+
+
+def _chain_ends(session, edges):
+    '''
+    Map every gid of edges to the end of its first_gid chain, the gallery that replaces it
+    '''
+
+    gids = np.unique(edges)
+    ends = gids.copy()
+    for start in range(0, len(gids), LOAD_CHUNK):
+        chunk = gids[start:start + LOAD_CHUNK].tolist()
+        rows = session.execute(
+            select(Gallery.gid, Gallery.dupe_with)
+            .where(Gallery.gid.in_(chunk))
+            .where(Gallery.dupe_with.isnot(None))
+        ).all()
+        if rows:
+            members, chain_ends = np.array(rows, dtype=np.int64).T
+            ends[np.searchsorted(gids, members)] = chain_ends
+    return ends[np.searchsorted(gids, edges)]
+
+
+def _write_cluster_best(session, gids, best, scope=None):
+    '''
+    Point cluster_best of every clustered gallery to its best in one statement, NULL for the
+    best itself, and clear the links in scope left over from earlier runs
+    :param scope: (min_gid, max_gid) the candidates were collected for, None for every gallery
+
+    :return: number of galleries updated
+    '''
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows((g, '' if g == b else b) for g, b in zip(gids.tolist(), best.tolist()))
+    buffer.seek(0)
+
+    if scope is None:
+        in_scope, params = 'TRUE', {}
+    else:
+        # Galleries in the range, or pointing to one, had all their candidates collected
+        in_scope = (
+            '(g.gid >= %(min_gid)s AND g.gid < %(max_gid)s '
+            'OR g.cluster_best >= %(min_gid)s AND g.cluster_best < %(max_gid)s)'
+        )
+        params = {'min_gid': scope[0], 'max_gid': scope[1]}
+
+    cursor = session.connection().connection.cursor()
+    cursor.execute('CREATE TEMP TABLE cluster_stage (gid bigint PRIMARY KEY, best bigint) ON COMMIT DROP')
+    cursor.copy_expert('COPY cluster_stage (gid, best) FROM STDIN WITH (FORMAT CSV)', buffer)
+    cursor.execute('ANALYZE cluster_stage')
+    cursor.execute(f'''
+        UPDATE gallery SET cluster_best = s.best
+        FROM (
+            SELECT gid, best FROM cluster_stage
+            UNION ALL
+            SELECT g.gid, NULL::bigint FROM gallery g
+            WHERE g.cluster_best IS NOT NULL AND {in_scope}
+            AND NOT EXISTS (SELECT 1 FROM cluster_stage c WHERE c.gid = g.gid)
+        ) s
+        WHERE gallery.gid = s.gid AND gallery.cluster_best IS DISTINCT FROM s.best
+    ''', params)
+    return cursor.rowcount
+
+
+def resolve_clusters(pairs, scope=None):
+    '''
+    Group candidate pairs into clusters and point cluster_best of every member to the best one.
+    Older galleries of a first_gid chain stand for the chain end, so chains and clusters never
+    point at each other in a loop.
+    :param pairs: Iterable of (gid, candidate_gid, ...) from the candidate engine,
+                  or an (m, 2) array from EmbeddingStore.candidate_pairs
+    :param scope: (min_gid, max_gid) the pairs were collected for, links of galleries in
+                  scope that are no longer clustered are cleared. None for every gallery.
+
+    :return: (number of clusters, number of galleries updated)
+    '''
+
+    if isinstance(pairs, np.ndarray):
+        edges = pairs[:, :2].astype(np.int64)
+    else:
+        edges = np.array([(p[0], p[1]) for p in pairs], dtype=np.int64).reshape(-1, 2)
+
+    with session_generator() as session:
+        if len(edges):
+            edges = _chain_ends(session, edges)
+            edges = edges[edges[:, 0] != edges[:, 1]]
+        if not len(edges):
+            return 0, _write_cluster_best(session, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), scope)
+
+        gids, inverse = np.unique(edges, return_inverse=True)
+        inverse = inverse.reshape(-1, 2)
+        roots = connected_components(len(gids), inverse[:, 0], inverse[:, 1])
+        _, labels = np.unique(roots, return_inverse=True)
+
+        attributes = _load_attributes(session, gids)
+        scores = score_galleries(labels, *attributes)
+
+        # Best score wins, ties go to the newest gid like first_gid chains
+        order = np.lexsort((gids, scores, labels))
+        last = np.r_[labels[order][1:] != labels[order][:-1], True]
+        best_of_label = np.empty(labels.max() + 1, dtype=np.int64)
+        best_of_label[labels[order][last]] = gids[order][last]
+
+        updated = _write_cluster_best(session, gids, best_of_label[labels], scope)
+
+    return labels.max() + 1, updated
+
+
+def dedupe_range(min_gid, max_gid, step=100000):
+    '''
+    Collect candidates for min_gid <= gid < max_gid in steps, then resolve all clusters at once
+    '''
+
+    pairs = []
+    for start in range(min_gid, max_gid, step):
+        batch = get_candidates_in_range(start, min(start + step, max_gid))
+        pairs.extend(batch)
+        logger.info(f'Collected {len(batch)} candidate pairs for gids {start}-{min(start + step, max_gid)}')
+
+    clusters, updated = resolve_clusters(pairs, scope=(min_gid, max_gid))
+    logger.info(f'Resolved {clusters} clusters, {updated} galleries updated')
+    return clusters, updated
+
+
+def dedupe_offline(store=None, sync=True, full=False, **kwargs):
+    '''
+    Resolve clusters from the memory-mapped embeddings, the perceptual hashes first
+    and the all-pairs cosine search with full, or only for the thumbs without a dhash
+    otherwise. Keyword arguments are passed to EmbeddingStore.all_pairs
+    '''
+
+    from ehclone.dedupe.embeddings import EmbeddingStore
+
+    store = store or EmbeddingStore()
+    if sync:
+        store.sync()
+    pairs, _ = store.candidate_pairs(full=full, **kwargs)
+
+    clusters, updated = resolve_clusters(pairs)
+    logger.info(f'Resolved {clusters} clusters, {updated} galleries updated')
+    return clusters, updated
@@ -1,11 +1,20 @@
 import time
+from queue import Queue, Empty
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from ehclone.config import config
 from ehclone.logger import logger
+from ehclone.downloader.aria2_notifier import Aria2Notifier
 
 
 class Aria2Client:
+    # Calls packed into a single system.multicall request
+    MULTICALL_LIMIT = 1000
+    STATUS_KEYS = ['gid', 'status']
+    FINISHED_STATES = {'complete', 'error', 'removed'}
+
     def __init__(self):
         self.url = config.aria2.url
         self.token = config.aria2.token
@@ -14,7 +23,62 @@ class Aria2Client:
         if self.token:
             self.base_params.append(f'token:{self.token}')
 
-    def add_task(self, url, out, prioritize=False):
+        # Keep-alive connections shared by every call
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=4))
+
+        self.notifier = None
+        if config.aria2.notifications:
+            self.notifier = Aria2Notifier(config.aria2.ws_url or Aria2Notifier.ws_url(self.url))
+
+    def _post(self, method, params):
+        rpc_params = {
+            'jsonrpc': '2.0',
+            'id': 'ehclone',
+            'method': method,
+            'params': params,
+        }
+        res = self.session.post(self.url, json=rpc_params)
+        res.raise_for_status()
+        return res.json()
+
+    def call(self, method, params):
+        '''
+        Call a single aria2 method
+        :return: the JSON-RPC response, with either 'result' or 'error'
+        '''
+
+        return self._post(method, self.base_params + params)
+
+    def multicall(self, calls):
+        '''
+        Call many aria2 methods with as few system.multicall requests as possible
+        :param calls: list of (method, params)
+
+        :return: list of {'result': ...} or {'error': ...}, aligned with calls
+        '''
+
+        responses = []
+        for i in range(0, len(calls), self.MULTICALL_LIMIT):
+            chunk = calls[i:i + self.MULTICALL_LIMIT]
+            result = self._post('system.multicall', [[
+                {'methodName': method, 'params': self.base_params + params}
+                for method, params in chunk
+            ]])
+            if 'error' in result:
+                responses.extend({'error': result['error']} for _ in chunk)
+                continue
+
+            # Each entry is [value] on success or a fault struct on failure
+            for r in result['result']:
+                if isinstance(r, list):
+                    responses.append({'result': r[0]})
+                else:
+                    responses.append({'error': r})
+        return responses
+
+    def _add_params(self, url, out, prioritize):
         options = {
             'out': str(out),
             'dir': self.base_dir,
@@ -27,84 +91,189 @@ class Aria2Client:
 
         if prioritize:
             params.append(0)
+        return params
 
-        rpc_params = {
-            'jsonrpc': '2.0',
-            'id': 'ehclone',
-            'method': 'aria2.addUri',
-            'params': self.base_params + params
-        }
+    def add_tasks(self, tasks, prioritize=False):
+        '''
+        Add many downloads at once
+        :param tasks: list of (url, out)
 
-        try:
-            res = requests.post(self.url, json=rpc_params)
-            res.raise_for_status()
-            result = res.json()
-            if 'error' in result:
-                logger.error(f'Aria2 error: {result['error']}')
-                return None
-            else:
-                logger.info(f'Added to Aria2: {result['result']}')
-                return result['result']
+        :return: list of task IDs aligned with tasks, None for those that failed
+        '''
 
+        calls = [('aria2.addUri', self._add_params(url, out, prioritize)) for url, out in tasks]
+        try:
+            responses = self.multicall(calls)
         except Exception as e:
             logger.error(f'Failed to send to Aria2: {e}')
-            return None
+            return [None] * len(tasks)
 
-    def get_status(self, task_id):
-        params = [
-            task_id,
-            [ 'gid', 'status']
-        ]
+        task_ids = []
+        for (url, _), response in zip(tasks, responses):
+            if 'error' in response:
+                logger.error(f'Aria2 error for {url}: {response["error"]}')
+                task_ids.append(None)
+            else:
+                task_ids.append(response['result'])
+        logger.info(f'Added {sum(t is not None for t in task_ids)}/{len(tasks)} tasks to Aria2')
+        return task_ids
 
-        rpc_params = {
-            'jsonrpc': '2.0',
-            'id': 'ehclone',
-            'method': 'aria2.tellStatus',
-            'params': self.base_params + params
-        }
+    def add_task(self, url, out, prioritize=False):
+        return self.add_tasks([(url, out)], prioritize=prioritize)[0]
 
-        try:
-            res = requests.post(self.url, json=rpc_params)
-            result = res.json()
-            return result
+    def get_statuses(self, task_ids, keys=None):
+        '''
+        :return: dict of task ID to {'result': status} or {'error': ...}, empty on failure
+        '''
 
+        keys = keys or self.STATUS_KEYS
+        task_ids = list(task_ids)
+        try:
+            responses = self.multicall([('aria2.tellStatus', [task_id, keys]) for task_id in task_ids])
         except Exception as e:
             logger.error(f'Error checking aria2 status: {e}')
-            return None
+            return {}
+        return dict(zip(task_ids, responses))
 
-    def wait_for_tasks(self, task_ids, timeout=None):
-        remaining = set(task_ids)
-        results = {}
+    def get_status(self, task_id):
+        return self.get_statuses([task_id]).get(task_id)
+
+    def tell_active(self, keys=None):
+        return self.call('aria2.tellActive', [keys or self.STATUS_KEYS]).get('result', [])
+
+    def tell_waiting(self, offset=0, num=1000, keys=None):
+        return self.call('aria2.tellWaiting', [offset, num, keys or self.STATUS_KEYS]).get('result', [])
+
+    def tell_stopped(self, offset=0, num=1000, keys=None):
+        return self.call('aria2.tellStopped', [offset, num, keys or self.STATUS_KEYS]).get('result', [])
+
+    def _poll_finished(self, task_ids):
+        finished = {}
+        for task_id, status in self.get_statuses(task_ids).items():
+            result = status.get('result') or {}
+            if 'error' in status or result.get('status') in self.FINISHED_STATES:
+                finished[task_id] = status
+        return finished
+
+    def completion_stream(self):
+        return CompletionStream(self)
+
+    def iter_completed(self, task_ids, timeout=None):
+        '''
+        Yield tasks as soon as they finish
+        :param task_ids: The task IDs to wait for
+        :param timeout: Seconds to wait before giving up on the rest
+
+        :return: generator of (task ID, {'result': status} or {'error': ...})
+        '''
+
+        stream = self.completion_stream()
+        stream.add(task_ids)
         start_time = time.time()
+        try:
+            while stream.pending:
+                remaining_time = None
+                if timeout is not None:
+                    remaining_time = timeout - (time.time() - start_time)
+                    if remaining_time <= 0:
+                        logger.error(f'Timeout waiting for aria2 tasks: {stream.pending}')
+                        break
+                yield from stream.next_batch(timeout=remaining_time).items()
+        finally:
+            stream.close()
 
-        while remaining:
-            for task_id in list(remaining):
-                status = self.get_status(task_id)
-                if not status:
-                    continue
+    def wait_for_tasks(self, task_ids, timeout=None):
+        results = dict(self.iter_completed(task_ids, timeout=timeout))
+        remaining = set(task_ids) - results.keys()
+        return results, remaining
 
-                if 'error' in status:
-                    results[task_id] = status
-                    remaining.remove(task_id)
-                    continue
 
-                result = status.get('result') or {}
-                state = result.get('status')
+class CompletionStream:
+    '''
+    A set of aria2 tasks that can grow while waiting, finished tasks are
+    reported as soon as their notification arrives. Falls back to polling
+    every poll_interval while the socket is down, and polls every
+    safety_poll_interval otherwise for missed events.
+    '''
 
-                if state in {'complete', 'error', 'removed'}:
-                    results[task_id] = status
-                    remaining.remove(task_id)
+    def __init__(self, client):
+        self.client = client
+        self.pending = set()
+        self.events = Queue()
+        self.last_poll = 0
+        self.poll_at = 0
 
-            if not remaining:
-                break
+    def _on_event(self, task_id, state):
+        self.events.put((task_id, {'result': {'gid': task_id, 'status': state}}))
+
+    def _connected(self):
+        notifier = self.client.notifier
+        return notifier is not None and notifier.connected.is_set()
 
-            if timeout is not None and time.time() - start_time > timeout:
-                logger.error(f'Timeout waiting for aria2 tasks: {remaining}')
+    def add(self, task_ids):
+        task_ids = set(task_ids)
+        self.pending |= task_ids
+        if self.client.notifier is not None:
+            for task_id in task_ids:
+                self.client.notifier.subscribe(task_id, self._on_event)
+        # Catch tasks that finished before they were subscribed
+        self.poll_at = min(self.poll_at, time.time() + 1)
+
+    def close(self):
+        if self.client.notifier is not None:
+            for task_id in self.pending:
+                self.client.notifier.unsubscribe(task_id)
+        self.pending.clear()
+
+    def next_batch(self, timeout=None):
+        '''
+        Block until at least one pending task finished
+        :param timeout: Seconds to wait, None to wait until something finishes
+
+        :return: dict of task ID to {'result': status} or {'error': ...}, empty on timeout
+        '''
+
+        deadline = None if timeout is None else time.time() + timeout
+        finished = {}
+        while self.pending and not finished:
+            now = time.time()
+            if not self._connected():
+                self.poll_at = min(self.poll_at, self.last_poll + config.aria2.poll_interval)
+
+            if now >= self.poll_at:
+                self.last_poll = now
+                if self._connected():
+                    self.poll_at = now + config.aria2.safety_poll_interval
+                else:
+                    self.poll_at = now + config.aria2.poll_interval
+                finished = self.client._poll_finished(self.pending)
+                continue
+
+            if deadline is not None and now >= deadline:
                 break
 
-            time.sleep(config.aria2.poll_interval)
+            # Wake up at least every poll_interval to notice a dropped socket
+            wait = min(self.poll_at - now, config.aria2.poll_interval)
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            try:
+                event = self.events.get(timeout=max(wait, 0))
+            except Empty:
+                continue
+            while event is not None:
+                task_id, status = event
+                if task_id in self.pending:
+                    finished[task_id] = status
+                try:
+                    event = self.events.get_nowait()
+                except Empty:
+                    event = None
 
-        return results, remaining
+        self.pending -= finished.keys()
+        if self.client.notifier is not None:
+            for task_id in finished:
+                self.client.notifier.unsubscribe(task_id)
+        return finished
 
 
 aria2 = Aria2Client()
@@ -0,0 +1,107 @@
+import json
+from threading import Thread, Event, Lock
+from urllib.parse import urlparse
+
+import websocket
+
+from ehclone.logger import logger
+
+
+class Aria2Notifier:
+    '''
+    Listen to aria2 download notifications over its WebSocket RPC endpoint.
+    Reconnects with backoff when the socket drops; connected is cleared
+    meanwhile so that waiters can fall back to polling.
+    '''
+
+    EVENTS = {
+        'aria2.onDownloadComplete':   'complete',
+        'aria2.onBtDownloadComplete': 'complete',
+        'aria2.onDownloadError':      'error',
+        'aria2.onDownloadStop':       'removed',
+    }
+    RECV_TIMEOUT = 60
+    MAX_BACKOFF = 60
+
+    def __init__(self, url):
+        self.url = url
+        self.connected = Event()
+        self._closed = Event()
+        self._listeners = {}
+        self._lock = Lock()
+        self._thread = None
+
+    @staticmethod
+    def ws_url(rpc_url):
+        parsed = urlparse(rpc_url)
+        scheme = 'wss' if parsed.scheme == 'https' else 'ws'
+        return parsed._replace(scheme=scheme).geturl()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='aria2-notifier', daemon=True)
+                self._thread.start()
+
+    def close(self):
+        self._closed.set()
+
+    def subscribe(self, task_id, callback):
+        '''
+        :param callback: Called as callback(task_id, state) from the listener thread
+        '''
+
+        self.start()
+        with self._lock:
+            self._listeners[task_id] = callback
+
+    def unsubscribe(self, task_id):
+        with self._lock:
+            self._listeners.pop(task_id, None)
+
+    def _dispatch(self, message):
+        state = self.EVENTS.get(message.get('method'))
+        if state is None:
+            return
+        for event in message.get('params', []):
+            task_id = event.get('gid')
+            with self._lock:
+                callback = self._listeners.pop(task_id, None)
+            if callback is not None:
+                try:
+                    callback(task_id, state)
+                except Exception as e:
+                    logger.exception(e)
+
+    def _run(self):
+        backoff = 1
+        while not self._closed.is_set():
+            ws = None
+            try:
+                ws = websocket.create_connection(self.url, timeout=self.RECV_TIMEOUT)
+                self.connected.set()
+                logger.info(f'Connected to aria2 notifications at {self.url}')
+                backoff = 1
+                while not self._closed.is_set():
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        ws.ping()
+                        continue
+                    if message:
+                        self._dispatch(json.loads(message))
+            except Exception as e:
+                if self.connected.is_set():
+                    logger.warning(f'Aria2 notification socket dropped: {e}')
+                else:
+                    logger.debug(f'Failed to connect to aria2 notifications: {e}')
+            finally:
+                self.connected.clear()
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+
+            self._closed.wait(backoff)
+            backoff = min(backoff * 2, self.MAX_BACKOFF)
@@ -1,3 +1,6 @@
+from pathlib import Path
+from argparse import ArgumentParser
+
 from sqlalchemy import text
 from sqlalchemy_utils import database_exists, create_database
 
@@ -5,17 +8,215 @@ from ehclone.config import config
 from ehclone.logger import logger
 from ehclone.db.entities import Base
 from ehclone.db.session import engine
-from ehclone.core.sync_index import sync_index
-from ehclone.core.sync_thumbs import sync_thumbs
+from ehclone.db.migrate import upgrade
 
 
-if __name__ == '__main__':
+def init_db():
     if not database_exists(engine.url):
         logger.info('Database does not exist, creating...')
         create_database(engine.url)
     with engine.begin() as connection:
         connection.execute(text('CREATE EXTENSION IF NOT EXISTS vector'))
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        upgrade(connection)
+
+
+def cmd_sync(args):
+    from ehclone.core.sync_index import sync_index
+    from ehclone.core.sync_thumbs import sync_thumbs
 
     sync_index()
+    if config.eh.refresh.enabled:
+        from ehclone.core.refresh import refresh_galleries
+
+        refresh_galleries()
     sync_thumbs()
+
+
+def cmd_import(args):
+    from ehclone.core.importer import import_dumps
+
+    import_dumps(args.paths, batch_size=args.batch_size)
+
+
+def cmd_replay(args):
+    from ehclone.core.replay import replay
+
+    replay(batch_size=args.batch_size)
+
+
+def cmd_prune_responses(args):
+    from ehclone.core.response_store import ResponseStore
+
+    if config.eh.response_store is None:
+        logger.warning('eh.response_store is not set, nothing to prune.')
+        return
+    listing_age = None if args.listing_days is None else args.listing_days * 86400
+    gdata_age = None if args.gdata_days is None else args.gdata_days * 86400
+    listing, gdata = ResponseStore(config.eh.response_store).prune(listing_age, gdata_age)
+    logger.info(f'Pruned {listing} listing bodies and {gdata} gdata entries')
+
+
+def cmd_refresh(args):
+    from ehclone.core.refresh import refresh_galleries
+
+    refresh_galleries(max_galleries=args.limit)
+
+
+def cmd_backfill(args):
+    from ehclone.core.backfill import backfill, coverage_report
+
+    if args.report:
+        coverage_report(expunged=args.expunged)
+        return
+    backfill(expunged=args.expunged, shards=args.shards, workers=args.workers)
+
+
+def cmd_rebuild_chains(args):
+    from ehclone.db.crud.gallery import rebuild_chains
+
+    rebuild_chains()
+
+
+def cmd_build_ann_index(args):
+    from ehclone.dedupe.candidates import build_ann_index
+
+    build_ann_index()
+
+
+def cmd_dedupe(args):
+    from ehclone.db.crud.gallery import get_last_gid
+    from ehclone.dedupe.resolver import dedupe_range
+
+    if not config.filter.dedupe.enabled:
+        logger.warning('Dedupe is disabled in the config.')
+        return
+    max_gid = args.max_gid or get_last_gid() + 1
+    dedupe_range(args.min_gid, max_gid, step=args.step)
+
+
+def cmd_export_embeddings(args):
+    from ehclone.dedupe.embeddings import EmbeddingStore
+
+    EmbeddingStore().sync()
+
+
+def cmd_backfill_dhash(args):
+    from ehclone.dedupe.hash_backfill import backfill_hashes
+
+    backfill_hashes(batch_size=args.batch_size)
+
+
+def cmd_dedupe_offline(args):
+    from ehclone.dedupe.resolver import dedupe_offline
+
+    if not config.filter.dedupe.enabled:
+        logger.warning('Dedupe is disabled in the config.')
+        return
+    dedupe_offline(sync=not args.no_sync, full=args.full, threshold=args.threshold)
+
+
+def cmd_export_onnx(args):
+    from ehclone.vectorizer.mobile_net_v3 import Vectorizer
+    from ehclone.vectorizer.onnx_mobile_net_v3 import quantize
+
+    Vectorizer().export_onnx(config.vectorizer.onnx_model)
+    quantize(config.vectorizer.onnx_model)
+
+
+def cmd_bench_vectorizer(args):
+    from ehclone.vectorizer.benchmark import bench_vectorizers
+
+    bench_vectorizers(args.image_dir, limit=args.limit)
+
+
+def cmd_bench_listing(args):
+    from ehclone.core.listing_benchmark import bench_listing_parsers
+
+    bench_listing_parsers(args.html_dir, repeat=args.repeat)
+
+
+def main():
+    parser = ArgumentParser(prog='ehclone')
+    parser.set_defaults(func=cmd_sync)
+    parser.add_argument('--offline', action='store_true', help='Serve EH requests from the response store only')
+    subparsers = parser.add_subparsers()
+
+    sync_parser = subparsers.add_parser('sync', help='Sync the gallery index and thumbnails (default)')
+    sync_parser.set_defaults(func=cmd_sync)
+
+    import_parser = subparsers.add_parser('import', help='Bulk load gdata JSONL dumps, optionally compressed')
+    import_parser.add_argument('paths', type=Path, nargs='+', help="Dump files, '-' for stdin")
+    import_parser.add_argument('--batch-size', type=int, default=None)
+    import_parser.set_defaults(func=cmd_import)
+
+    replay_parser = subparsers.add_parser('replay', help='Ingest every stored gdata response again, offline')
+    replay_parser.add_argument('--batch-size', type=int, default=1000)
+    replay_parser.set_defaults(func=cmd_replay)
+
+    prune_parser = subparsers.add_parser('prune-responses', help='Delete old responses from eh.response_store')
+    prune_parser.add_argument('--listing-days', type=int, default=None, help='Keep listing bodies this many days')
+    prune_parser.add_argument('--gdata-days', type=int, default=None, help='Keep gdata entries this many days')
+    prune_parser.set_defaults(func=cmd_prune_responses, db=False)
+
+    refresh_parser = subparsers.add_parser('refresh', help='Fetch the metadata of stale galleries again')
+    refresh_parser.add_argument('--limit', type=int, default=None, help='Maximum galleries to refresh')
+    refresh_parser.set_defaults(func=cmd_refresh)
+
+    backfill_parser = subparsers.add_parser('backfill', help='Crawl the gid space as concurrent ranges')
+    backfill_parser.add_argument('--expunged', action='store_true', help='Include expunged galleries')
+    backfill_parser.add_argument('--shards', type=int, default=None)
+    backfill_parser.add_argument('--workers', type=int, default=None)
+    backfill_parser.add_argument('--report', action='store_true', help='Print the coverage of the ranges and exit')
+    backfill_parser.set_defaults(func=cmd_backfill)
+
+    chains_parser = subparsers.add_parser('rebuild-chains', help='Recompute dupe_with of all first_gid chains')
+    chains_parser.set_defaults(func=cmd_rebuild_chains)
+
+    ann_parser = subparsers.add_parser('build-ann-index', help='Create the HNSW index on thumb vectors')
+    ann_parser.set_defaults(func=cmd_build_ann_index)
+
+    dedupe_parser = subparsers.add_parser('dedupe', help='Cluster near-duplicate galleries and set cluster_best')
+    dedupe_parser.add_argument('--min-gid', type=int, default=1)
+    dedupe_parser.add_argument('--max-gid', type=int, default=None)
+    dedupe_parser.add_argument('--step', type=int, default=100000)
+    dedupe_parser.set_defaults(func=cmd_dedupe)
+
+    embeddings_parser = subparsers.add_parser('export-embeddings', help='Sync thumb vectors to the memory-mapped store')
+    embeddings_parser.set_defaults(func=cmd_export_embeddings)
+
+    dhash_parser = subparsers.add_parser('backfill-dhash', help='Hash stored thumbs vectorized before dhash existed')
+    dhash_parser.add_argument('--batch-size', type=int, default=5000)
+    dhash_parser.set_defaults(func=cmd_backfill_dhash)
+
+    offline_parser = subparsers.add_parser('dedupe-offline', help='Dedupe with the exported hashes and vectors')
+    offline_parser.add_argument('--threshold', type=float, default=None)
+    offline_parser.add_argument('--no-sync', action='store_true')
+    offline_parser.add_argument('--full', action='store_true', help='Also run the all-pairs cosine search')
+    offline_parser.set_defaults(func=cmd_dedupe_offline)
+
+    export_parser = subparsers.add_parser('export-onnx', help='Export the vectorizer to ONNX with an int8 copy')
+    export_parser.set_defaults(func=cmd_export_onnx, db=False)
+
+    bench_parser = subparsers.add_parser('bench-vectorizer', help='Compare vectorizer backends on a directory of images')
+    bench_parser.add_argument('image_dir', type=Path)
+    bench_parser.add_argument('--limit', type=int, default=1000)
+    bench_parser.set_defaults(func=cmd_bench_vectorizer, db=False)
+
+    listing_parser = subparsers.add_parser('bench-listing', help='Compare listing page parsers on saved HTML pages')
+    listing_parser.add_argument('html_dir', type=Path)
+    listing_parser.add_argument('--repeat', type=int, default=20)
+    listing_parser.set_defaults(func=cmd_bench_listing, db=False)
+
+    args = parser.parse_args()
+    if args.offline:
+        config.eh.offline = True
+
+    if getattr(args, 'db', True):
+        init_db()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+from ehclone.config import config
+
+
+def load_vectorizer(backend=None):
+    '''
+    :param backend: 'torch' or 'onnx', defaults to config.vectorizer.backend
+    '''
+
+    backend = backend or config.vectorizer.backend
+    if backend == 'onnx':
+        from ehclone.vectorizer.onnx_mobile_net_v3 import OnnxVectorizer
+        return OnnxVectorizer()
+    if backend == 'torch':
+        from ehclone.vectorizer.mobile_net_v3 import Vectorizer
+        return Vectorizer()
+    raise ValueError(f'Unknown vectorizer backend: {backend}')
+
+
+vectorizer = load_vectorizer()
@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.dedupe.phash import dhash
+
+
+class BaseVectorizer:
+    '''
+    Shared batching for thumbnail vectorizers, backends implement _preprocess and _infer
+    '''
+
+    DIM = 576
+
+    def _init_executor(self):
+        self.batch_size = config.vectorizer.batch_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.vectorizer.decode_workers,
+            thread_name_prefix='vectorizer',
+        )
+
+    def _preprocess(self, image):
+        '''
+        :param image: Decoded RGB PIL image
+
+        :return: the preprocessed image ready to be stacked into a batch
+        '''
+        raise NotImplementedError
+
+    def _load(self, image_path):
+        '''
+        Decode an image once for both the model input and the perceptual hash
+
+        :return: (preprocessed image, dhash)
+        '''
+
+        with Image.open(image_path) as image:
+            image = image.convert('RGB')
+        return self._preprocess(image), dhash(image)
+
+    def _infer(self, images):
+        '''
+        :param images: list of preprocessed images
+
+        :return: array of shape (len(images), DIM)
+        '''
+        raise NotImplementedError
+
+    def _safe_load(self, image_path):
+        try:
+            return self._load(image_path)
+        except Exception as e:
+            logger.error(f'Error loading {image_path}: {e}')
+            return None
+
+    def encode_batch_with_hashes(self, image_paths):
+        '''
+        Vectorize many images, decoding in a thread pool and running the model on stacked batches
+        :param image_paths: Paths of the images
+
+        :return: (vectors, hashes), vectors a float32 array of shape (len(image_paths), DIM)
+                 with L2-normalized rows, NaN for images that could not be vectorized,
+                 hashes a list of dhash values, None for images that could not be decoded
+        '''
+
+        image_paths = [str(p) for p in image_paths]
+        vectors = np.full((len(image_paths), self.DIM), np.nan, dtype=np.float32)
+        hashes = [None] * len(image_paths)
+
+        for start in range(0, len(image_paths), self.batch_size):
+            chunk = image_paths[start:start + self.batch_size]
+            loaded = list(self.executor.map(self._safe_load, chunk))
+            rows = [i for i, image in enumerate(loaded) if image is not None]
+            if not rows:
+                continue
+            for i in rows:
+                hashes[start + i] = loaded[i][1]
+
+            try:
+                features = self._infer([loaded[i][0] for i in rows])
+                features = np.asarray(features, dtype=np.float32).reshape(len(rows), -1)
+            except Exception as e:
+                logger.error(f'Error vectorizing batch starting with {chunk[0]}: {e}')
+                continue
+
+            norms = np.linalg.norm(features, axis=1, keepdims=True)
+            for i, norm in zip(rows, norms[:, 0]):
+                if norm == 0:
+                    logger.error(f'Error vectorizing {chunk[i]}: Vector norm is zero')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                features = np.where(norms > 0, features / norms, np.nan)
+            vectors[[start + i for i in rows]] = features
+
+        return vectors, hashes
+
+    def encode_batch(self, image_paths):
+        '''
+        encode_batch_with_hashes without the hashes
+        '''
+
+        return self.encode_batch_with_hashes(image_paths)[0]
+
+    def encode(self, image_path):
+        vector = self.encode_batch([image_path])[0]
+        if np.isnan(vector).any():
+            return None
+        return vector.tolist()
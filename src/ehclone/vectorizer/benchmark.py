@@ -0,0 +1,66 @@
+from time import perf_counter
+
+import numpy as np
+from tabulate import tabulate
+
+from ehclone.config import config
+from ehclone.logger import logger
+
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def bench_vectorizers(image_dir, limit=1000):
+    '''
+    Compare the vectorizer backends on the images under image_dir: throughput,
+    resident memory after each backend ran, and cosine agreement with torch.
+    ONNX backends run first so that their RSS is not inflated by torch.
+    '''
+
+    from ehclone.vectorizer.onnx_mobile_net_v3 import OnnxVectorizer, quantized_path
+    from ehclone.vectorizer.mobile_net_v3 import Vectorizer
+
+    paths = sorted(p for p in image_dir.rglob('*') if p.suffix.lower() in IMAGE_SUFFIXES)[:limit]
+    if not paths:
+        logger.error(f'No images found in {image_dir}')
+        return
+
+    backends = [
+        ('onnx', lambda: OnnxVectorizer(config.vectorizer.onnx_model)),
+        ('onnx-int8', lambda: OnnxVectorizer(quantized_path(config.vectorizer.onnx_model))),
+        ('torch', Vectorizer),
+    ]
+
+    results = {}
+    for name, factory in backends:
+        try:
+            backend = factory()
+        except Exception as e:
+            logger.warning(f'Skipping {name}: {e}')
+            continue
+        backend.encode_batch(paths[:backend.batch_size])
+        start = perf_counter()
+        vectors = backend.encode_batch(paths)
+        elapsed = perf_counter() - start
+        results[name] = (vectors, len(paths) / elapsed, rss_mb())
+
+    reference = results.get('torch', (None,))[0]
+    rows = []
+    for name, (vectors, rate, rss) in results.items():
+        agreement = ['-', '-']
+        if reference is not None:
+            valid = ~(np.isnan(vectors).any(axis=1) | np.isnan(reference).any(axis=1))
+            cosine = np.sum(vectors[valid] * reference[valid], axis=1)
+            if len(cosine):
+                agreement = [f'{cosine.min():.5f}', f'{cosine.mean():.5f}']
+        rows.append([name, f'{rate:.1f}', f'{rss:.0f}', *agreement])
+
+    print(tabulate(rows, headers=['backend', 'images/s', 'RSS MB', 'min cos', 'mean cos']))
@@ -1,10 +1,14 @@
-import numpy as np
+import json
+
+import torch
+from torchvision import transforms
 from imagededup.methods import CNN
 
 from ehclone.config import config
 from ehclone.logger import logger
+from ehclone.vectorizer.base import BaseVectorizer
 
-class Vectorizer:
+class Vectorizer(BaseVectorizer):
     _instance = None
 
     def __new__(cls):
@@ -14,21 +18,65 @@ class Vectorizer:
         return cls._instance
 
     def _init_model(self):
+        if config.vectorizer.torch_threads:
+            torch.set_num_threads(config.vectorizer.torch_threads)
         self.cnn = CNN()
-        logger.info('Initialized MobileNetV3 vectorizer.')
-
-    def encode(self, image_path):
-        try:
-            image_path = str(image_path)
-            vector = self.cnn.encode_image(image_file=image_path)
-            vector = vector.flatten()
-            norm = np.linalg.norm(vector)
-            if norm == 0:
-                raise ValueError('Vector norm is zero')
-            return (vector / norm).tolist()
-        except Exception as e:
-            logger.error(f'Error vectorizing {image_path}: {e}')
-            return None
-
-
-vectorizer = Vectorizer()
+        self._init_executor()
+        logger.info(f'Initialized MobileNetV3 vectorizer with {torch.get_num_threads()} torch threads.')
+
+    def _preprocess(self, image):
+        return self.cnn.transform(image)
+
+    def _infer(self, images):
+        batch = torch.stack(images).to(self.cnn.device)
+        with torch.no_grad():
+            features = self.cnn.model(batch)
+        return features.detach().cpu().numpy()
+
+    def describe_transform(self):
+        '''
+        Describe the torchvision preprocessing so that other backends can replicate it
+
+        :return: list of dicts, one per transform step
+        '''
+
+        steps = []
+        for t in self.cnn.transform.transforms:
+            if isinstance(t, transforms.Resize):
+                size = t.size if isinstance(t.size, int) else list(t.size)
+                steps.append({'op': 'resize', 'size': size})
+            elif isinstance(t, transforms.CenterCrop):
+                steps.append({'op': 'center_crop', 'size': list(t.size)})
+            elif isinstance(t, transforms.ToTensor):
+                steps.append({'op': 'to_tensor'})
+            elif isinstance(t, transforms.Normalize):
+                steps.append({'op': 'normalize', 'mean': list(t.mean), 'std': list(t.std)})
+            else:
+                raise ValueError(f'Unsupported transform for export: {t}')
+        return steps
+
+    def export_onnx(self, path):
+        '''
+        Export the embedding model to ONNX, the preprocessing is stored in the model metadata
+        '''
+
+        import onnx
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        dummy = torch.zeros(1, 3, 224, 224, device=self.cnn.device)
+        torch.onnx.export(
+            self.cnn.model,
+            dummy,
+            str(path),
+            input_names=['input'],
+            output_names=['features'],
+            dynamic_axes={'input': {0: 'batch', 2: 'height', 3: 'width'}, 'features': {0: 'batch'}},
+            opset_version=17,
+        )
+
+        model = onnx.load(str(path))
+        meta = model.metadata_props.add()
+        meta.key = 'preprocess'
+        meta.value = json.dumps(self.describe_transform())
+        onnx.save(model, str(path))
+        logger.info(f'Exported MobileNetV3 to {path}')
@@ -0,0 +1,88 @@
+import json
+
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+
+from ehclone.config import config
+from ehclone.logger import logger
+from ehclone.vectorizer.base import BaseVectorizer
+
+
+def quantized_path(path):
+    return path.with_suffix('.int8.onnx')
+
+
+def quantize(path):
+    '''
+    Write a dynamically int8-quantized copy of an exported model next to it
+    '''
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    target = quantized_path(path)
+    quantize_dynamic(str(path), str(target), weight_type=QuantType.QInt8)
+    logger.info(f'Quantized {path} to {target}')
+    return target
+
+
+class OnnxVectorizer(BaseVectorizer):
+    '''
+    The MobileNetV3 embedding on ONNX Runtime, same output as the torch backend
+    without loading torch. The model comes from Vectorizer.export_onnx.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        :param path: The exported model, defaults to config.vectorizer.onnx_model
+                     or its quantized copy if onnx_quantized is set
+        '''
+
+        if path is None:
+            path = config.vectorizer.onnx_model
+            if config.vectorizer.onnx_quantized:
+                path = quantized_path(path)
+
+        options = ort.SessionOptions()
+        if config.vectorizer.onnx_threads:
+            options.intra_op_num_threads = config.vectorizer.onnx_threads
+        self.session = ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.steps = json.loads(meta['preprocess'])
+
+        self._init_executor()
+        logger.info(f'Initialized ONNX MobileNetV3 vectorizer from {path}.')
+
+    def _preprocess(self, image):
+        array = None
+        for step in self.steps:
+            op = step['op']
+            if op == 'resize':
+                size = step['size']
+                if isinstance(size, int):
+                    # Match the shorter side like torchvision
+                    w, h = image.size
+                    if w <= h:
+                        size = [int(size * h / w), size]
+                    else:
+                        size = [size, int(size * w / h)]
+                h, w = size
+                image = image.resize((w, h), Image.BILINEAR)
+            elif op == 'center_crop':
+                h, w = step['size']
+                left = int(round((image.width - w) / 2))
+                top = int(round((image.height - h) / 2))
+                image = image.crop((left, top, left + w, top + h))
+            elif op == 'to_tensor':
+                array = np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255
+            elif op == 'normalize':
+                mean = np.array(step['mean'], dtype=np.float32).reshape(3, 1, 1)
+                std = np.array(step['std'], dtype=np.float32).reshape(3, 1, 1)
+                array = (array - mean) / std
+        return array
+
+    def _infer(self, images):
+        batch = np.stack(images).astype(np.float32)
+        return self.session.run(None, {self.input_name: batch})[0]
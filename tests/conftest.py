@@ -0,0 +1,17 @@
+import os
+import json
+import tempfile
+from pathlib import Path
+
+
+# ehclone.config loads APPDATA/config.json on import, point it at a copy of the example
+_appdata = Path(tempfile.mkdtemp(prefix='ehclone-test-'))
+_config = json.loads((Path(__file__).parents[1] / 'appdata' / 'config.example.json').read_text())
+_config['log']['dir'] = None
+_config['filter']['dedupe']['thumb_dir'] = str(_appdata / 'thumbnails')
+_config['filter']['dedupe']['embedding_dir'] = str(_appdata / 'embeddings')
+# Tests that need PostgreSQL run against this database and are skipped without it
+if os.environ.get('EHCLONE_TEST_DB_URL'):
+    _config['db']['url'] = os.environ['EHCLONE_TEST_DB_URL']
+(_appdata / 'config.json').write_text(json.dumps(_config))
+os.environ['APPDATA'] = str(_appdata)
@@ -0,0 +1,257 @@
+import json
+import time
+import base64
+import socket
+import struct
+import hashlib
+from threading import Thread, Lock, Event
+
+import pytest
+
+pytest.importorskip('websocket')
+
+from ehclone.config import config
+from ehclone.downloader.aria2_client import Aria2Client
+
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class FakeAria2:
+    '''
+    aria2 on one port like the real one: JSON-RPC over HTTP POST answering
+    aria2.tellStatus from self.statuses, and WebSocket upgrades that receive
+    whatever notify() sends
+    '''
+
+    def __init__(self):
+        self.statuses = {}
+        self.accept_ws = True
+        self.ws_connections = 0
+        self.polls = 0
+        self._sockets = []
+        self._lock = Lock()
+        self._ws_open = Event()
+
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.url = f'http://127.0.0.1:{self.port}/jsonrpc'
+        Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                conn.close()
+                return
+            data += chunk
+        head, body = data.split(b'\r\n\r\n', 1)
+        lines = head.decode().split('\r\n')
+        headers = {k.strip().lower(): v.strip() for k, v in (line.split(':', 1) for line in lines[1:])}
+
+        if headers.get('upgrade', '').lower() == 'websocket':
+            self._upgrade(conn, headers)
+            return
+
+        length = int(headers.get('content-length', 0))
+        while len(body) < length:
+            body += conn.recv(4096)
+        result = self._rpc(json.loads(body))
+        payload = json.dumps(result).encode()
+        conn.sendall(
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n'
+            + f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+        )
+        conn.close()
+
+    def _rpc(self, request):
+        assert request['method'] == 'system.multicall'
+        self.polls += 1
+        results = []
+        for call in request['params'][0]:
+            task_id = call['params'][0]
+            results.append([{'gid': task_id, 'status': self.statuses.get(task_id, 'active')}])
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': results}
+
+    def _upgrade(self, conn, headers):
+        if not self.accept_ws:
+            conn.sendall(b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            conn.close()
+            return
+        accept = base64.b64encode(hashlib.sha1(headers['sec-websocket-key'].encode() + WS_GUID).digest())
+        conn.sendall(
+            b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n'
+        )
+        with self._lock:
+            self._sockets.append(conn)
+            self.ws_connections += 1
+        self._ws_open.set()
+
+    def wait_for_ws(self, timeout=5):
+        assert self._ws_open.wait(timeout), 'notifier did not connect'
+
+    def notify(self, method, *task_ids):
+        message = json.dumps({
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': [{'gid': task_id} for task_id in task_ids],
+        }).encode()
+        # Unmasked text frame, payloads here stay under 126 bytes
+        assert len(message) < 126
+        frame = struct.pack('!BB', 0x81, len(message)) + message
+        with self._lock:
+            for conn in self._sockets:
+                conn.sendall(frame)
+
+    def drop(self):
+        '''
+        Close every WebSocket from the server side
+        '''
+
+        self._ws_open.clear()
+        with self._lock:
+            sockets, self._sockets = self._sockets, []
+        for conn in sockets:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def close(self):
+        self.drop()
+        self.server.close()
+
+
+@pytest.fixture
+def aria2(monkeypatch):
+    fake = FakeAria2()
+    monkeypatch.setattr(config.aria2, 'url', fake.url)
+    monkeypatch.setattr(config.aria2, 'ws_url', None)
+    monkeypatch.setattr(config.aria2, 'notifications', True)
+    monkeypatch.setattr(config.aria2, 'poll_interval', 0.2)
+    monkeypatch.setattr(config.aria2, 'safety_poll_interval', 60)
+
+    client = Aria2Client()
+    yield fake, client
+    client.notifier.close()
+    fake.close()
+
+
+def _collect(stream, timeout=5):
+    finished = {}
+    deadline = time.time() + timeout
+    while stream.pending and time.time() < deadline:
+        finished.update(stream.next_batch(timeout=deadline - time.time()))
+    return {task_id: status['result']['status'] for task_id, status in finished.items()}
+
+
+def test_notifications_finish_tasks(aria2):
+    fake, client = aria2
+    stream = client.completion_stream()
+    stream.add(['a', 'b', 'c'])
+    fake.wait_for_ws()
+
+    # Only the poll right after subscribing, the rest arrives over the socket
+    assert stream.next_batch(timeout=0.5) == {}
+    polls = fake.polls
+    fake.notify('aria2.onDownloadComplete', 'a')
+    fake.notify('aria2.onDownloadError', 'b')
+    fake.notify('aria2.onBtDownloadComplete', 'c')
+
+    assert _collect(stream) == {'a': 'complete', 'b': 'error', 'c': 'complete'}
+    assert fake.polls == polls
+
+
+def test_events_for_unknown_tasks_are_ignored(aria2):
+    fake, client = aria2
+    stream = client.completion_stream()
+    stream.add(['a'])
+    fake.wait_for_ws()
+
+    fake.notify('aria2.onDownloadComplete', 'other')
+    fake.notify('aria2.onDownloadStart', 'a')
+    assert stream.next_batch(timeout=0.5) == {}
+    fake.notify('aria2.onDownloadStop', 'a')
+    assert _collect(stream) == {'a': 'removed'}
+
+
+def test_reconnects_after_drop(aria2):
+    fake, client = aria2
+    stream = client.completion_stream()
+    stream.add(['a'])
+    fake.wait_for_ws()
+    assert fake.ws_connections == 1
+
+    fake.drop()
+    deadline = time.time() + 5
+    while client.notifier.connected.is_set() and time.time() < deadline:
+        time.sleep(0.05)
+    assert not client.notifier.connected.is_set()
+
+    # The first retry comes after a one second backoff
+    fake.wait_for_ws()
+    assert fake.ws_connections == 2
+    deadline = time.time() + 5
+    while not client.notifier.connected.is_set() and time.time() < deadline:
+        time.sleep(0.05)
+
+    fake.notify('aria2.onDownloadComplete', 'a')
+    assert _collect(stream) == {'a': 'complete'}
+
+
+def test_backoff_grows_while_refused(aria2):
+    fake, client = aria2
+    fake.accept_ws = False
+
+    # Record the backoff of every failed attempt without sleeping through it
+    attempts = []
+    original = client.notifier._closed.wait
+    client.notifier._closed.wait = lambda timeout: attempts.append(timeout) or original(0.01)
+    stream = client.completion_stream()
+    stream.add(['a'])
+    deadline = time.time() + 5
+    while len(attempts) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert attempts[:4] == [1, 2, 4, 8]
+    stream.close()
+
+
+def test_falls_back_to_polling_while_disconnected(aria2):
+    fake, client = aria2
+    stream = client.completion_stream()
+    stream.add(['a', 'b'])
+    fake.wait_for_ws()
+    assert stream.next_batch(timeout=0.3) == {}
+
+    fake.accept_ws = False
+    fake.drop()
+    fake.statuses['a'] = 'complete'
+    fake.statuses['b'] = 'error'
+
+    polls = fake.polls
+    assert _collect(stream) == {'a': 'complete', 'b': 'error'}
+    assert fake.polls > polls
+    assert not client.notifier.connected.is_set()
+
+
+def test_polls_without_notifier(aria2, monkeypatch):
+    fake, _ = aria2
+    monkeypatch.setattr(config.aria2, 'notifications', False)
+    client = Aria2Client()
+    assert client.notifier is None
+
+    fake.statuses['a'] = 'complete'
+    results, remaining = client.wait_for_tasks(['a'], timeout=5)
+    assert results['a']['result']['status'] == 'complete'
+    assert not remaining
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from ehclone.dedupe.embeddings import EmbeddingStore
+from ehclone.db.crud.thumb import VECTOR_DIM
+
+
+def _vector(seed):
+    return np.random.default_rng(seed).standard_normal(VECTOR_DIM)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = EmbeddingStore(tmp_path, dtype='float32')
+    base = _vector(0)
+    # a and b are near-duplicates, c is unrelated
+    store.upsert(['a', 'b', 'c'], [1, 1, None], [base, base + 0.01 * _vector(1), _vector(2)])
+    store.upsert_galleries(
+        [10, 11, 12, 20, 30, 40],
+        [20, 20, 100, 21, 20, 20],
+        [store.index['a'], store.index['a'], store.index['a'], store.index['b'], store.index['c'], -1],
+    )
+    return store
+
+
+def _pairs(gids):
+    return {tuple(sorted(pair)) for pair in gids.tolist()}
+
+
+def test_every_gallery_of_a_thumb_is_paired(store):
+    gids, distances = store.candidate_pairs(full=True, page_tolerance=8)
+    # 12 is too long, 30 and 40 have no near-duplicate thumb
+    assert _pairs(gids) == {(10, 11), (10, 20), (11, 20)}
+    assert len(gids) == len(distances)
+
+
+def test_gallery_mapping_survives_reload_and_updates(store, tmp_path):
+    store.save()
+    reloaded = EmbeddingStore(tmp_path)
+    assert reloaded.gallery_gids.tolist() == [10, 11, 12, 20, 30, 40]
+
+    # 11 moved to the unrelated thumb, 12 was trimmed, 50 is new
+    reloaded.upsert_galleries(
+        [11, 12, 50, 12],
+        [20, 0, 20, 22],
+        [reloaded.index['c'], reloaded.index['a'], reloaded.index['b'], reloaded.index['a']],
+    )
+    assert reloaded.gallery_gids.tolist() == [10, 11, 12, 20, 30, 40, 50]
+    gids, _ = reloaded.candidate_pairs(full=True, page_tolerance=8)
+    assert _pairs(gids) == {(10, 12), (10, 20), (12, 20), (10, 50), (12, 50), (20, 50), (11, 30)}
+
+
+def test_unfinished_sync_is_dropped_on_load(store, tmp_path):
+    store.save()
+    meta = (tmp_path / 'meta.json').read_text()
+    store.upsert(['d'], [None], [_vector(3)])
+    store.upsert_galleries([60], [20], [store.index['d']])
+    store.save()
+    # Interrupted after the arrays were written but before meta.json
+    (tmp_path / 'meta.json').write_text(meta)
+
+    reloaded = EmbeddingStore(tmp_path)
+    assert reloaded.count == 3
+    assert reloaded.gallery_rows[reloaded.gallery_gids == 60].tolist() == [-1]
+
+
+def test_unhashed_thumbs_fall_back_to_cosine(tmp_path):
+    store = EmbeddingStore(tmp_path, dtype='float32')
+    base = _vector(0)
+    # b was vectorized before dhash was stored
+    store.upsert(['a', 'b', 'c'], [1, None, 0x0F0F0F0F0F0F0F0F], [base, base + 0.01 * _vector(1), _vector(2)])
+    store.upsert_galleries([10, 20, 30], [20, 20, 20], [0, 1, 2])
+
+    gids, _ = store.candidate_pairs(page_tolerance=8)
+    assert _pairs(gids) == {(10, 20)}
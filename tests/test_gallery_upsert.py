@@ -0,0 +1,121 @@
+import copy
+from contextlib import contextmanager
+
+import pytest
+
+from ehclone.db.cache import tag_cache, thumb_cache
+from ehclone.db.crud import gallery
+from ehclone.db.crud.gallery import parse_gdata
+
+
+GDATA = {
+    'gid': 3012345,
+    'token': '0a1b2c3d4e',
+    'title': '[Circle] Title',
+    'title_jpn': '[サークル] タイトル',
+    'category': 'Doujinshi',
+    'thumb': 'https://ehgt.org/w/01/234/56789-abcdefgh.webp',
+    'uploader': 'someone',
+    'posted': '1717171717',
+    'filecount': '24',
+    'filesize': 12345678,
+    'expunged': False,
+    'rating': '4.56',
+    'torrentcount': '1',
+    'torrents': [
+        {'hash': 'a' * 40, 'added': '1717171800', 'name': 'Title.zip', 'tsize': '1234', 'fsize': '12345678'},
+    ],
+    'tags': ['language:english', 'female:glasses', 'other:full color'],
+    'parent_gid': '3012300',
+    'parent_key': 'ffeeddccbb',
+    'first_gid': '3012200',
+    'first_key': '1122334455',
+}
+
+
+def _fingerprint(gdata):
+    return parse_gdata(gdata)[0]['fingerprint']
+
+
+def test_parse_gdata():
+    row, first, tags, torrents = parse_gdata(GDATA)
+    assert row['gid'] == 3012345
+    assert row['rating'] == 91
+    assert row['first_gid'] == 3012200
+    assert first == (3012200, '1122334455')
+    assert sorted(tags) == [('female', 'glasses'), ('language', 'english'), ('other', 'full color')]
+    assert [t['infohash'] for t in torrents] == ['a' * 40]
+
+
+def test_fingerprint_is_stable():
+    reordered = copy.deepcopy(GDATA)
+    reordered['tags'].reverse()
+    # Not part of the stored row
+    reordered['torrentcount'] = '2'
+    assert _fingerprint(GDATA) == _fingerprint(copy.deepcopy(GDATA)) == _fingerprint(reordered)
+
+
+@pytest.mark.parametrize('change', [
+    lambda g: g['tags'].append('male:glasses'),
+    lambda g: g['tags'].remove('female:glasses'),
+    lambda g: g['torrents'][0].update(name='Title (v2).zip'),
+    lambda g: g['torrents'].append(dict(g['torrents'][0], hash='b' * 40)),
+    lambda g: g['torrents'].clear(),
+    lambda g: g.update(rating='4.61'),
+    lambda g: g.update(expunged=True),
+])
+def test_fingerprint_changes(change):
+    changed = copy.deepcopy(GDATA)
+    change(changed)
+    assert _fingerprint(changed) != _fingerprint(GDATA)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    '''
+    Run insert_galleries without a database, upsert_batch only resolves tags and thumbs
+    '''
+
+    state = {'fail_commit': False, 'rolled_back': False}
+
+    @contextmanager
+    def session_generator():
+        try:
+            yield object()
+            if state['fail_commit']:
+                raise RuntimeError('could not serialize access')
+        except Exception:
+            state['rolled_back'] = True
+            raise
+
+    def upsert_batch(session, gdata_list, pending_tags, pending_thumbs):
+        for gdata in gdata_list:
+            row, first, tags, _ = parse_gdata(gdata)
+            pending_tags.update({key: len(pending_tags) + 1 for key in tags if key not in pending_tags})
+            pending_thumbs[row['thumb_url']] = row['gid']
+        return set()
+
+    monkeypatch.setattr(gallery, 'session_generator', session_generator)
+    monkeypatch.setattr(gallery, 'upsert_batch', upsert_batch)
+    monkeypatch.setattr(gallery, 'warm_tag_cache', lambda session: None)
+    monkeypatch.setattr(gallery, 'resolve_chains', lambda session, first_gids: None)
+    tag_cache.clear()
+    thumb_cache.clear()
+    yield state
+    tag_cache.clear()
+    thumb_cache.clear()
+
+
+def test_caches_published_after_commit(fake_db):
+    gallery.insert_galleries([GDATA])
+    assert tag_cache.get_many([('language', 'english')]) == {('language', 'english'): 1}
+    assert thumb_cache.get_many([GDATA['thumb']]) == {GDATA['thumb']: 3012345}
+
+
+def test_caches_untouched_on_rollback(fake_db):
+    fake_db['fail_commit'] = True
+    with pytest.raises(RuntimeError):
+        gallery.insert_galleries([GDATA])
+    assert fake_db['rolled_back']
+    assert len(tag_cache) == 0
+    assert len(thumb_cache) == 0
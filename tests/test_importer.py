@@ -0,0 +1,34 @@
+import gzip
+import json
+import sys
+
+import pytest
+
+from ehclone.core.importer import iter_dump
+
+
+ENTRIES = [{'gid': 1, 'token': 'a'}, {'gid': 2, 'token': 'b'}, {'gid': 3, 'error': 'Key missing'}]
+
+
+def test_gzip_dump(tmp_path):
+    path = tmp_path / 'dump.jsonl.gz'
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(ENTRIES[0]) + '\n')
+        f.write(json.dumps({'gmetadata': ENTRIES[1:]}) + '\n')
+    assert list(iter_dump(path)) == ENTRIES[:2]
+
+
+def test_zst_dump(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    path = tmp_path / 'dump.jsonl.zst'
+    payload = ''.join(json.dumps(e) + '\n' for e in ENTRIES)
+    path.write_bytes(zstandard.ZstdCompressor().compress(payload.encode('utf-8')))
+    assert list(iter_dump(path)) == ENTRIES[:2]
+
+
+def test_zst_dump_without_zstandard(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    path = tmp_path / 'dump.jsonl.zst'
+    path.write_bytes(b'')
+    with pytest.raises(ImportError, match=r'ehclone\[zstd\]'):
+        list(iter_dump(path))
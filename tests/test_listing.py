@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('lxml')
+
+from ehclone.core.listing import parse_listing
+
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'listing'
+
+GALLERIES = [
+    [3012345, '0a1b2c3d4e'],
+    [3012340, 'f0e1d2c3b4'],
+    [3012301, '9a8b7c6d5e'],
+]
+
+
+@pytest.mark.parametrize('mode, prev, next, count', [
+    ('compact', None, 3012301, 1234567),
+    ('extended', 3012345, 3012301, 1234567),
+    ('thumbnail', 3012345, 3012301, 87654),
+    ('minimal', 3012345, None, 42),
+    ('minimal_plus', 3012345, 3012301, 12345),
+])
+def test_display_modes(mode, prev, next, count):
+    page = parse_listing((FIXTURES / f'{mode}.html').read_bytes())
+    assert page.galleries == GALLERIES
+    assert (page.prev, page.next, page.count) == (prev, next, count)
+
+
+def test_minimal_plus_inline_tags():
+    # Tags sit inside the /g/ link of every row, next to the title
+    content = (FIXTURES / 'minimal_plus.html').read_bytes()
+    assert content.count(b'<div class="gt" title=') == 8
+    page = parse_listing(content)
+    assert page.galleries == GALLERIES
+
+
+def test_no_hits():
+    page = parse_listing((FIXTURES / 'empty.html').read_bytes())
+    assert page.galleries == []
+    assert (page.prev, page.next, page.count) == (None, None, None)
+
+
+def test_compact_matches_soup_parser():
+    pytest.importorskip('bs4')
+    from ehclone.core.listing_benchmark import parse_listing_soup
+
+    content = (FIXTURES / 'compact.html').read_bytes()
+    assert parse_listing_soup(content) == parse_listing(content).galleries
+
+
+def test_benchmark_runs_on_fixtures(capsys):
+    pytest.importorskip('bs4')
+    from ehclone.core.listing_benchmark import bench_listing_parsers
+
+    bench_listing_parsers(FIXTURES, repeat=2)
+    output = capsys.readouterr().out
+    assert 'lxml xpath' in output
+    assert all(f'{mode}.html' in output for mode in ('compact', 'extended', 'thumbnail', 'minimal', 'minimal_plus'))
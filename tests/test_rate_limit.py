@@ -0,0 +1,133 @@
+from threading import Lock
+
+import pytest
+import requests
+
+from ehclone.core import eh_session, rate_limiter
+from ehclone.core.eh_session import EHSession, Identity, classify_response
+from ehclone.core.rate_limiter import AdaptiveBucket, RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, 'monotonic', clock)
+    monkeypatch.setattr(eh_session, 'monotonic', clock)
+    return clock
+
+
+def _response(status=200, body=b'<html>' + b' ' * 4096 + b'</html>', headers=None):
+    res = requests.Response()
+    res.status_code = status
+    res._content = body
+    res.headers.update(headers or {})
+    res.encoding = 'utf-8'
+    return res
+
+
+def test_classify_ok():
+    assert classify_response(_response()) == (RateLimiter.OK, None)
+    assert classify_response(_response(body=b'{"gmetadata": []}')) == (RateLimiter.OK, None)
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_classify_overload_status(status):
+    assert classify_response(_response(status, headers={'Retry-After': '120'})) == (RateLimiter.OVERLOAD, 120)
+    assert classify_response(_response(status)) == (RateLimiter.OVERLOAD, 60)
+
+
+def test_classify_overload_page():
+    body = b'You are opening pages too fast, thus placing a heavy load on the server.'
+    assert classify_response(_response(body=body)) == (RateLimiter.OVERLOAD, 60)
+
+
+def test_classify_ban_page():
+    body = b'Your IP address has been temporarily banned. The ban expires in 1 hour and 25 minutes'
+    assert classify_response(_response(body=body)) == (RateLimiter.BANNED, 3600 + 25 * 60)
+
+
+def test_classify_error():
+    assert classify_response(_response(404)) == (RateLimiter.ERROR, None)
+
+
+def test_bucket_refill(clock):
+    bucket = TokenBucket(rate=0.5, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(2)
+    # The reserved token is owed first, then the bucket fills up to burst only
+    clock.now += 4
+    assert bucket.peek() == 0
+    clock.now += 100
+    bucket.reserve()
+    bucket.reserve()
+    assert bucket.peek() == pytest.approx(2)
+
+
+def test_aimd_halves_and_recovers(clock):
+    bucket = AdaptiveBucket(max_rate=1, min_rate=0.1, increase=0.1, decrease=0.5)
+    bucket.on_overload()
+    assert bucket.rate == pytest.approx(0.5)
+    bucket.on_overload()
+    bucket.on_overload()
+    bucket.on_overload()
+    assert bucket.rate == pytest.approx(0.1)
+
+    for _ in range(5):
+        bucket.on_success()
+    assert bucket.rate == pytest.approx(0.6)
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == pytest.approx(1)
+
+
+def test_overload_pause(clock):
+    bucket = AdaptiveBucket(max_rate=1)
+    bucket.on_overload(pause=30)
+    assert bucket.peek() == pytest.approx(30)
+    clock.now += 30
+    assert bucket.peek() == 0
+
+
+def test_feedback_paces_every_bucket(clock):
+    limiter = RateLimiter(AdaptiveBucket(max_rate=1), {'api': AdaptiveBucket(max_rate=0.5)})
+    limiter.feedback('api', RateLimiter.OVERLOAD)
+    assert limiter.rate == pytest.approx(0.5)
+    assert limiter.endpoint_buckets['api'].rate == pytest.approx(0.25)
+    limiter.feedback('listing', RateLimiter.ERROR)
+    assert limiter.rate == pytest.approx(0.5)
+
+
+@pytest.fixture
+def pool(clock):
+    session = EHSession.__new__(EHSession)
+    session._lock = Lock()
+    session.identities = [Identity('slow', min_request_interval=10), Identity('fast', min_request_interval=2)]
+    return session
+
+
+def test_pick_soonest_refill(pool):
+    slow, fast = pool.identities
+    # Both start with a full bucket, spend them
+    assert pool._pick('api') == (slow, 0)
+    assert pool._pick('api') == (fast, 0)
+    # fast refills in 2s, slow in 10s
+    identity, wait = pool._pick('api')
+    assert identity is fast and wait == pytest.approx(2)
+
+
+def test_pick_skips_parked(pool, clock):
+    slow, fast = pool.identities
+    fast.park(60)
+    assert pool._pick('api') == (slow, 0)
+    slow.park(30)
+    identity, wait = pool._pick('api')
+    assert identity is None and wait == pytest.approx(30)
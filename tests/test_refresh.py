@@ -0,0 +1,77 @@
+import pytest
+import requests
+
+from ehclone.core import refresh
+from ehclone.core.eh_session import ehs
+
+
+def _entry(gid, token):
+    return {'gid': gid, 'token': token}
+
+
+@pytest.fixture
+def chunks(monkeypatch):
+    '''
+    Serve gdata chunks from a dict of gid to entry, None fails the chunk
+    '''
+
+    served = {}
+
+    def _gdata_chunk(gidlist):
+        if any(served.get(gid, '') is None for gid, _ in gidlist):
+            raise requests.ConnectionError('connection reset')
+        return [served[gid] for gid, _ in gidlist if served.get(gid)]
+
+    monkeypatch.setattr(ehs, '_gdata_chunk', _gdata_chunk)
+    monkeypatch.setattr(ehs, 'GDATA_LIMIT', 2)
+    return served
+
+
+def test_failed_chunks_are_not_missing(chunks):
+    chunks.update({1: _entry(1, 'a'), 3: None, 5: _entry(5, 'e')})
+    results, unfetched = ehs.gdata_partial([[1, 'a'], [2, 'b'], [3, 'c'], [4, 'd'], [5, 'e']])
+    # 2 was answered without an entry, 3 and 4 shared the failed chunk
+    assert sorted(d['gid'] for d in results) == [1, 5]
+    assert unfetched == {3, 4}
+    assert ehs.gdata([[1, 'a'], [5, 'e']]) == [_entry(1, 'a'), _entry(5, 'e')]
+    assert ehs.gdata([[1, 'a'], [2, 'b']]) == {}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    '''
+    In-memory stand-in for the gallery table, gid to token of the galleries due
+    '''
+
+    state = {'due': {}, 'refreshed': [], 'missing': []}
+
+    def get_stale_galleries(limit):
+        return [[gid, token] for gid, token in sorted(state['due'].items())][:limit]
+
+    def mark_refreshed(gids, missing=()):
+        for gid in [*gids, *missing]:
+            del state['due'][gid]
+        state['refreshed'] += gids
+        state['missing'] += missing
+
+    monkeypatch.setattr(refresh, 'get_stale_galleries', get_stale_galleries)
+    monkeypatch.setattr(refresh, 'mark_refreshed', mark_refreshed)
+    monkeypatch.setattr(refresh, 'insert_galleries', lambda gdata: None)
+    return state
+
+
+def test_batch_of_unresolved_galleries_backs_off(chunks, db):
+    db['due'].update({1: 'a', 2: 'b', 3: 'c'})
+    chunks.update({3: _entry(3, 'c')})
+    assert refresh.refresh_galleries() == 3
+    assert db['refreshed'] == [3]
+    assert sorted(db['missing']) == [1, 2]
+
+
+def test_failed_requests_stay_due(chunks, db):
+    db['due'].update({1: 'a', 2: 'b', 3: 'c'})
+    chunks.update({1: None, 3: _entry(3, 'c')})
+    refresh.refresh_galleries()
+    assert db['refreshed'] == [3]
+    assert db['missing'] == []
+    assert db['due'] == {1: 'a', 2: 'b'}
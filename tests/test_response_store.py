@@ -0,0 +1,22 @@
+import time
+
+from ehclone.core.response_store import ResponseStore
+
+
+def test_prune_keeps_recent_responses(tmp_path, monkeypatch):
+    store = ResponseStore(tmp_path / 'responses.sqlite3')
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now - 10 * 86400)
+    store.put_listing('old', b'<html></html>')
+    store.put_gdata([{'gid': 1, 'token': 'a'}])
+    monkeypatch.setattr(time, 'time', lambda: now)
+    store.put_listing('new', b'<html></html>')
+    store.put_gdata([{'gid': 2, 'token': 'b'}])
+
+    assert store.prune(listing_age=86400) == (1, 0)
+    assert store.get_listing('old') is None
+    assert store.get_listing('new') == b'<html></html>'
+    assert store.count() == 2
+
+    assert store.prune(gdata_age=86400) == (0, 1)
+    assert store.get_gdata([[1, 'a'], [2, 'b']]) == [{'gid': 2, 'token': 'b'}]
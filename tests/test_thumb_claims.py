@@ -0,0 +1,60 @@
+import os
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+if not os.environ.get('EHCLONE_TEST_DB_URL'):
+    pytest.skip('EHCLONE_TEST_DB_URL is not set', allow_module_level=True)
+
+from sqlalchemy import delete, insert, update, func
+
+from ehclone.config import config
+from ehclone.db.entities import Thumb
+from ehclone.db.session import session_generator
+from ehclone.db.crud.thumb import claim_unvectorized_thumbs
+
+
+PREFIX = 'https://test.invalid/claim/'
+
+
+@pytest.fixture
+def thumbs():
+    from ehclone.main import init_db
+
+    init_db()
+    with session_generator() as session:
+        # A dedicated test database, lease every other queued thumb so the queue only holds these
+        session.execute(delete(Thumb).where(Thumb.url.startswith(PREFIX)))
+        session.execute(update(Thumb).where(Thumb.mobile_net_v3.is_(None)).values(claimed_at=func.now()))
+        session.execute(insert(Thumb).values([{'url': f'{PREFIX}{i:02}', 'first_gid': i} for i in range(20)]))
+    yield [(i, f'{PREFIX}{i:02}') for i in range(20)]
+    with session_generator() as session:
+        session.execute(delete(Thumb).where(Thumb.url.startswith(PREFIX)))
+
+
+def test_claims_never_overlap(thumbs):
+    first = claim_unvectorized_thumbs(5)
+    assert first == thumbs[:5]
+    assert claim_unvectorized_thumbs(5) == thumbs[5:10]
+
+    with ThreadPoolExecutor(4) as executor:
+        claims = list(executor.map(lambda _: claim_unvectorized_thumbs(3), range(4)))
+    claimed = [c for claim in claims for c in claim]
+    assert len(claimed) == len(set(claimed)) == 10
+    assert sorted(claimed) == thumbs[10:]
+    assert claim_unvectorized_thumbs(5) == []
+
+
+def test_expired_lease_is_claimed_again(thumbs):
+    claim_unvectorized_thumbs(20)
+    assert claim_unvectorized_thumbs(20) == []
+
+    expired = func.now() - timedelta(seconds=config.db.thumb_claim_lease + 1)
+    with session_generator() as session:
+        session.execute(update(Thumb).where(Thumb.url.in_([thumbs[3][1], thumbs[7][1]])).values(claimed_at=expired))
+    assert claim_unvectorized_thumbs(20) == [thumbs[3], thumbs[7]]
+    # The keyset cursor still applies
+    with session_generator() as session:
+        session.execute(update(Thumb).where(Thumb.url == thumbs[3][1]).values(claimed_at=expired))
+    assert claim_unvectorized_thumbs(20, after=thumbs[3]) == []
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+pytest.importorskip('torch')
+pytest.importorskip('imagededup')
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+
+# Thumbs are not square, so the shorter-side resize and the crop are both exercised
+SIZES = [(250, 354), (250, 176), (224, 224), (180, 250), (300, 300)]
+
+
+def _images(directory):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i, (w, h) in enumerate(SIZES):
+        x = np.linspace(0, 1, w)[None, :, None]
+        y = np.linspace(0, 1, h)[:, None, None]
+        base = rng.random(3)
+        pixels = (255 * np.clip(base * x + (1 - base) * y, 0, 1)).astype(np.uint8)
+        image = Image.fromarray(pixels, 'RGB')
+        draw = ImageDraw.Draw(image)
+        for _ in range(8):
+            x0, y0 = rng.integers(0, w // 2), rng.integers(0, h // 2)
+            box = [x0, y0, x0 + rng.integers(10, w // 2), y0 + rng.integers(10, h // 2)]
+            draw.ellipse(box, fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+        path = directory / f'{i}.jpg'
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture(scope='module')
+def backends(tmp_path_factory):
+    from ehclone.vectorizer.mobile_net_v3 import Vectorizer
+    from ehclone.vectorizer.onnx_mobile_net_v3 import OnnxVectorizer
+
+    try:
+        torch_backend = Vectorizer()
+    except Exception as e:
+        pytest.skip(f'MobileNetV3 weights unavailable: {e}')
+
+    directory = tmp_path_factory.mktemp('vectorizer')
+    model = directory / 'mobilenet_v3_small.onnx'
+    torch_backend.export_onnx(model)
+    return torch_backend, OnnxVectorizer(model), model, _images(directory)
+
+
+def _cosines(a, b):
+    assert not np.isnan(a).any() and not np.isnan(b).any()
+    return np.sum(a * b, axis=1)
+
+
+def test_onnx_matches_torch(backends):
+    torch_backend, onnx_backend, _, paths = backends
+    reference, reference_hashes = torch_backend.encode_batch_with_hashes(paths)
+    vectors, hashes = onnx_backend.encode_batch_with_hashes(paths)
+
+    assert _cosines(vectors, reference).min() >= 0.999
+    assert hashes == reference_hashes
+
+
+def test_quantized_onnx_close_to_torch(backends):
+    from ehclone.vectorizer.onnx_mobile_net_v3 import OnnxVectorizer, quantize
+
+    torch_backend, _, model, paths = backends
+    quantized = OnnxVectorizer(quantize(model))
+    assert _cosines(quantized.encode_batch(paths), torch_backend.encode_batch(paths)).min() >= 0.9